@@ -2,6 +2,9 @@ import Cookie
 import logging
 import datetime
 import hashlib
+import threading
+import time
+from collections import OrderedDict
 
 from ckanext.dgu.drupalclient import DrupalClient, DrupalXmlRpcSetupError, \
      DrupalRequestError
@@ -9,6 +12,112 @@ from xmlrpclib import ServerProxy
 
 log = logging.getLogger(__name__)
 
+
+class _Lookup(object):
+    '''A lookup of a session in Drupal that other threads can wait for.'''
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class DrupalSessionCache(object):
+    '''Remembers what Drupal said about each session ID, so that it is not
+    asked again on every login.
+
+    Valid sessions are kept for ttl seconds and invalid ones (value None) for
+    negative_ttl seconds. The least recently used are dropped beyond
+    max_size. When several threads look up the same session at once, only
+    one asks Drupal and the others wait for its answer. Errors are not
+    cached.
+    '''
+    def __init__(self, max_size=10000, ttl=300, negative_ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # {session_id: (expires, value)}
+        self._lookups = {}  # {session_id: _Lookup}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.errors = 0
+        self.drupal_calls = 0
+        self.drupal_seconds = 0.0
+        self.drupal_max_seconds = 0.0
+
+    def get(self, session_id, load):
+        '''Returns the cached value for the session, or calls
+        load(session_id) to get it.'''
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry and entry[0] > time.time():
+                # re-insert to mark it as the most recently used
+                self._entries[session_id] = entry
+                if entry[1] is None:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                return entry[1]
+            lookup = self._lookups.get(session_id)
+            if lookup:
+                self.waits += 1
+                is_loader = False
+            else:
+                lookup = self._lookups[session_id] = _Lookup()
+                self.misses += 1
+                is_loader = True
+
+        if not is_loader:
+            lookup.done.wait()
+            if lookup.error:
+                raise lookup.error
+            return lookup.value
+
+        try:
+            lookup.value = load(session_id)
+        except Exception, e:
+            lookup.error = e
+            with self._lock:
+                self.errors += 1
+                del self._lookups[session_id]
+            lookup.done.set()
+            raise
+        ttl = self.ttl if lookup.value is not None else self.negative_ttl
+        with self._lock:
+            self._entries[session_id] = (time.time() + ttl, lookup.value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            del self._lookups[session_id]
+        lookup.done.set()
+        return lookup.value
+
+    def record_drupal_call(self, seconds):
+        with self._lock:
+            self.drupal_calls += 1
+            self.drupal_seconds += seconds
+            self.drupal_max_seconds = max(self.drupal_max_seconds, seconds)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses + self.waits
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'errors': self.errors,
+                'hit_ratio': float(self.hits + self.negative_hits + self.waits)
+                             / lookups if lookups else None,
+                'drupal_calls': self.drupal_calls,
+                'drupal_mean_seconds': self.drupal_seconds / self.drupal_calls
+                                       if self.drupal_calls else None,
+                'drupal_max_seconds': self.drupal_max_seconds,
+                }
+
+
 class DrupalAuthMiddleware(object):
     '''Allows CKAN user to login via Drupal. It looks for the Drupal cookie
     and gets user details from Drupal using XMLRPC.
@@ -23,6 +132,14 @@ class DrupalAuthMiddleware(object):
         self.seconds_between_checking_drupal_cookie = int(minutes_between_checking_drupal_cookie) * 60
         # if that int() raises a ValueError then the app will not start
 
+        app_conf = app_conf or {}
+        self.session_cache = DrupalSessionCache(
+            max_size=int(app_conf.get('dgu.drupal_auth.session_cache_size', 10000)),
+            ttl=int(app_conf.get('dgu.drupal_auth.session_cache_ttl', 300)),
+            negative_ttl=int(app_conf.get('dgu.drupal_auth.session_cache_negative_ttl', 60)))
+        self.stats_log_interval = int(app_conf.get('dgu.drupal_auth.stats_log_interval', 1000))
+        self._logins = 0
+
     def _parse_cookies(self, environ):
         is_ckan_cookie = [False]
         drupal_session_id = [False]
@@ -187,72 +304,102 @@ class DrupalAuthMiddleware(object):
         the equivalent CKAN user with properties copied from Drupal and log the
         person in with auth_tkt and its cookie.
         '''
-        if self.drupal_client is None:
-            self.drupal_client = DrupalClient()
-        # ask drupal for the drupal_user_id for this session
         try:
-            drupal_user_id = self.drupal_client.get_user_id_from_session_id(drupal_session_id)
+            session = self.session_cache.get(drupal_session_id,
+                                             self._load_drupal_session)
         except DrupalRequestError, e:
             log.error('Error checking session with Drupal: %s', e)
             return
-        if not drupal_user_id:
+        finally:
+            self._logins += 1
+            if self.stats_log_interval and \
+                    self._logins % self.stats_log_interval == 0:
+                log.info('Drupal session cache: %r',
+                         self.session_cache.stats())
+        if not session:
             log.debug('Drupal said the session ID found in the cookie is not valid.')
             return
+        ckan_user_name = session['user_name']
+
+        # There is a chance that on this request we needed to get authtkt
+        # to log-out. This would have created headers like this:
+        #   'Set-Cookie', 'auth_tkt="INVALID"...'
+        # but since we are about to login again, which will create a header
+        # setting that same cookie, we need to get rid of the invalidation
+        # header first.
+        new_headers[:] = [(key, value) for (key, value) in new_headers \
+                            if (not (key=='Set-Cookie' and value.startswith('auth_tkt="INVALID"')))]
+        #log.debug('Headers reduced to: %r', new_headers)
+
+        # Ask auth_tkt to remember this user so that subsequent requests
+        # will be authenticated by auth_tkt.
+        # auth_tkt cookie template needs to also go in the response.
+        identity = {'repoze.who.userid': str(ckan_user_name),
+                    'tokens': '',
+                    'userdata': drupal_session_id}
+        headers = environ['repoze.who.plugins']['dgu_auth_tkt'].remember(environ, identity)
+        if headers:
+            new_headers.extend(headers)
+
+        # Tell app during this request that the user is logged in
+        environ['REMOTE_USER'] = ckan_user_name
+        log.debug('Set REMOTE_USER = %r', ckan_user_name)
+
+    def _load_drupal_session(self, drupal_session_id):
+        '''Asks Drupal about the session and creates/updates the equivalent
+        CKAN user. Returns a dict of the Drupal user_id, properties, roles
+        and the CKAN user_name, or None if the session is not valid.
+
+        The result is cached in self.session_cache.
+        '''
+        if self.drupal_client is None:
+            self.drupal_client = DrupalClient()
+        # ask drupal for the drupal_user_id for this session
+        start = time.time()
+        drupal_user_id = self.drupal_client.get_user_id_from_session_id(drupal_session_id)
+        if not drupal_user_id:
+            self.session_cache.record_drupal_call(time.time() - start)
+            return None
 
         # ask drupal about this user
         drupal_user_properties = self.drupal_client.get_user_properties(drupal_user_id)
+        self.session_cache.record_drupal_call(time.time() - start)
+        roles = frozenset(drupal_user_properties['roles'].values())
         user_dict = DrupalUserMapping.drupal_user_to_ckan_user(
                 drupal_user_properties)
 
+        self._update_ckan_user(user_dict)
+        self.set_roles(user_dict['name'], roles)
+        return {'user_id': drupal_user_id,
+                'properties': drupal_user_properties,
+                'roles': roles,
+                'user_name': user_dict['name']}
+
+    def _update_ckan_user(self, user_dict):
+        '''Creates the CKAN user for the Drupal user, or updates its details
+        if they have changed.'''
         # see if user already exists in CKAN
         ckan_user_name = user_dict['name']
         from ckan import model
         from ckan.model.meta import Session
-        query = Session.query(model.User).filter_by(name=unicode(ckan_user_name))
-        if not query.count():
+        user = Session.query(model.User).filter_by(name=unicode(ckan_user_name)).first()
+        if not user:
             # need to add this user to CKAN
             user = model.User(**user_dict)
             Session.add(user)
             Session.commit()
             log.debug('Drupal user added to CKAN as: %s', user.name)
         else:
-            user = query.one()
             log.debug('Drupal user found in CKAN: %s', user.name)
 
             if user.email != user_dict['email'] or \
-                    user.fullname != user_dict['name']:
+                    user.fullname != user_dict['fullname']:
                 user.email = user_dict['email']
                 user.fullname = user_dict['fullname']
                 log.debug('User details updated from Drupal: %s %s',
                           user.email, user.fullname)
                 model.Session.commit()
 
-        self.set_roles(ckan_user_name, drupal_user_properties['roles'].values())
-
-        # There is a chance that on this request we needed to get authtkt
-        # to log-out. This would have created headers like this:
-        #   'Set-Cookie', 'auth_tkt="INVALID"...'
-        # but since we are about to login again, which will create a header
-        # setting that same cookie, we need to get rid of the invalidation
-        # header first.
-        new_headers[:] = [(key, value) for (key, value) in new_headers \
-                            if (not (key=='Set-Cookie' and value.startswith('auth_tkt="INVALID"')))]
-        #log.debug('Headers reduced to: %r', new_headers)
-
-        # Ask auth_tkt to remember this user so that subsequent requests
-        # will be authenticated by auth_tkt.
-        # auth_tkt cookie template needs to also go in the response.
-        identity = {'repoze.who.userid': str(ckan_user_name),
-                    'tokens': '',
-                    'userdata': drupal_session_id}
-        headers = environ['repoze.who.plugins']['dgu_auth_tkt'].remember(environ, identity)
-        if headers:
-            new_headers.extend(headers)
-
-        # Tell app during this request that the user is logged in
-        environ['REMOTE_USER'] = user.name
-        log.debug('Set REMOTE_USER = %r', user.name)
-
     def set_roles(self, user_name, drupal_roles):
         '''Sets CKAN user roles based on the drupal roles.
 
@@ -0,0 +1,142 @@
+'''
+Helpers for exports such as drupal_dump.py that fetch items from a remote
+service and write them out:
+
+ * FetchPool (from ckanext.dgu.lib.fetch_pool) - fetches the items over a
+   bounded pool of threads.
+ * JsonlExport - streams records to a gzipped JSON-lines file, checkpointing
+   which items are done so that an interrupted export can be resumed.
+'''
+import gzip
+import json
+import os
+import zlib
+
+class JsonlExport(object):
+    '''Writes records to a gzipped JSON-lines file, alongside a checkpoint
+    file (output_fpath + '.checkpoint') listing the ids of the items that are
+    done, whether or not they produced a record.
+
+    With resume=True, the records written by an interrupted run are kept and
+    the ids in `done` can be skipped. Ids are checkpointed in batches, once
+    the records before them are flushed to disk, along with the number of
+    records written for them. On resume the output is cut back to that
+    number, so a record whose id didn't get checkpointed is dropped, and
+    written again when its item is.
+
+    e.g.
+        with JsonlExport('nodes.jsonl.gz', resume=True) as export:
+            for nid in nids:
+                if nid in export.done:
+                    continue
+                export.mark_done(nid)
+                export.write(get_node(nid))
+    '''
+    def __init__(self, output_fpath, resume=False, commit_every=100):
+        self.output_fpath = output_fpath
+        self.checkpoint_fpath = output_fpath + '.checkpoint'
+        self.resume = resume
+        self.commit_every = commit_every
+        self.done = set()
+        self.pending_ids = []
+        self.records = 0  # written to the output, in this run and before
+        self.item_start = 0  # self.records before the last item
+        self.output_f = self.checkpoint_f = None
+
+    def __enter__(self):
+        if self.resume and os.path.exists(self.checkpoint_fpath):
+            self.done, records = self._read_checkpoint()
+            self.records = self._recover_output(records)
+            self.output_f = gzip.open(self.output_fpath, 'ab')
+            self.checkpoint_f = open(self.checkpoint_fpath, 'ab')
+        else:
+            self.output_f = gzip.open(self.output_fpath, 'wb')
+            self.checkpoint_f = open(self.checkpoint_fpath, 'wb')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # after an exception, the last item may not have been finished
+        self.commit(interrupted=exc_type is not None)
+        self.output_f.close()
+        self.checkpoint_f.close()
+        if exc_type is None:
+            os.remove(self.checkpoint_fpath)
+
+    def _read_checkpoint(self):
+        '''Returns the ids that are done and the number of records written
+        for them.'''
+        done = set()
+        records = 0
+        with open(self.checkpoint_fpath, 'rb') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                commit = json.loads(line)
+                done.update(commit['ids'])
+                records = commit['records']
+        return done, records
+
+    def _recover_output(self, records):
+        '''Rewrites the output with just the first `records` records, since
+        an interrupted run can leave records whose ids were not checkpointed,
+        and a truncated line or gzip member at the end.
+
+        Returns the number of records kept.'''
+        if not os.path.exists(self.output_fpath):
+            return 0
+        kept = 0
+        recovered_fpath = self.output_fpath + '.recovered'
+        with open(self.output_fpath, 'rb') as in_f, \
+                gzip.open(recovered_fpath, 'wb') as out_f:
+            # gzip.GzipFile raises without returning what it has read, so
+            # decompress each member (one per run) until the data ends
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            incomplete_line = ''
+            try:
+                while kept < records:
+                    data = in_f.read(64 * 1024)
+                    if not data:
+                        break
+                    while data and kept < records:
+                        lines = (incomplete_line +
+                                 decompressor.decompress(data)).split('\n')
+                        incomplete_line = lines.pop()
+                        for line in lines[:records - kept]:
+                            out_f.write(line + '\n')
+                            kept += 1
+                        data = decompressor.unused_data
+                        if data:
+                            decompressor = zlib.decompressobj(
+                                16 + zlib.MAX_WBITS)
+            except zlib.error:
+                pass
+        os.rename(recovered_fpath, self.output_fpath)
+        return kept
+
+    def write(self, record):
+        self.output_f.write(json.dumps(record) + '\n')
+        self.records += 1
+
+    def mark_done(self, item_id):
+        '''Records that the item is done. Call it before writing the item's
+        record.'''
+        if len(self.pending_ids) >= self.commit_every:
+            self.commit()
+        self.done.add(unicode(item_id))
+        self.pending_ids.append(unicode(item_id))
+        self.item_start = self.records
+
+    def commit(self, interrupted=False):
+        '''Checkpoints the pending ids. If interrupted, the last one (and
+        any record it has) is left to be done again.'''
+        ids, records = self.pending_ids, self.records
+        if interrupted:
+            ids, records = ids[:-1], self.item_start
+        self.pending_ids = []
+        if not ids:
+            return
+        self.output_f.flush()
+        os.fsync(self.output_f.fileno())
+        self.checkpoint_f.write(json.dumps({'records': records,
+                                            'ids': ids}) + '\n')
+        self.checkpoint_f.flush()
@@ -0,0 +1,108 @@
+'''
+Benchmarks DrupalClient against a mock Drupal server
+(testtools/mock_drupal2.py), comparing its pooled keep-alive transport with
+a new connection per call (as xmlrpclib.ServerProxy and requests.get do on
+their own).
+
+Usage:
+ $ python drupal_client_bench.py [-n 500] [-t 4] [-l 0.005] [-c 0.02]
+
+-c sets the time the mock server takes to accept a new connection, to
+simulate the TCP/TLS handshakes with a remote server, which is what the
+pooled connections save.
+'''
+import sys
+import time
+import threading
+import xmlrpclib
+from optparse import OptionParser
+
+import requests
+
+from ckanext.dgu.drupalclient import DrupalClient
+from ckanext.dgu.testtools.mock_drupal2 import MockDrupal2Server
+
+SESSION_ID = '4160a72a4d6831abec1ac57d7b5a59eb'
+
+
+class UnpooledCalls(object):
+    '''The calls as they were made before the shared transport.'''
+    def __init__(self, domain):
+        self.xmlrpc_url = 'http://%s/services/xmlrpc' % domain
+        self.rest_url = 'http://%s/services/rest' % domain
+
+    def login(self):
+        drupal_xmlrpc = xmlrpclib.ServerProxy(self.xmlrpc_url)
+        user_id = drupal_xmlrpc.session.retrieve(SESSION_ID)
+        return drupal_xmlrpc.user.retrieve(user_id)
+
+    def comments(self):
+        return requests.get(self.rest_url + '/views/replies'
+                            '?entity_type=node&entity_id=1').json()
+
+
+class PooledCalls(object):
+    def __init__(self, domain):
+        self.client = DrupalClient({'xmlrpc_domain': domain})
+
+    def login(self):
+        user_id = self.client.get_user_id_from_session_id(SESSION_ID)
+        return self.client.get_user_properties(user_id)
+
+    def comments(self):
+        return self.client.get_comments(1)
+
+
+def run(calls, num_requests, num_threads):
+    '''Makes num_requests logins and comment requests, spread over
+    num_threads. Returns the requests per second.'''
+    per_thread = num_requests / num_threads
+    def worker():
+        for i in xrange(per_thread):
+            calls.login()
+            calls.comments()
+    threads = [threading.Thread(target=worker) for i in range(num_threads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return per_thread * num_threads / (time.time() - start)
+
+
+def bench(num_requests, num_threads, latency, connect_latency, port):
+    server = MockDrupal2Server(port=port, latency=latency,
+                               connect_latency=connect_latency)
+    server.start()
+    domain = 'localhost:%s' % port
+    try:
+        for name, calls in (('New connection per call', UnpooledCalls(domain)),
+                            ('DrupalClient pooled', PooledCalls(domain))):
+            rate = run(calls, num_requests, num_threads)
+            print '%s: %.1f logins+comments/s' % (name, rate)
+        for method_name, stats in sorted(calls.client.stats().items()):
+            print '  %s: %r' % (method_name, stats)
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    usage = __doc__
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--requests', dest='requests', type='int',
+                      default=500, help='Number of logins+comments requests')
+    parser.add_option('-t', '--threads', dest='threads', type='int',
+                      default=4, help='Number of concurrent threads')
+    parser.add_option('-l', '--latency', dest='latency', type='float',
+                      default=0, help='Seconds the mock server takes per call')
+    parser.add_option('-c', '--connect-latency', dest='connect_latency',
+                      type='float', default=0.02,
+                      help='Seconds the mock server takes per new connection')
+    parser.add_option('-p', '--port', dest='port', type='int',
+                      default=8052, help='Port for the mock server')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('Wrong number of arguments')
+    bench(options.requests, options.threads, options.latency,
+          options.connect_latency, options.port)
+    sys.exit(0)
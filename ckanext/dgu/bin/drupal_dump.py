@@ -1,5 +1,9 @@
 '''
 Dump Drupal data to csv files.
+
+The items are requested from Drupal concurrently (see --workers and --rate).
+The users, forum, library and dataset_comments dumps checkpoint as they go, so
+can be carried on with --resume if they are interrupted.
 '''
 import argparse
 from pprint import pprint
@@ -19,6 +23,8 @@ from ckanext.dgu.drupalclient import (
     DrupalRequestError,
     )
 from running_stats import Stats
+from ckanext.dgu.lib.fetch_pool import FetchPool
+from concurrent_fetch import JsonlExport
 import common
 
 parse_jsonl = common.parse_jsonl
@@ -57,29 +63,30 @@ def users():
     user_id_list.sort()
     print 'Users to try: %s (up to %s)' % (len(user_id_list), user_id_list[-1])
 
-    i = 0
-    with gzip.open(args.output_fpath, 'wb') as output_f:
-        for user_id in common.add_progress_bar(
-                user_id_list, maxval=len(user_id_list)):
+    pool = get_fetch_pool()
+    with open_export(args.output_fpath) as export:
+        user_id_list = [user_id for user_id in user_id_list
+                        if unicode(user_id) not in export.done]
+        fetches = pool.imap(drupal.get_user_properties, user_id_list)
+        for i, (user_id, user, e) in enumerate(common.add_progress_bar(
+                fetches, maxval=len(user_id_list))):
             if i > 0 and i % 100 == 0:
-                print stats
-            i += 1
+                print stats, '%.1f requests/s' % pool.rate()
 
-            if args.user and str(user_id) != str(args.user):
-                continue
-            try:
-                user = drupal.get_user_properties(user_id)
-            except DrupalRequestError, e:
+            if e:
                 if 'There is no user with ID' in str(e):
+                    export.mark_done(user_id)
                     print stats.add('User ID unknown', int(user_id))
                     continue
                 elif 'Access denied for user anonymous' in str(e):
+                    export.mark_done(user_id)
                     print stats.add('User blocked', int(user_id))
                     continue
                 print stats.add('Error: %s' % e, int(user_id))
                 continue
+            export.mark_done(user_id)
             if not args.user:
-                output_f.write(json.dumps(user) + '\n')
+                export.write(user)
             stats.add('User dumped ok', int(user_id))
 
             if args.user:
@@ -106,19 +113,23 @@ def organograms():
 
     organograms_ = []
     organograms_public = []
-    i = 0
+    if args.publisher:
+        organogram_files = [organogram_file
+                            for organogram_file in organogram_files
+                            if organogram_file['name'] == args.publisher]
     print 'Organogram files to try: %s' % len(organogram_files)
-    for organogram_file in common.add_progress_bar(organogram_files):
+    pool = get_fetch_pool()
+    fetches = pool.imap(
+        lambda organogram_file: drupal.get_organogram_file_properties(
+            organogram_file['fid']),
+        organogram_files)
+    for i, (organogram_file, organogram, e) in enumerate(
+            common.add_progress_bar(fetches, maxval=len(organogram_files))):
         if i > 0 and i % 100 == 0:
-            print stats
-        i += 1
+            print stats, '%.1f requests/s' % pool.rate()
 
         fid = organogram_file['fid']
-        if args.publisher and organogram_file['name'] != args.publisher:
-            continue
-        try:
-            organogram = drupal.get_organogram_file_properties(fid)
-        except DrupalRequestError, e:
+        if e:
             if 'There is no organogram file with fid' in str(e):
                 print stats.add('Organogram fid unknown',
                                 int(fid))
@@ -284,22 +295,21 @@ def apps():
         #    thumb_url = ''
 
     nodes = drupal.get_nodes(type_filter='app')
-
+    # ignore Forum topics and blog posts that refer
+    # Eventually we might handle other types.
+    nodes = [node for node in nodes if node['type'] == 'app']
+    if args.app:
+        nodes = [node for node in nodes
+                 if args.app in (node['nid'], node['title'])]
+
+    pool = get_fetch_pool()
+    fetches = pool.imap(lambda node: drupal.get_node(node['nid']), nodes)
     with gzip.open(args.output_fpath, 'wb') as output_f, \
             gzip.open(args.public_output_fpath, 'wb') as public_output_f:
-        for node in common.add_progress_bar(nodes):
-            # ignore Forum topics and blog posts that refer
-            # Eventually we might handle other types.
-            if node['type'] != 'app':
-                continue
-            app = node
-            if args.app and args.app not in (app['nid'], app['title']):
-                continue
-
+        for node, app_node, e in common.add_progress_bar(
+                fetches, maxval=len(nodes)):
             # Get main details from the node
-            try:
-                app_node = drupal.get_node(node['nid'])
-            except DrupalRequestError, e:
+            if e:
                 if 'There is no app file with nid' in str(e):
                     print stats.add('Node id unknown',
                                     int(node['nid']))
@@ -450,27 +460,36 @@ def forum():
 
     print 'Topics to try: %s' % len(topics)
 
-    i = 0
-    with gzip.open(args.output_fpath, 'wb') as output_f:
-        for topic in common.add_progress_bar(topics):
+    if args.topic:
+        topics = [topic for topic in topics
+                  if args.topic in (topic['nid'], topic['title'])]
+
+    def get_topic(topic):
+        # the node and its comments, fetched together by the same worker
+        return (drupal.get_node(topic['nid']),
+                drupal.get_comments(topic['nid']))
+
+    pool = get_fetch_pool()
+    with open_export(args.output_fpath) as export:
+        topics = [topic for topic in topics
+                  if topic['nid'] not in export.done]
+        fetches = pool.imap(get_topic, topics)
+        for i, (topic, result, e) in enumerate(common.add_progress_bar(
+                fetches, maxval=len(topics))):
             if i > 0 and i % 100 == 0:
-                print stats
-            i += 1
-
-            if args.topic and args.topic not in (
-                    topic['nid'], topic['title']):
-                continue
+                print stats, '%.1f requests/s' % pool.rate()
 
             # Get main details from the node
-            try:
-                topic_node = drupal.get_node(topic['nid'])
-            except DrupalRequestError, e:
+            if e:
                 if 'There is no node with nid' in str(e):
+                    export.mark_done(topic['nid'])
                     print stats.add('Node id unknown',
-                                    int(node['nid']))
+                                    int(topic['nid']))
                     continue
-                print stats.add('Error: %s' % e, int(fid))
+                print stats.add('Error: %s' % e, int(topic['nid']))
                 continue
+            export.mark_done(topic['nid'])
+            topic_node, comments = result
 
             # topic_node is a superset of topic
             topic = topic_node
@@ -537,11 +556,6 @@ def forum():
 
 
             # Comments
-            try:
-                comments = drupal.get_comments(topic['nid'])
-            except DrupalRequestError, e:
-                print stats.add('Error: %s' % e, topic['nid'])
-                continue
             # e.g.
             # {u'changed': u'Saturday, 9 April, 2016 - 03:08',
             #  u'comment': u"<p>\n\tI'm not...</p>\n",
@@ -564,7 +578,7 @@ def forum():
                     }, topic['title'])
 
             if not args.topic:
-                output_f.write(json.dumps(topic) + '\n')
+                export.write(topic)
             stats.add('Topic dumped ok', int(topic['nid']))
 
             if args.topic:
@@ -603,26 +617,29 @@ def library():
 
     print 'Library items to try: %s' % len(items)
 
-    i = 0
-    with gzip.open(args.output_fpath, 'wb') as output_f:
-        for item in common.add_progress_bar(items):
-            if i > 0 and i % 100 == 0:
-                print stats
-            i += 1
+    if args.item:
+        items = [item for item in items
+                 if args.item in (item['nid'], item['title'])]
 
-            if args.item and args.item not in (item['nid'], item['title']):
-                continue
+    pool = get_fetch_pool()
+    with open_export(args.output_fpath) as export:
+        items = [item for item in items if item['nid'] not in export.done]
+        fetches = pool.imap(lambda item: drupal.get_node(item['nid']), items)
+        for i, (item, item_node, e) in enumerate(common.add_progress_bar(
+                fetches, maxval=len(items))):
+            if i > 0 and i % 100 == 0:
+                print stats, '%.1f requests/s' % pool.rate()
 
             # Get main details from the node
-            try:
-                item_node = drupal.get_node(item['nid'])
-            except DrupalRequestError, e:
+            if e:
                 if 'There is no node with nid' in str(e):
+                    export.mark_done(item['nid'])
                     print stats.add('Node id unknown',
                                     int(item['nid']))
                     continue
                 print stats.add('Error: %s' % e, int(item['nid']))
                 continue
+            export.mark_done(item['nid'])
 
             # item_node is a superset of item apart from 'uri'
             item.update(item_node)
@@ -715,7 +732,7 @@ def library():
             # TODO add in comments
 
             if not args.item:
-                output_f.write(json.dumps(item) + '\n')
+                export.write(item)
             stats.add('Library item dumped ok', int(item['nid']))
 
             if args.item:
@@ -769,17 +786,17 @@ def dataset_requests():
     print 'Dataset requests to try: %s' % len(requests)
 
     requests_public = []
-    i = 0
+    pool = get_fetch_pool()
+    fetches = pool.imap(lambda request: drupal.get_node(request['nid']),
+                        requests)
     with gzip.open(args.output_fpath, 'wb') as output_f:
-        for request in common.add_progress_bar(requests):
+        for i, (request, request_node, e) in enumerate(
+                common.add_progress_bar(fetches, maxval=len(requests))):
             if i > 0 and i % 100 == 0:
-                print stats
-            i += 1
+                print stats, '%.1f requests/s' % pool.rate()
 
             # Get main details from the node
-            try:
-                request_node = drupal.get_node(request['nid'])
-            except DrupalRequestError, e:
+            if e:
                 if 'There is no node with nid' in str(e):
                     print stats.add('Node id unknown',
                                     int(request['nid']))
@@ -1093,23 +1110,22 @@ def dataset_comments():
             if user_dict['status'] != '0'  # i.e. not blocked
             )
 
-    i = 0
-    with gzip.open(args.output_fpath, 'wb') as output_f:
-        for drupal_dataset_id in \
-                common.add_progress_bar(drupal_dataset_ids):
+    pool = get_fetch_pool()
+    with open_export(args.output_fpath) as export:
+        drupal_dataset_ids = [id_ for id_ in drupal_dataset_ids
+                              if id_ not in export.done]
+        fetches = pool.imap(drupal.get_dataset_comments, drupal_dataset_ids)
+        for i, (drupal_dataset_id, comments, e) in enumerate(
+                common.add_progress_bar(fetches,
+                                        maxval=len(drupal_dataset_ids))):
             if i > 0 and i % 250 == 0:
-                print stats
-            i += 1
-
-            if args.dataset and args.dataset != drupal_dataset_id:
-                continue
+                print stats, '%.1f requests/s' % pool.rate()
 
             # Comments
-            try:
-                comments = drupal.get_dataset_comments(drupal_dataset_id)
-            except DrupalRequestError, e:
+            if e:
                 print stats.add('Error: %s' % e, drupal_dataset_id)
                 continue
+            export.mark_done(drupal_dataset_id)
             # e.g.
             # {u'bundle': u'comment',
             #  u'changed': u'Monday, 14 October, 2013 - 19:31',
@@ -1168,7 +1184,7 @@ def dataset_comments():
                 comments=comments)
 
             if not args.dataset:
-                output_f.write(json.dumps(dataset) + '\n')
+                export.write(dataset)
             appendum = ' but not found in ckan' if not exists_in_ckan else ''
             stats.add('Dataset comments dumped ok' + appendum, readable_id)
 
@@ -1305,7 +1321,18 @@ def get_drupal_client():
         xmlrpc_scheme='https',
         xmlrpc_domain=args.domain,
         xmlrpc_username='CKAN_API',
-        xmlrpc_password=password))
+        xmlrpc_password=password,
+        # a connection for each worker
+        pool_size=args.workers))
+
+
+def get_fetch_pool():
+    return FetchPool(workers=args.workers, rate=args.rate,
+                     errors=(DrupalRequestError,))
+
+
+def open_export(output_fpath):
+    return JsonlExport(output_fpath, resume=args.resume)
 
 
 if __name__ == '__main__':
@@ -1315,6 +1342,15 @@ if __name__ == '__main__':
                         help='Remote domain to query')
     parser.add_argument('--cache-requests', action='store_true',
                         help='Use cache for requests (.drupal_dump.sqlite)')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='Number of concurrent requests to Drupal')
+    parser.add_argument('--rate', type=float,
+                        help='Maximum items (users, nodes etc) to fetch from Drupal '
+                             'per second')
+    parser.add_argument('--resume', action='store_true',
+                        help='Carry on from where an interrupted users, '
+                             'forum, library or dataset_comments dump got '
+                             'to, using its .checkpoint file')
 
     subparsers = parser.add_subparsers()
 
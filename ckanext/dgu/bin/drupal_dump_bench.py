@@ -0,0 +1,81 @@
+'''
+Benchmarks the concurrent fetching in drupal_dump.py (lib/fetch_pool.py)
+against a mock Drupal server (testtools/mock_drupal2.py), fetching each forum
+topic's node and comments as "drupal_dump.py forum" does, for a range of
+worker counts.
+
+Usage:
+ $ python drupal_dump_bench.py [-n 500] [-w 1,4,8,16] [-l 0.05] [-r 0]
+
+-l sets the time the mock server takes to respond, to simulate the round
+trip to a remote Drupal, which is the waiting that the workers overlap.
+'''
+import os
+import sys
+import shutil
+import tempfile
+from optparse import OptionParser
+
+from ckanext.dgu.drupalclient import DrupalClient, DrupalRequestError
+from ckanext.dgu.testtools.mock_drupal2 import MockDrupal2Server
+from ckanext.dgu.lib.fetch_pool import FetchPool
+from concurrent_fetch import JsonlExport
+
+
+def run(domain, nids, workers, rate, output_fpath):
+    '''Dumps the topics. Returns the requests per second.'''
+    drupal = DrupalClient({'xmlrpc_domain': domain, 'pool_size': workers})
+
+    def get_topic(nid):
+        return drupal.get_node(nid), drupal.get_comments(nid)
+    pool = FetchPool(workers=workers, rate=rate,
+                     errors=(DrupalRequestError,))
+    with JsonlExport(output_fpath) as export:
+        for nid, result, e in pool.imap(get_topic, nids):
+            if e:
+                print 'Error: %s' % e
+                continue
+            export.mark_done(nid)
+            topic, comments = result
+            topic['comments'] = comments
+            export.write(topic)
+    # two requests per topic
+    return pool.rate() * 2
+
+
+def bench(num_topics, worker_counts, latency, rate, port):
+    server = MockDrupal2Server(port=port, latency=latency)
+    server.start()
+    domain = 'localhost:%s' % port
+    nids = [str(nid) for nid in range(1, num_topics + 1)]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for workers in worker_counts:
+            output_fpath = os.path.join(tmp_dir, 'forum_%s.jsonl.gz' % workers)
+            print '%s workers: %.1f requests/s' % (
+                workers, run(domain, nids, workers, rate, output_fpath))
+    finally:
+        server.stop()
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    usage = __doc__
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--topics', dest='topics', type='int',
+                      default=500, help='Number of forum topics to dump')
+    parser.add_option('-w', '--workers', dest='workers', default='1,4,8,16',
+                      help='Comma-separated numbers of workers to try')
+    parser.add_option('-l', '--latency', dest='latency', type='float',
+                      default=0.05, help='Seconds the mock server takes per call')
+    parser.add_option('-r', '--rate', dest='rate', type='float', default=0,
+                      help='Maximum topics per second (0 for no limit)')
+    parser.add_option('-p', '--port', dest='port', type='int',
+                      default=8052, help='Port for the mock server')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('Wrong number of arguments')
+    worker_counts = [int(workers) for workers in options.workers.split(',')]
+    bench(options.topics, worker_counts, options.latency, options.rate,
+          options.port)
+    sys.exit(0)
@@ -4,12 +4,15 @@ Analyses the data.gov.uk JSON dataset dumps.
 Gets run by gov_daily.py or from the command-line:
   $ dump_analysis
 (in an activated pyenv with ckanext-dgu installed)
+
+Historic dumps can be re-analysed in parallel with --processes.
 '''
 import zipfile
 import gzip
 import json
 from collections import defaultdict
 import datetime
+import multiprocessing
 import os
 import logging
 import re
@@ -60,6 +63,9 @@ class DumpAnalysisOptions(dict):
         self.update(**initial_options)
         
     def __getattr__(self, key):
+        if key.startswith('__'):
+            # e.g. pickle looks for __getstate__, so it must not get None
+            raise AttributeError(key)
         if self.has_key(key):
             return self[key]
         else:
@@ -224,10 +230,125 @@ class TxtAnalysisFile(AnalysisFile):
             fileobj.close()
         
 
+def iter_json_array(fileobj, chunk_size=64 * 1024):
+    '''Yields the items of the JSON array in the file one by one, so that
+    only one item needs to be in memory at a time.'''
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+
+    while True:
+        # Skip whitespace and the array's punctuation
+        while pos < len(buf) and (buf[pos].isspace() or
+                                  buf[pos] in (',' if started else '[')):
+            if buf[pos] == '[':
+                started = True
+            pos += 1
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        if pos < len(buf):
+            if not started:
+                raise ValueError('JSON is not an array')
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # the item continues in the next chunk (unless this is the
+                # end of the file)
+                if eof:
+                    raise
+            else:
+                # (a number at the end of the buffer might continue in the
+                # next chunk)
+                if end < len(buf) or eof:
+                    yield item
+                    pos = end
+                    continue
+        if eof:
+            if not started:
+                raise ValueError('JSON is not an array')
+            raise ValueError('JSON array is not terminated')
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+def is_active(pkg):
+    if pkg.has_key('state'):
+        return pkg['state'] == 'active'
+    else:
+        return pkg['state_id'] == 1
+
+def is_ons_package(pkg):
+    import_source = pkg['extras'].get('import_source')
+    return bool(import_source and import_source.startswith('ONS'))
+
+def source_bin(pkg):
+    import_source = pkg['extras'].get('import_source')
+    if import_source:
+        for prefix in import_source_prefixes:
+            if import_source.startswith(prefix):
+                import_source = import_source_prefixes[prefix]
+                break
+        return import_source
+    if pkg['extras'].get('UKLP') == 'True':
+        return 'UKLP'
+    if (pkg.get('url') or '').startswith('http://www.data4nr.net/resources/'):
+        return import_source_prefixes['DATA4NR']
+    if pkg['extras'].get('co_id'):
+        return import_source_prefixes['COSPREAD']
+    if asbool(pkg['extras'].get('unpublished')):
+        return unpublished
+    return manual_creation
+
+remove_id_regex = re.compile(' \[\d+\]')
+
+def published_by_bin(pkg):
+    if not is_ons_package(pkg):
+        return None
+    published_by = pkg['extras'].get('published_by')
+    if published_by:
+        published_by = remove_id_regex.sub('', published_by)
+    if published_by:
+        return published_by
+    return 'No value'
+
+def theme_bin(pkg):
+    theme = pkg['extras'].get('theme-primary')
+    if (not theme) or (not theme.strip()):
+        return 'No value'
+    # Fix old names for themes so they are consistent
+    if theme in OLD_THEMES:
+        theme = OLD_THEMES[theme]
+    if theme not in THEMES:
+        theme = 'Other: %s' % theme
+    return theme
+
+def unpublished_bin(pkg):
+    return asbool(pkg['extras'].get('unpublished'))
+
+# (option, analysis_dict label, function returning the package's bin or None)
+ANALYSERS = (
+    ('analyse_by_source', 'Datasets by source: %s', source_bin),
+    ('analyse_ons_by_published_by',
+     'National Statistics Pub Hub by published_by: %s', published_by_bin),
+    ('analyse_by_theme', 'Datasets by theme: %s', theme_bin),
+    ('analyse_by_unpublished', 'Datasets by unpublished: %s',
+     unpublished_bin),
+    )
+
+
 class DumpAnalysis(object):
     '''
     Reads a JSON dump file and runs analysis according to the options, and
     saves it in self.analysis_dict
+
+    The dump is streamed and all the analyses are done in one pass over it,
+    keeping only the counts (and a few examples) for each bin, so that memory
+    use doesn't grow with the size of the dump.
     '''
     def __init__(self, dump_filepath, options):
         log.info('Analysing %s' % dump_filepath)
@@ -237,30 +358,38 @@ class DumpAnalysis(object):
 
     def run(self):
         self.save_date()
+        analysers = [(label, bin_func)
+                     for option, label, bin_func in ANALYSERS
+                     if getattr(self.options, option)]
+        num_examples = int(self.options.examples or 0)
+        # {label: {bin: count}}
+        counts = dict((label, defaultdict(int)) for label, bin_func in analysers)
+        # {label: {bin: [pkg_name, ...]}}
+        examples = dict((label, defaultdict(list))
+                        for label, bin_func in analysers)
+        num_packages = num_active = 0
+        for pkg in self.iter_packages():
+            num_packages += 1
+            if not is_active(pkg):
+                continue
+            num_active += 1
+            for label, bin_func in analysers:
+                pkg_bin = bin_func(pkg)
+                if pkg_bin is None:
+                    continue
+                counts[label][pkg_bin] += 1
+                if len(examples[label][pkg_bin]) < num_examples:
+                    examples[label][pkg_bin].append(pkg['name'])
+        log.info('Read in packages: %i' % num_packages)
+        log.info('Deleted datasets discarded: %i', num_packages - num_active)
+        log.info('Number of active datsets: %i', num_active)
+
         self.analysis_dict = OrderedDict()
-        packages = self.get_packages()
-        packages = self.filter_out_deleted_packages(packages)
-        self.analysis_dict[total_label] = len(packages)
-
-        if self.options.analyse_by_source:
-            pkg_bins = self.analyse_by_source(packages)
-            for bin, pkgs in pkg_bins.items():
-                self.analysis_dict['Datasets by source: %s' % bin] = len(pkgs)
-        if self.options.analyse_ons_by_published_by:
-            ons_packages = self.filter_by_ons_packages(packages)
-            pkg_bins = self.analyse_by_published_by(ons_packages)
-            for bin, pkgs in pkg_bins.items():
-                self.analysis_dict['National Statistics Pub Hub by published_by: %s' % bin] = len(pkgs)
-        if self.options.analyse_by_theme:
-            pkg_bins = self.analyse_by_theme(packages)
-            for bin, pkgs in pkg_bins.items():
-                self.analysis_dict['Datasets by theme: %s' % bin] = len(pkgs)
-        if self.options.analyse_by_unpublished:
-            pkg_bins = self.analyse_by_unpublished(packages)
-            for bin, pkgs in pkg_bins.items():
-                self.analysis_dict['Datasets by unpublished: %s' % bin] = len(pkgs)
-
-        self.print_analysis(pkg_bins)
+        self.analysis_dict[total_label] = num_active
+        for label, bin_func in analysers:
+            for pkg_bin, count in self.sorted_bins(counts[label]):
+                self.analysis_dict[label % pkg_bin] = count
+        self.print_analysis(analysers, counts, examples)
 
     def save_date(self):
         try:
@@ -271,114 +400,59 @@ class DumpAnalysis(object):
         datestr = format_date(self.date) if self.date else None
         log.info('Date of dumpfile: %r', datestr)
 
-    def get_packages(self):
-        '''Returns the packages listed in the JSON dump file'''
+    def open_dump(self):
         if zipfile.is_zipfile(self.dump_filepath):
-            log.info('Unzipping...')
             zf = zipfile.ZipFile(self.dump_filepath)
             assert len(zf.infolist()) == 1, 'Archive must contain one file: %r' % zf.infolist()
-            f = zf.open(zf.namelist()[0])
-        elif self.dump_filepath.endswith('gz'):            
-            f = gzip.open(self.dump_filepath, 'rb')
+            return zf.open(zf.namelist()[0])
+        elif self.dump_filepath.endswith('gz'):
+            return gzip.open(self.dump_filepath, 'rb')
         else:
-            f = open(self.dump_filepath, 'rb')
-        log.info('Reading file...')
-        json_buf = f.read()
-        log.info('Parsing JSON...')
-        packages = json.loads(json_buf)
-        log.info('Read in packages: %i' % len(packages))
-        return packages
-
-    def filter_out_deleted_packages(self, packages):
-        filtered_pkgs = []
-        for pkg in packages:
-            if pkg.has_key('state'):
-                is_active = pkg['state'] == 'active'
-            else:
-                is_active = pkg['state_id'] == 1
-            if is_active:
-                filtered_pkgs.append(pkg)
-        log.info('Deleted datasets discarded: %i', (len(packages) - len(filtered_pkgs)))
-        log.info('Number of active datsets: %i', (len(filtered_pkgs)))
-        return filtered_pkgs
-
-    def filter_by_ons_packages(self, packages):
-        filtered_pkgs = []
-        ons_prefix = 'ONS'
-        for pkg in packages:
-            import_source = pkg['extras'].get('import_source')
-            if import_source and import_source.startswith(ons_prefix):
-                filtered_pkgs.append(pkg)
-        log.info('Number of Pub Hub packages: %i', (len(filtered_pkgs)))
-        return filtered_pkgs
-
-    def analyse_by_source(self, packages):
-        pkg_bins = defaultdict(list)
-        for pkg in packages:
-            import_source = pkg['extras'].get('import_source')
-            if import_source:
-                for prefix in import_source_prefixes:
-                    if import_source.startswith(prefix):
-                        import_source = import_source_prefixes[prefix]
-                        break
-                pkg_bins[import_source].append(pkg['name'])
-                continue
-            if pkg['extras'].get('UKLP') == 'True':
-                pkg_bins['UKLP'].append(pkg['name'])
-                continue
-            if (pkg.get('url') or '').startswith('http://www.data4nr.net/resources/'):
-                import_source = import_source_prefixes['DATA4NR']
-                pkg_bins[import_source].append(pkg['name'])
-                continue
-            if pkg['extras'].get('co_id'):
-                import_source = import_source_prefixes['COSPREAD']
-                pkg_bins[import_source].append(pkg['name'])
-                continue
-            if asbool(pkg['extras'].get('unpublished')):
-                import_source = unpublished
-                pkg_bins[import_source].append(pkg['name'])
-                continue
-            pkg_bins[manual_creation].append(pkg['name'])
-        return pkg_bins
-
-    def analyse_by_published_by(self, packages):
-        pkg_bins = defaultdict(list)
-        remove_id_regex = re.compile(' \[\d+\]')
-        for pkg in packages:
-            published_by = pkg['extras'].get('published_by')
-            published_by = remove_id_regex.sub('', published_by)
-            if published_by:
-                pkg_bins[published_by].append(pkg['name'])
-                continue
-            pkg_bins['No value'].append(pkg['name'])
-        return pkg_bins
-
-    def analyse_by_theme(self, packages):
-        pkg_bins = defaultdict(list)
-        for pkg in packages:
-            theme = pkg['extras'].get('theme-primary')
-            if (not theme) or (not theme.strip()):
-                pkg_bins['No value'].append(pkg['name'])
-                continue
-            # Fix old names for themes so they are consistent
-            if theme in OLD_THEMES:
-                theme = OLD_THEMES[theme]
-            if theme not in THEMES:
-                theme = 'Other: %s' % theme
-            pkg_bins[theme].append(pkg['name'])
-        return pkg_bins
-
-    def analyse_by_unpublished(self, packages):
-        pkg_bins = defaultdict(list)
-        for pkg in packages:
-            unpublished = pkg['extras'].get('unpublished')
-            pkg_bins[asbool(unpublished)].append(pkg['name'])
-        return pkg_bins
-
-    def print_analysis(self, pkg_bins):
-        log.info('* Analysis by source *')
-        for pkg_bin, pkgs in sorted(pkg_bins.items(), key=lambda (pkg_bin, pkgs): -len(pkgs)):
-            log.info('  %s: %i (e.g. %r)', pkg_bin, len(pkgs), pkgs[:int(self.options.examples)])
+            return open(self.dump_filepath, 'rb')
+
+    def iter_packages(self):
+        '''Yields the packages listed in the JSON dump file'''
+        f = self.open_dump()
+        try:
+            for pkg in iter_json_array(f):
+                yield pkg
+        finally:
+            f.close()
+
+    def sorted_bins(self, bin_counts):
+        return sorted(bin_counts.items(),
+                      key=lambda (pkg_bin, count): (-count, pkg_bin))
+
+    def print_analysis(self, analysers, counts, examples):
+        for label, bin_func in analysers:
+            log.info('* %s *', label % '...')
+            for pkg_bin, count in self.sorted_bins(counts[label]):
+                log.info('  %s: %i (e.g. %r)', pkg_bin, count,
+                         examples[label][pkg_bin])
+
+
+def analyse_dump(args):
+    '''Runs the analysis of one dump. Used by the worker processes.'''
+    input_filepath, options = args
+    analysis = DumpAnalysis(input_filepath, options)
+    return analysis.date, analysis.analysis_dict
+
+
+def analyse_dumps(input_filepaths, options, processes=1):
+    '''Runs the analysis of each dump, in that many processes.
+
+    Returns a list of (date, analysis_dict) in the order of input_filepaths.
+    '''
+    tasks = [(input_filepath, options) for input_filepath in input_filepaths]
+    if processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            return pool.map(analyse_dump, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    return [analyse_dump(task) for task in tasks]
+
 
 class Command(command.Command):
     usage = 'usage: %prog [options] dumpfile.json.zip'
@@ -404,6 +478,10 @@ class Command(command.Command):
                                action="store_true")
         self.parser.add_option('--analyse-by-unpublished', dest='analyse_by_unpublished',
                                action="store_true")
+        self.parser.add_option('--processes', dest='processes',
+                               type='int', default=1,
+                               help='analyse the dumps in NUMBER processes',
+                               metavar='NUMBER')
 
     def parse_args(self):
         super(Command, self).parse_args()
@@ -431,19 +509,22 @@ class Command(command.Command):
             if output_filepath:
                 analysis_files[analysis_file_class] = analysis_file_class(output_filepath, run_info)
 
-        for input_filepath in input_filepaths:
-            # Run analysis
-            analysis = DumpAnalysis(input_filepath, self.options)
+        # Run analysis
+        options = DumpAnalysisOptions(**vars(self.options))
+        results = analyse_dumps(input_filepaths, options,
+                                self.options.processes)
 
+        for input_filepath, (date, analysis_dict) in zip(input_filepaths, results):
             if analysis_files:
-                assert analysis.date, 'The results are requested to be saved to '
+                assert date, 'The results are requested to be saved to '
                 'an analysis file which is sorted by date, but could not find '
                 'a date in the input filename: %s' % input_filepath
 
             for analysis_file_class, analysis_file in analysis_files.items():
-                analysis_file.add_analysis(analysis.date, analysis.analysis_dict)
-                # Save
-                analysis_file.save()
+                analysis_file.add_analysis(date, analysis_dict)
+        # Save
+        for analysis_file in analysis_files.values():
+            analysis_file.save()
         log.info('Finished')
 
 def command():
@@ -0,0 +1,70 @@
+'''
+Benchmarks the resource format normalisation (lib/formats.py) by replaying
+the format of every resource in a data.gov.uk JSON dump through it.
+
+Usage:
+ $ python format_bench.py <CKAN config.ini> <dump.json|.json.zip|.json.gz> [-r 3]
+'''
+import sys
+import time
+import json
+import gzip
+import zipfile
+from optparse import OptionParser
+
+import common
+
+
+def load_raw_formats(dump_filepath):
+    if zipfile.is_zipfile(dump_filepath):
+        zf = zipfile.ZipFile(dump_filepath)
+        f = zf.open(zf.namelist()[0])
+    elif dump_filepath.endswith('gz'):
+        f = gzip.open(dump_filepath, 'rb')
+    else:
+        f = open(dump_filepath, 'rb')
+    try:
+        packages = json.load(f)
+    finally:
+        f.close()
+    raw_formats = []
+    for pkg in packages:
+        for res in pkg.get('resources') or []:
+            raw_formats.append(res.get('format') or '')
+    return raw_formats
+
+
+def bench(config_ini, dump_filepath, repeats):
+    common.load_config(config_ini)
+    from ckanext.dgu.lib.formats import FormatNormaliser
+
+    print 'Reading dump...'
+    raw_formats = load_raw_formats(dump_filepath)
+    print 'Formats: %s (%s distinct)' % (len(raw_formats),
+                                         len(set(raw_formats)))
+
+    normaliser = FormatNormaliser()
+    for i in range(repeats):
+        start = time.time()
+        for raw_format in raw_formats:
+            normaliser.clean_format(raw_format)
+        duration = time.time() - start
+        print 'Run %s: %.3fs %s formats/s (cache hits=%s misses=%s)' % (
+            i + 1, duration,
+            int(len(raw_formats) / duration) if duration else 'inf',
+            normaliser.cache.hits, normaliser.cache.misses)
+        if i == 0:
+            # later runs show the throughput with a warm cache
+            normaliser.cache.hits = normaliser.cache.misses = 0
+
+
+if __name__ == '__main__':
+    usage = __doc__
+    parser = OptionParser(usage=usage)
+    parser.add_option('-r', '--repeats', dest='repeats', type='int',
+                      default=3, help='Number of times to replay the formats')
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error('Wrong number of arguments')
+    bench(args[0], args[1], options.repeats)
+    sys.exit(0)
@@ -185,37 +185,61 @@ def command(config_file):
                             f.close()
                         log.info('Wrote openspending report %s', filepath)
 
+    # Publisher performance traffic lights, shown on the publisher pages
+    if run_task('publisher-performance'):
+        log.info('Calculating publisher performance')
+        from ckanext.dgu.lib.publisher import cached_publisher_performance
+        try:
+            cached_publisher_performance()
+        except Exception, exc_performance:
+            log.exception(exc_performance)
+            log.error('Failed to calculate publisher performance (see '
+                      'exception in previous log message)')
+        report_time_taken(log)
+
     # Create dumps for users
     def create_dump_dir_if_necessary(dump_dir):
         if not os.path.exists(dump_dir):
             log.info('Creating dump dir: %s' % dump_dir)
             os.makedirs(dump_dir)
-    if run_task('dump-csv'):
+    # With a dump cache dir configured, the CSV, unpublished CSV and JSON
+    # dumps are made together, only serializing datasets that have changed
+    # since the last run.
+    dump_cache_dir = config.get('dgu.dump_cache_dir')
+    incremental_dumps = [file_type for task, file_type in (
+        ('dump-csv', 'csv'), ('dump-csv-unpublished', 'unpublished.csv'),
+        ('dump-json', 'json')) if run_task(task)] if dump_cache_dir else []
+    if incremental_dumps:
+        from ckanext.dgu.lib.incremental_dump import IncrementalDump
+        log.info('Creating database dumps incrementally - %s',
+                 ', '.join(incremental_dumps))
+        create_dump_dir_if_necessary(dump_dir)
+        logging.getLogger("MARKDOWN").setLevel(logging.WARN)
+        filepaths = IncrementalDump(os.path.expanduser(dump_cache_dir)).run(
+            dump_dir, start_time.strftime(dump_filebase), incremental_dumps)
+        for filepath in filepaths:
+            log.info('Dumped %s (%dMB)', filepath,
+                     os.path.getsize(filepath) / (1024 * 1024))
+        report_time_taken(log)
+
+    if run_task('dump-csv') and not incremental_dumps:
         log.info('Creating database dumps - CSV')
         create_dump_dir_if_necessary(dump_dir)
         dump_file_base = start_time.strftime(dump_filebase)
 
         logging.getLogger("MARKDOWN").setLevel(logging.WARN)
 
-        # Explicitly dump the packages and resources to their respective CSV
-        # files before zipping them up and moving them into position.
+        # Dump the packages and resources to their respective CSV files,
+        # streamed straight into the zip.
         dump_filepath = os.path.join(dump_dir, dump_file_base + '.csv.zip')
 
         log.info('Creating CSV files: %s' % dump_filepath)
-        dumpobj = dgu_dumper.CSVDumper()
-        dumpobj.dump()
-
-        dataset_file, resource_file = dumpobj.close()
-
-        log.info('Dumped datasets file is %dMb in size' % (
-            os.path.getsize(dataset_file) / (1024 * 1024)))
-        log.info('Dumped resources file is %dMb in size' % (
-            os.path.getsize(resource_file) / (1024 * 1024)))
-
-        dump_file = zipfile.ZipFile(dump_filepath, 'w', zipfile.ZIP_DEFLATED)
-        dump_file.write(dataset_file, "datasets.csv")
-        dump_file.write(resource_file, "resources.csv")
-        dump_file.close()
+        dumpobj = dgu_dumper.CSVDumper(
+            workers=int(config.get('dgu.dump_csv.workers', 1)))
+        num_datasets, num_resources = dumpobj.dump(dump_filepath)
+        log.info('Dumped %s datasets and %s resources. Zip is %dMb in size',
+                 num_datasets, num_resources,
+                 os.path.getsize(dump_filepath) / (1024 * 1024))
 
         link_filepath = os.path.join(
             dump_dir, 'data.gov.uk-ckan-meta-data-latest.csv.zip')
@@ -223,8 +247,6 @@ def command(config_file):
         if os.path.exists(link_filepath):
             os.unlink(link_filepath)
         os.symlink(dump_filepath, link_filepath)
-        os.remove(dataset_file)
-        os.remove(resource_file)
 
     def dump_datasets(file_type, dumper_func, dumper_type, dump_dir,
                       *dumper_args, **dumper_kwargs):
@@ -281,14 +303,14 @@ def command(config_file):
         finally:
             os.remove(tmp_filepath)
 
-    if run_task('dump-csv-unpublished'):
+    if run_task('dump-csv-unpublished') and not incremental_dumps:
         log.info('Creating database dumps - CSV unpublished')
         create_dump_dir_if_necessary(dump_dir)
 
         dump_datasets('unpublished.csv', unpublished_dumper, 1, dump_dir)
         report_time_taken(log)
 
-    if run_task('dump-json'):
+    if run_task('dump-json') and not incremental_dumps:
         log.info('Creating database dumps - JSON')
         create_dump_dir_if_necessary(dump_dir)
 
@@ -475,7 +497,7 @@ class ConfigObject(dict):
         return  # not KeyError
 
 
-TASKS_TO_RUN = ['analytics', 'openspending',
+TASKS_TO_RUN = ['analytics', 'openspending', 'publisher-performance',
                 'dump-csv', 'dump-csv-unpublished', 'dump-json', 'dump-json2',
                 'dump-orgs', 'dump-orgs-private',
                 'dump_analysis', 'backup']
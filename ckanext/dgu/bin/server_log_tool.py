@@ -7,9 +7,9 @@ Inspiration:
  *  https://speakerdeck.com/pyconslides/server-log-analysis-with-pandas-by-taavi-burns
  *  https://www.youtube.com/watch?v=ZOpR3P-jAno
 
-You need Pandas to run this::
+You need Pandas (and PyTables, for HDF5) to run this::
 
-  pip install pandas
+  pip install pandas tables
 
 To play about with it, get setup with IPython notebook as well::
 
@@ -24,11 +24,19 @@ Get hold of a log like this:
 
   rsync -z --progress co@co-prod3.dh.bytemark.co.uk:/var/log/nginx/access.log /vagrant/
 
+Print the standard summaries - serve_time_upstream percentiles by route,
+cache hit ratio and the slowest URLs:
+
+  python /vagrant/src/ckanext-dgu/ckanext/dgu/bin/server_log_tool.py /vagrant/access.log --summary
+
 Parse and save as HDF5:
 
   python /vagrant/src/ckanext-dgu/ckanext/dgu/bin/server_log_tool.py /vagrant/access.log --save /vagrant/access.log.h5
 
-Have a shell to play about with data:
+Saving appends to the HDF5 table, so several days' logs can be added to one
+file, and the summaries can be run on it too.
+
+Have a shell to play about with data (this loads it all into memory):
 
   python /vagrant/src/ckanext-dgu/ckanext/dgu/bin/server_log_tool.py /vagrant/access.log.h5 --shell
 
@@ -37,28 +45,25 @@ Work on it in python like this:
   import pandas as pd
   store = pd.HDFStore('/vagrant/access_today.log.h5')
   df = store['log']
+
+A log is parsed in chunks of the file by a pool of processes. The chunks are
+put in order, converted to DataFrames and summarized or appended to the store
+one at a time, with only a few in flight, so memory use stays the same
+however long the log is.
 '''
 from optparse import OptionParser
+import os
 import re
-import datetime
+import multiprocessing
 
+import numpy as np
 import pandas as pd
 
 class Logs(object):
     df = None
 
-    def load_log(self, filepath):
-        rows = []
-        index = []
-        with open(filepath, 'rb') as f:
-            for line in f:
-                values = parse_line(line)
-                timestamp_index = columns.index('timestamp')
-                timestamp = values.pop(timestamp_index)
-                rows.append(values)
-                index.append(timestamp)
-        columns_without_timestamp = [h for h in columns if h != 'timestamp']
-        self.df = pd.DataFrame(rows, index=index, columns=columns_without_timestamp)
+    def load_log(self, filepath, processes=None):
+        self.df = pd.concat(list(iter_log_chunks(filepath, processes)))
         print 'Loaded log %s' % filepath
 
     def load_h5(self, filepath):
@@ -71,57 +76,294 @@ class Logs(object):
         store['log'] = self.df
         print 'Saved %s' % filepath
 
-nginx_re = re.compile(r'(?P<ip>.+) - (?P<remote_user>.+) \[(?P<timestamp>.+)\] "(?P<url>[^"]*)" (?P<status>.+) (?P<size>.+) "(?P<referer>[^"]*)" "(?P<agent>[^"]*)"')
-nginx_re_timed = re.compile(r'(?P<ip>.+) - (?P<remote_user>.+) \[(?P<timestamp>.+)\]  "(?P<url>[^"]*)" (?P<status>.+) (?P<size>.+) "(?P<referer>[^"]*)" "(?P<agent>[^"]*)" (?P<serve_time>.+) (?P<serve_time_upstream>.+)')
+# One regex for lines with and without the serve times on the end. It also
+# picks out the route - the first part of the path, or the first two for
+# /api and /data (e.g. /dataset, /api/action, /data/search)
+nginx_re = re.compile(r'(?P<ip>.+?) - (?P<remote_user>.+) \[(?P<timestamp>[^\]]+)\]\s+"(?P<url>(?:[A-Z]+ (?P<route>/(?:(?:api|data)/)?[^/?\s"]*))?[^"]*)" (?P<status>\S+) (?P<size>\S+) "(?P<referer>[^"]*)" "(?P<agent>[^"]*)"(?: (?P<serve_time>\S+) (?P<serve_time_upstream>\S+))?\s*$')
 columns = ('ip', 'remote_user', 'timestamp', 'url', 'status', 'size', 'referer', 'agent', 'serve_time', 'serve_time_upstream')
+string_columns = ('ip', 'remote_user', 'url', 'referer', 'agent')
+# strings are truncated to these lengths, since the columns in the HDF5 table
+# have a fixed size
+string_column_sizes = {'ip': 100, 'remote_user': 50, 'url': 1000,
+                       'route': 50, 'referer': 500, 'agent': 500}
+OTHER_ROUTE = '(other)'
+
+def _int(value):
+    return int(value) if value.isdigit() else None
+
+def _float(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
 def parse_line(line):
-    match = re.match(nginx_re_timed, line)
+    '''Returns the values of the line, in the order of `columns`, or None if
+    it doesn't match. Lines without serve times have None for them.'''
+    match = nginx_re.match(line)
     if not match:
-        match = re.match(nginx_re, line)
-        if not match:
-            print 'Could not match line: ', line
-    row = list(match.groups())
-    if len(row) == len(columns) - 2:
-        row += [0, 0]
+        return None
+    row = [match.group(column) for column in columns]
     for key in ('serve_time', 'serve_time_upstream'):
         i = columns.index(key)
-        try:
-            row[i] = float(row[i])
-        except ValueError:
-            row[i] = None
+        row[i] = _float(row[i])
     for key in ('size', 'status'):
         i = columns.index(key)
-        try:
-            row[i] = int(row[i])
-        except ValueError:
-            row[i] = None
-    i = columns.index('timestamp')
-
-    row[i] = datetime.datetime.strptime(row[i][:-6], "%d/%b/%Y:%H:%M:%S")
+        row[i] = _int(row[i])
     return row
 
+def chunk_offsets(filepath, chunk_size):
+    '''Returns (start, end) byte offsets that divide the file into chunks.'''
+    file_size = os.path.getsize(filepath)
+    return [(start, min(start + chunk_size, file_size))
+            for start in xrange(0, file_size, chunk_size)]
+
+def read_chunk_lines(filepath, start, end):
+    '''Yields the lines that start within the byte range [start, end), so
+    that chunks divided at arbitrary offsets have each line exactly once.'''
+    with open(filepath, 'rb') as f:
+        if start:
+            # skip the line that started in the previous chunk (or just the
+            # newline ending it, if this chunk starts on a new line)
+            f.seek(start - 1)
+            position = start - 1 + len(f.readline())
+        else:
+            position = 0
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+def parse_chunk(chunk):
+    '''Parses the lines of a chunk of the log into a DataFrame indexed by
+    timestamp. Run in the pool's worker processes.
+
+    Returns (DataFrame, number of lines that didn't parse).
+    '''
+    filepath, start, end = chunk
+    values = dict((column, []) for column in columns + ('route',))
+    unparsed = 0
+    for line in read_chunk_lines(filepath, start, end):
+        match = nginx_re.match(line)
+        if not match:
+            unparsed += 1
+            continue
+        for column in string_columns:
+            values[column].append(match.group(column)
+                                  [:string_column_sizes[column]])
+        values['route'].append(match.group('route') or OTHER_ROUTE)
+        values['timestamp'].append(match.group('timestamp')[:-6])
+        for column in ('status', 'size'):
+            values[column].append(_int(match.group(column)))
+        for column in ('serve_time', 'serve_time_upstream'):
+            values[column].append(_float(match.group(column)))
+    # convert the timestamps all at once, not with strptime line by line
+    index = pd.to_datetime(pd.Series(values.pop('timestamp')),
+                           format='%d/%b/%Y:%H:%M:%S')
+    df = pd.DataFrame(dict(
+        (column, np.array(column_values, dtype=float))
+        if column in ('status', 'size', 'serve_time', 'serve_time_upstream')
+        else (column, column_values)
+        for column, column_values in values.iteritems()))
+    df.index = pd.DatetimeIndex(index, name='timestamp')
+    return df[[column for column in columns if column != 'timestamp'] +
+              ['route']], unparsed
+
+def iter_log_chunks(filepath, processes=None, chunk_size=32 * 1024 * 1024,
+                    stats=None):
+    '''Yields a DataFrame for each chunk of the log, in order. The chunks are
+    parsed in a pool of processes, with no more than two per process parsed
+    ahead of the one being yielded.
+
+    stats - optional dict, in which 'unparsed' is incremented by the number
+            of lines that couldn't be parsed
+    '''
+    chunks = [(filepath, start, end)
+              for start, end in chunk_offsets(filepath, chunk_size)]
+    pool = multiprocessing.Pool(processes)
+    window = (processes or multiprocessing.cpu_count()) * 2
+    pending = []
+    try:
+        for chunk in chunks:
+            pending.append(pool.apply_async(parse_chunk, (chunk,)))
+            if len(pending) >= window:
+                df, unparsed = pending.pop(0).get()
+                if stats is not None:
+                    stats['unparsed'] = stats.get('unparsed', 0) + unparsed
+                yield df
+        while pending:
+            df, unparsed = pending.pop(0).get()
+            if stats is not None:
+                stats['unparsed'] = stats.get('unparsed', 0) + unparsed
+            yield df
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def iter_h5_chunks(filepath, chunksize=500000):
+    '''Yields DataFrames of a log saved with --save.'''
+    store = pd.HDFStore(filepath)
+    try:
+        for df in store.select('log', chunksize=chunksize):
+            yield df
+    finally:
+        store.close()
+
+def append_to_store(chunks, filepath):
+    '''Appends the chunks' DataFrames to the "log" table in an HDF5 file.'''
+    store = pd.HDFStore(filepath, complib='blosc')
+    try:
+        rows = 0
+        for df in chunks:
+            store.append('log', df, format='table',
+                         data_columns=['route', 'status'],
+                         min_itemsize=string_column_sizes)
+            rows += len(df)
+    finally:
+        store.close()
+    print 'Saved %s rows to %s' % (rows, filepath)
+
+
+# Serve times are counted into these bins (in seconds) to get percentiles
+# without keeping every time. Each bin is about 2% wider than the last, from
+# 1ms to 1000s.
+SERVE_TIME_BINS = np.concatenate([[0.0], np.logspace(-3, 3, 601)])
+
+class LogSummary(object):
+    '''Accumulates the summary stats of a log, one DataFrame at a time.
+
+    A request was served from the cache if it has serve times, but no
+    serve_time_upstream (nginx logs "-" when it didn't pass the request on).
+    '''
+    def __init__(self, top=20):
+        self.top = top
+        self.requests = 0
+        self.timed_requests = 0
+        self.cache_hits = 0
+        self.histograms = {}  # route: counts in SERVE_TIME_BINS
+        self.slowest = None  # DataFrame of the top slowest requests
+
+    def add(self, df):
+        self.requests += len(df)
+        timed = df['serve_time'].notnull()
+        upstream = df['serve_time_upstream'].notnull()
+        self.timed_requests += int(timed.sum())
+        self.cache_hits += int((timed & ~upstream).sum())
+
+        df = df[upstream]
+        for route, times in df.groupby('route')['serve_time_upstream']:
+            counts = np.histogram(
+                np.clip(times.values, 0, SERVE_TIME_BINS[-1]),
+                bins=SERVE_TIME_BINS)[0]
+            if route in self.histograms:
+                self.histograms[route] += counts
+            else:
+                self.histograms[route] = counts
+
+        candidates = df[['url', 'serve_time_upstream']]
+        if self.slowest is not None:
+            candidates = pd.concat([self.slowest, candidates])
+        slowest_first = np.argsort(
+            candidates['serve_time_upstream'].values)[::-1]
+        self.slowest = candidates.iloc[slowest_first[:self.top]]
+
+    @staticmethod
+    def percentile(counts, fraction):
+        '''Returns the upper edge of the bin the percentile falls in.'''
+        cumulative = np.cumsum(counts)
+        i = np.searchsorted(cumulative, fraction * cumulative[-1])
+        return SERVE_TIME_BINS[i + 1]
+
+    def route_percentiles(self):
+        '''Returns [(route, requests, p50, p95, p99), ...] busiest first.'''
+        rows = []
+        for route, counts in self.histograms.items():
+            rows.append((route, int(counts.sum())) +
+                        tuple(self.percentile(counts, fraction)
+                              for fraction in (0.5, 0.95, 0.99)))
+        return sorted(rows, key=lambda row: -row[1])
+
+    def cache_hit_ratio(self):
+        if not self.timed_requests:
+            return None
+        return float(self.cache_hits) / self.timed_requests
+
+    def report(self):
+        lines = ['Requests: %s' % self.requests]
+        ratio = self.cache_hit_ratio()
+        lines.append('Cache hit ratio: %s' % (
+            '%.1f%%' % (ratio * 100) if ratio is not None
+            else 'unknown (no serve times in the log)'))
+        lines.append('')
+        lines.append('serve_time_upstream (s) by route:')
+        lines.append('%-30s %10s %8s %8s %8s' % ('Route', 'Requests', 'p50',
+                                                'p95', 'p99'))
+        for route, requests, p50, p95, p99 in self.route_percentiles():
+            lines.append('%-30s %10d %8.3f %8.3f %8.3f' % (
+                route[:30], requests, p50, p95, p99))
+        lines.append('')
+        lines.append('Slowest URLs:')
+        if self.slowest is not None:
+            for timestamp, row in self.slowest.iterrows():
+                lines.append('%8.3f %s %s' % (row['serve_time_upstream'],
+                                              timestamp, row['url']))
+        return '\n'.join(lines)
+
+
 if __name__ == '__main__':
     # NB I am not sure, what this tool is for, so the command-line
     # syntax is a bit weird right now.
     usage = "usage: %prog [options] <filepath.log/.h5>"
     parser = OptionParser(usage=usage)
     parser.add_option("-s", "--save", dest="save",
-                            help="Save data as HDF5")
+                            help="Save data as HDF5 (appending to the file)")
+    parser.add_option("--summary", dest="summary",
+            action="store_true", default=False,
+            help="Print percentiles by route, cache hit ratio and slowest URLs")
+    parser.add_option("--top", dest="top", type="int", default=20,
+                      help="Number of slowest URLs to show")
+    parser.add_option("-p", "--processes", dest="processes", type="int",
+                      help="Number of processes to parse with (default: number of CPUs)")
+    parser.add_option("--chunk-size", dest="chunk_size", type="int",
+                      default=32, help="MB of the log parsed at a time")
     parser.add_option("--shell", dest="shell",
             action="store_true", default=False)
     (options, args) = parser.parse_args()
     filepath = args[0]
 
-    logs = Logs()
-    if filepath.endswith('.log'):
-        logs.load_log(filepath)
-    elif filepath.endswith('.h5'):
-        logs.load_h5(filepath)
+    stats = {}
+    if filepath.endswith('.h5'):
+        chunks = iter_h5_chunks(filepath)
+    elif filepath.endswith('.log'):
+        chunks = iter_log_chunks(filepath, options.processes,
+                                 options.chunk_size * 1024 * 1024, stats)
     else:
         raise NotImplemented
 
-    if options.save:
-        logs.save(options.save)
+    if options.summary or options.save:
+        summary = LogSummary(top=options.top)
+        def summarize(chunks):
+            for df in chunks:
+                summary.add(df)
+                yield df
+        if options.summary:
+            chunks = summarize(chunks)
+        if options.save:
+            append_to_store(chunks, options.save)
+        else:
+            for df in chunks:
+                pass
+        if stats.get('unparsed'):
+            print 'Could not parse %s lines' % stats['unparsed']
+        if options.summary:
+            print summary.report()
     if options.shell:
+        logs = Logs()
+        if filepath.endswith('.log'):
+            logs.load_log(filepath, options.processes)
+        else:
+            logs.load_h5(filepath)
         import pdb; pdb.set_trace()
-
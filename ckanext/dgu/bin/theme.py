@@ -74,7 +74,7 @@ def get_freq_dist(package_options, level):
 
 
 def categorize(options, test=False):
-    from ckanext.dgu.lib.theme import categorize_package2, PRIMARY_THEME
+    from ckanext.dgu.lib.theme import categorize_packages, PRIMARY_THEME
 
     stats = StatsList()
     stats.report_value_limit = 1000
@@ -95,11 +95,10 @@ def categorize(options, test=False):
 
     themes_to_write = {}  # pkg_name:themes
 
-    for pkg in packages:
-        print 'Dataset: %s' % pkg.name
-        themes = categorize_package2(pkg, stats)
-        if options.write and not pkg.extras.get(PRIMARY_THEME) and themes:
-            themes_to_write[pkg.name] = themes
+    for pkg, themes in categorize_packages(packages, options.processes, stats):
+        print 'Dataset: %s' % pkg['name']
+        if options.write and not pkg['extras'].get(PRIMARY_THEME) and themes:
+            themes_to_write[pkg['name']] = themes
 
     print 'Categorize summary:'
     print stats.report()
@@ -122,7 +121,7 @@ def write_themes(themes_to_write):
     model.repo.commit_and_remove()
 
 def recategorize(options):
-    from ckanext.dgu.lib.theme import (categorize_package2, PRIMARY_THEME,
+    from ckanext.dgu.lib.theme import (categorize_packages, PRIMARY_THEME,
             SECONDARY_THEMES, Themes)
 
     stats = StatsList()
@@ -149,11 +148,10 @@ def recategorize(options):
 
     themes_to_write = {}  # pkg_name:themes
 
-    for pkg in packages:
-        print 'Dataset: %s' % pkg.name
-        themes = categorize_package2(pkg)
-        existing_theme = pkg.extras.get(PRIMARY_THEME)
-        pkg_identity = '%s (%s)' % (pkg.name, existing_theme)
+    for pkg, themes in categorize_packages(packages, options.processes):
+        print 'Dataset: %s' % pkg['name']
+        existing_theme = pkg['extras'].get(PRIMARY_THEME)
+        pkg_identity = '%s (%s)' % (pkg['name'], existing_theme)
         if not themes:
             print stats.add('Cannot decide theme', pkg_identity)
             continue
@@ -165,7 +163,7 @@ def recategorize(options):
             continue
         print stats.add('Recategorized to %s' % themes[0]['name'], pkg_identity)
         if options.write:
-            themes_to_write[pkg.name] = themes
+            themes_to_write[pkg['name']] = themes
 
     print 'Recategorize summary:'
     print stats.report()
@@ -247,6 +245,9 @@ Commands:
                       action="store_true", dest="write",
                       help="write the theme to the datasets")
     parser.add_option('--limit', dest='limit')
+    parser.add_option('--processes', dest='processes', type='int',
+                      help='Number of processes to categorize with '
+                           '(default: number of CPUs)')
     (options, args) = parser.parse_args()
     if len(args) != 2:
         parser.error('Wrong number of arguments (%i)' % len(args))
@@ -7,15 +7,34 @@ import re
 
 from collections import defaultdict, OrderedDict
 
-class Transaction(object):    
+class Prop(tuple):
+    '''A transaction property - a tuple is much smaller than a dict, which
+    matters with a day's worth of transactions.'''
+    __slots__ = ()
+    type = property(lambda self: self[0])
+    msg = property(lambda self: self[1])
+    key = property(lambda self: self[2])
+    value = property(lambda self: self[3])
+
+    def __getitem__(self, name):
+        if isinstance(name, basestring):
+            return getattr(self, name)
+        return tuple.__getitem__(self, name)
+
+    def get(self, name):
+        return getattr(self, name)
+
+class Transaction(object):
+    __slots__ = ('_props', 'line', 'id')
+
     def __init__(self):
         self._props = []
 
     def add_row_dict(self, row_dict):
-        self._props.append({'type': row_dict['type'],
-                            'msg': row_dict['msg'],
-                            'key': row_dict.get('key'),
-                            'value': row_dict.get('value')})
+        self._props.append(Prop((row_dict['type'],
+                                 row_dict['msg'],
+                                 row_dict.get('key'),
+                                 row_dict.get('value'))))
 
     @property
     def url(self):
@@ -109,24 +128,18 @@ class Transaction(object):
 
         return ', '.join(reasons) or '(no reason)'
 
-def analyse(vlog_filepath, cmd, args):
-    # Parse log and populate transactions dict (of open transactions)
+def iter_transactions(vlog_filepath):
+    '''Parses the log, yielding each transaction as it ends, so only the open
+    transactions are held in memory.'''
     open_transactions_dict = {} # transation_id: transaction_dict
-    transactions = []
     with open(vlog_filepath, 'r') as f:
         line_count = 0
-        while True:
-            row = f.readline()
-            if row == '':
-                # end of file
-                break
-            line_count +=1 
+        for row in f:
+            line_count +=1
             row_dict = parse_row(row)
-            id = row_dict['transaction_id']                
+            id = row_dict['transaction_id']
             if row_dict['type'] == 'ReqEnd' and id in open_transactions_dict:
-                transaction = open_transactions_dict[id]
-                transactions.append(transaction)
-                del open_transactions_dict[id]
+                yield open_transactions_dict.pop(id)
             if row_dict['type'] == 'ReqStart':
                 open_transactions_dict[id] = Transaction()
                 open_transactions_dict[id].line = line_count
@@ -134,6 +147,9 @@ def analyse(vlog_filepath, cmd, args):
             if id in open_transactions_dict:
                 open_transactions_dict[id].add_row_dict(row_dict)
 
+def analyse(vlog_filepath, cmd, args):
+    transactions = iter_transactions(vlog_filepath)
+
     if cmd == 'list':
         print 'List of transactions\n'
         for transaction in transactions:
@@ -173,13 +189,13 @@ def analyse(vlog_filepath, cmd, args):
 
     elif cmd == 'summary':
         print 'Summary\n'
-        print 'Requests:', len(transactions)
         hits = misses = 0
         for t in transactions:
             if t.was_hit:
                 hits += 1
             else:
                 misses += 1
+        print 'Requests:', hits + misses
         print 'Hits:', float(hits)/(hits+misses)*100, '%'
 
 def parse_row(row_str):
@@ -0,0 +1,96 @@
+'''
+Benchmarks the WMS capabilities checks of gemini_postprocess.py, comparing
+inspect_capabilities, which stops reading once it has what the checks need,
+with parsing the whole response into a tree as the checks used to.
+
+It uses the sample responses in ckanext/dgu/tests/wms_samples, plus a large
+service made by repeating the layer of the WMS 1.3 sample, like the INSPIRE
+services with thousands of layers.
+
+Usage:
+ $ python wms_capabilities_bench.py [-s 10000000] [-r 5]
+'''
+import os
+import re
+import sys
+import time
+import resource
+from StringIO import StringIO
+from optparse import OptionParser
+
+from lxml import etree
+
+import ckanext.dgu
+from ckanext.dgu.gemini_postprocess import (
+    inspect_capabilities,
+    MAX_BYTES_READ_DURING_WMS_CHECK,
+    )
+
+SAMPLES_DIR = os.path.join(os.path.dirname(ckanext.dgu.__file__),
+                           'tests', 'wms_samples')
+
+
+def large_capabilities(size):
+    '''Returns the WMS 1.3 sample with its layer repeated to make it about
+    size bytes.'''
+    with open(os.path.join(SAMPLES_DIR, 'wms_1_3_capabilities.xml')) as f:
+        xml = f.read()
+    layer = re.search(r'      <Layer queryable.*?\n      </Layer>\n', xml,
+                      re.DOTALL).group(0)
+    num_layers = max(1, (size - len(xml)) / len(layer))
+    return xml.replace(layer, layer * num_layers)
+
+
+def full_parse(xml):
+    '''What the checks did before: read everything and build the tree.'''
+    tree = etree.fromstring(StringIO(xml).read(
+        MAX_BYTES_READ_DURING_WMS_CHECK + 1))
+    tree.xpath('//wms:HTTP//wms:OnlineResource/@xlink:href', namespaces={
+        'wms': 'http://www.opengis.net/wms',
+        'xlink': 'http://www.w3.org/1999/xlink'})
+    return len(xml)
+
+
+def inspect(xml):
+    return inspect_capabilities(StringIO(xml)).bytes_read
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def bench(size, repeats):
+    documents = []
+    for filename in sorted(os.listdir(SAMPLES_DIR)):
+        with open(os.path.join(SAMPLES_DIR, filename)) as f:
+            documents.append((filename, f.read()))
+    documents.append(('large service (generated)', large_capabilities(size)))
+
+    for name, xml in documents:
+        print '%s: %s bytes' % (name, len(xml))
+        # inspect first, as the peak memory only goes up
+        for method_name, method in (('inspect_capabilities', inspect),
+                                    ('full parse', full_parse)):
+            rss_before = max_rss_mb()
+            start = time.time()
+            for i in range(repeats):
+                bytes_read = method(xml)
+            duration = (time.time() - start) / repeats
+            print '  %s: %.2fms, read %s bytes, peak memory +%.1fMB' % (
+                method_name, duration * 1000, bytes_read,
+                max_rss_mb() - rss_before)
+
+
+if __name__ == '__main__':
+    usage = __doc__
+    parser = OptionParser(usage=usage)
+    parser.add_option('-s', '--size', dest='size', type='int',
+                      default=MAX_BYTES_READ_DURING_WMS_CHECK,
+                      help='Size in bytes of the generated large service')
+    parser.add_option('-r', '--repeats', dest='repeats', type='int',
+                      default=5, help='Number of times to check each response')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('Wrong number of arguments')
+    bench(options.size, options.repeats)
+    sys.exit(0)
@@ -4,6 +4,8 @@ import logging
 import urlparse
 import ckanext.dgu.lib.ingest as ingest
 
+from sqlalchemy import or_
+
 from ckan.lib.cli import CkanCommand
 
 
@@ -35,6 +37,9 @@ class Ingester(CkanCommand):
 
     def __init__(self, name):
         super(Ingester, self).__init__(name)
+        self.parser.add_option('-b', '--batch-size', dest='batch_size',
+                               type='int', default=500,
+                               help='Number of rows to write to the database at a time')
 
     def command(self):
         self._load_config()
@@ -101,73 +106,97 @@ class Ingester(CkanCommand):
 
             return True, ""
 
-        def process_row(row):
+        def process_rows(rows):
             """
-            Reads each row and tries to create a new commitment database entry after
-            trying to determine if a matching one already exists.
+            Reads a batch of rows and tries to create a new commitment database
+            entry for each, after trying to determine if a matching one already
+            exists. The publishers, datasets and existing commitments are
+            looked up for the whole batch, and it is committed together.
             """
             import ckan.model as model
             from ckanext.dgu.model.commitment import Commitment
             from ckanext.dgu.model.commitment import ODS_ORGS, ODS_LINKS
 
-            short_org = row[0].strip()
-            org_name = ODS_ORGS.get(short_org, None)
-            if not org_name:
-                raise ingest.IngestException("Failed to lookup group {0}".format(short_org), True)
-            org = model.Group.get(org_name)
-            if not org:
-                raise ingest.IngestException("Failed to find group {0}".format(org_name), True)
+            org_names = set(ODS_ORGS[row[0].strip()] for row in rows
+                            if row[0].strip() in ODS_ORGS)
+            orgs = dict((org.name, org) for org in
+                        model.Session.query(model.Group)
+                        .filter(model.Group.name.in_(org_names))) \
+                if org_names else {}
 
-            dataset = None
             # Handle multiple values in the URL field
-            parts = row[6].strip().split()
-            if parts:
-                dataset_name = self._url_to_dataset_name(parts[0])
-                dataset = model.Session.query(model.Package)\
-                    .filter(model.Package.name==dataset_name)\
-                    .filter(model.Package.state=='active').first()
-            if not dataset:
-                if parts and parts[0].startswith('http'):
-                    dataset = parts[0]
+            urls = [row[6].strip().split()[:1] for row in rows]
+            dataset_names = set(self._url_to_dataset_name(url[0])
+                                for url in urls if url)
+            datasets = dict((pkg.name, pkg) for pkg in
+                            model.Session.query(model.Package)
+                            .filter(model.Package.name.in_(dataset_names))
+                            .filter(model.Package.state=='active')) \
+                if dataset_names else {}
+
+            # Existing records match based on source, name, text and publisher
+            commitments = {}
+            if orgs:
+                for c in model.Session.query(Commitment)\
+                        .filter(Commitment.publisher.in_(orgs.keys())):
+                    key = (c.source, c.dataset_name, c.commitment_text, c.publisher)
+                    commitments.setdefault(key, c)
+
+            for row, url in zip(rows, urls):
+                try:
+                    short_org = row[0].strip()
+                    org_name = ODS_ORGS.get(short_org, None)
+                    if not org_name:
+                        raise ingest.IngestException("Failed to lookup group {0}".format(short_org), True)
+                    org = orgs.get(org_name)
+                    if not org:
+                        raise ingest.IngestException("Failed to find group {0}".format(org_name), True)
+                except ingest.IngestException, ie:
+                    log.warning('Ingest error, but continuing: %s', ie)
+                    continue
+
+                dataset = None
+                if url:
+                    dataset = datasets.get(self._url_to_dataset_name(url[0]))
+                if not dataset:
+                    if url and url[0].startswith('http'):
+                        dataset = url[0]
+                    else:
+                        dataset = ""
+
+                source     = row[1]
+                name       = row[2]
+                text       = row[3]
+                notes      = row[4] or ''
+                published  = row[5]
+
+                key = (source, name, text, org.name)
+                c = commitments.get(key)
+                if not c:
+                    c = commitments[key] = Commitment()
+                    log.info("Creating new commitment")
                 else:
-                    dataset = ""
-
-            source     = row[1]
-            name       = row[2]
-            text       = row[3]
-            notes      = row[4] or ''
-            published  = row[5]
-
-            # Delete a record that matches based on source and name
-            c = model.Session.query(Commitment)\
-                .filter(Commitment.source==source)\
-                .filter(Commitment.dataset_name==name)\
-                .filter(Commitment.commitment_text==text)\
-                .filter(Commitment.publisher==org.name).first()
-            if not c:
-                c = Commitment()
-                log.info("Creating new commitment")
-            else:
-                log.info("Updating existing commitment")
-
-            c.source = source
-            c.commitment_text = text
-
-            c.notes = notes
-            c.publisher = org.name
-            c.author = ''
-            c.dataset_name = name
-            if dataset and hasattr(dataset, 'name'):
-                c.dataset = dataset.name
-            else:
-                c.dataset = dataset
-            c.state = 'active'
-            model.Session.add(c)
+                    log.info("Updating existing commitment")
+
+                c.source = source
+                c.commitment_text = text
+
+                c.notes = notes
+                c.publisher = org.name
+                c.author = ''
+                c.dataset_name = name
+                if dataset and hasattr(dataset, 'name'):
+                    c.dataset = dataset.name
+                else:
+                    c.dataset = dataset
+                c.state = 'active'
+                model.Session.add(c)
             model.Session.commit()
 
         try:
             ingester = ingest.Ingester(filename)
-            ingester.process(process_row, header_validate, row_validate)
+            ingester.process(process_rows, header_validate, row_validate,
+                             batch_size=self.options.batch_size)
         except ingest.IngestException, ie:
             print ie
             log.exception(ie)
@@ -195,35 +224,50 @@ class Ingester(CkanCommand):
 
             return True, ""
 
-        def process_row(row):
+        def process_rows(rows):
             """
-            Reads each row and after working out which dataset it is, sets the core-dataset
-            extra to be True.
+            Reads a batch of rows and after working out which dataset each is,
+            sets the core-dataset extra to be True. The datasets are looked up
+            for the whole batch, and it is committed together.
             """
             import ckan.model as model
 
-            # Validation will catch this later, but for now we will just log the problem.
-            if row[2].strip() == '':
-                log.warn(u'Dataset url is required - skipping for now')
-                return
-
-            dataset_name = self._url_to_dataset_name(row[2].strip())
-            pkg = model.Package.get(dataset_name)
-            if not pkg:
-                # Complain, but carry on.
-                raise ingest.IngestException("Failed to find package {0}".format(dataset_name), True)
-
-            if pkg.extras.get('core-dataset', False) == 'true':
-                log.info("Skipping {0} as it is already marked as core".format(pkg.name))
-                return
-
-            pkg.extras['core-dataset'] = True
-            model.Session.add(pkg)
+            dataset_names = []
+            for row in rows:
+                # Validation will catch this later, but for now we will just log the problem.
+                if row[2].strip() == '':
+                    log.warn(u'Dataset url is required - skipping for now')
+                    continue
+                dataset_names.append(self._url_to_dataset_name(row[2].strip()))
+
+            # by name or id, like Package.get()
+            pkgs = {}
+            if dataset_names:
+                for pkg in model.Session.query(model.Package)\
+                        .filter(or_(model.Package.name.in_(dataset_names),
+                                    model.Package.id.in_(dataset_names))):
+                    pkgs[pkg.id] = pkgs[pkg.name] = pkg
+
+            for dataset_name in dataset_names:
+                pkg = pkgs.get(dataset_name)
+                if not pkg:
+                    # Complain, but carry on.
+                    log.warning('Ingest error, but continuing: %s',
+                                "Failed to find package {0}".format(dataset_name))
+                    continue
+
+                if pkg.extras.get('core-dataset', False) == 'true':
+                    log.info("Skipping {0} as it is already marked as core".format(pkg.name))
+                    continue
+
+                pkg.extras['core-dataset'] = True
+                model.Session.add(pkg)
             model.Session.commit()
 
         try:
             ingester = ingest.Ingester(filename)
-            ingester.process(process_row, header_validate, row_validate)
+            ingester.process(process_rows, header_validate, row_validate,
+                             batch_size=self.options.batch_size)
         except ingest.IngestException, ie:
             print ie
             log.exception(ie)
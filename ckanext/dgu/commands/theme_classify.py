@@ -0,0 +1,137 @@
+import collections
+import json
+import logging
+import sys
+import os
+import time
+
+from ckan.lib.cli import CkanCommand
+# No other CKAN imports allowed until _load_config is run,
+# or logging is disabled
+
+
+class ClassifyThemes(CkanCommand):
+    """
+    Proposes themes for every dataset, using the theme classifier over all the CPUs.
+    Usage: classify_themes csv <output.csv>   - write the proposals to a CSV file
+       Or: classify_themes table              - write them to the theme_proposal table
+       Or: classify_themes diff               - dry-run: show where they differ from theme-primary
+
+    Datasets' themes are not changed.
+    """
+    summary = __doc__.strip().split('\n')[0]
+    usage = '\n' + __doc__
+    max_args = 2
+    min_args = 1
+
+    csv_headers = ['package_id', 'package_name', 'current_primary_theme',
+                   'primary_theme', 'primary_score', 'secondary_themes',
+                   'secondary_scores', 'reasons']
+
+    def __init__(self, name):
+        super(ClassifyThemes, self).__init__(name)
+        self.parser.add_option('-p', '--processes', dest='processes',
+                               type='int', default=None,
+                               help='Number of processes (default: number of CPUs)')
+        self.parser.add_option('--limit', dest='limit', type='int',
+                               default=None,
+                               help='Only classify this many datasets')
+
+    def command(self):
+        self._load_config()
+        self.log = logging.getLogger('ckanext.dgu.classify_themes')
+        # the classifier logs every match, which would swamp this
+        logging.getLogger('ckanext.dgu.lib.theme').setLevel(logging.INFO)
+
+        cmd = self.args[0]
+        if cmd == 'csv':
+            if len(self.args) != 2:
+                print self.usage
+                sys.exit(1)
+            filename = self.args[1]
+            if os.path.exists(filename):
+                self.log.error('refusing to overwrite file: %s' % filename)
+                sys.exit(1)
+            self._write_csv(filename)
+        elif cmd == 'table':
+            self._write_table()
+        elif cmd == 'diff':
+            self._diff()
+        else:
+            self.log.error("First argument must be 'csv', 'table' or 'diff'. "
+                           "Got: %s" % cmd)
+            sys.exit(1)
+
+    def _proposals(self):
+        '''Yields a proposal dict for each dataset, and logs the rate.'''
+        from ckanext.dgu.lib.theme import (stream_package_dicts,
+                                           categorize_packages, PRIMARY_THEME)
+        start = time.time()
+        count = 0
+        pkgs = stream_package_dicts(limit=self.options.limit)
+        for pkg, theme_scores in categorize_packages(
+                pkgs, processes=self.options.processes, chunksize=200):
+            primary = theme_scores[0] if theme_scores else None
+            secondaries = theme_scores[1:]
+            yield {
+                'package_id': pkg['id'],
+                'package_name': pkg['name'],
+                'current_primary_theme': pkg['extras'].get(PRIMARY_THEME) or None,
+                'primary_theme': primary['name'] if primary else None,
+                'primary_score': primary['score'] if primary else None,
+                'secondary_themes': json.dumps([theme['name'] for theme in secondaries]),
+                'secondary_scores': json.dumps([theme['score'] for theme in secondaries]),
+                'reasons': '; '.join(primary['reasons']) if primary else '',
+                }
+            count += 1
+            if count % 5000 == 0:
+                self.log.info('%d datasets classified...' % count)
+        duration = time.time() - start
+        self.log.info('Classified %d datasets in %.1fs (%.0f/s)', count,
+                      duration, count / duration if duration else 0)
+
+    def _write_csv(self, filename):
+        import unicodecsv
+        self.log.info('Writing to file: %s' % filename)
+        with open(filename, 'w') as f:
+            writer = unicodecsv.DictWriter(f, self.csv_headers)
+            writer.writeheader()
+            for proposal in self._proposals():
+                writer.writerow(proposal)
+
+    def _write_table(self, batch_size=1000):
+        import ckan.model as model
+        from ckanext.dgu.model.theme_proposal import ThemeProposal, init_tables
+        init_tables(model.meta.engine)
+        table = ThemeProposal.__table__
+        # insert them all in the same transaction as clearing out the last
+        # run, so the table is never half-written
+        model.Session.execute(table.delete())
+        batch = []
+        for proposal in self._proposals():
+            batch.append(proposal)
+            if len(batch) >= batch_size:
+                model.Session.execute(table.insert(), batch)
+                batch = []
+        if batch:
+            model.Session.execute(table.insert(), batch)
+        model.Session.commit()
+        self.log.info('Written to table: %s' % table.name)
+
+    def _diff(self):
+        counts = collections.Counter()
+        for proposal in self._proposals():
+            current = proposal['current_primary_theme']
+            proposed = proposal['primary_theme']
+            if not proposed:
+                counts['No theme proposed'] += 1
+            elif current == proposed:
+                counts['Unchanged'] += 1
+            else:
+                counts['New theme' if not current else 'Changed theme'] += 1
+                print '%s: %s -> %s (score %s)' % (
+                    proposal['package_name'], current, proposed,
+                    proposal['primary_score'])
+        print 'Summary:'
+        for outcome, count in sorted(counts.items()):
+            print '  %s: %d' % (outcome, count)
@@ -2,6 +2,8 @@ import datetime
 import logging
 import csv
 import StringIO
+import threading
+import time
 
 from webhelpers.text import truncate
 
@@ -17,6 +19,37 @@ log = logging.getLogger(__name__)
 
 default_limit = 10
 
+# (limit, published_only): (expiry time, pkg_dicts) for latest_datasets
+_latest_datasets_cache = {}
+_latest_datasets_lock = threading.Lock()
+
+def invalidate_latest_datasets():
+    '''Empties the latest_datasets cache. Called when a package is committed.
+    Other processes' caches just expire.'''
+    with _latest_datasets_lock:
+        _latest_datasets_cache.clear()
+
+# The packages changed by any of some revisions, whether to the package
+# itself, its tags, extras, resources or group memberships
+CHANGED_PACKAGE_IDS_SQL = '''
+    SELECT id FROM package_revision
+    WHERE revision_id = ANY(:revision_ids)
+    UNION
+    SELECT package_id FROM package_tag_revision
+    WHERE revision_id = ANY(:revision_ids)
+    UNION
+    SELECT package_id FROM package_extra_revision
+    WHERE revision_id = ANY(:revision_ids)
+    UNION
+    SELECT resource_group.package_id FROM resource_revision
+    JOIN resource_group
+      ON resource_group.id = resource_revision.resource_group_id
+    WHERE resource_revision.revision_id = ANY(:revision_ids)
+    UNION
+    SELECT table_id FROM member_revision
+    WHERE table_name = 'package' AND revision_id = ANY(:revision_ids)
+'''
+
 
 class DguApiController(ApiController):
 
@@ -32,6 +65,10 @@ class DguApiController(ApiController):
         '''Designed for the dgu home page, shows lists the latest datasets
         that got changed (exluding extra, group and tag changes) with lots
         of details about each dataset.
+
+        It is made just from the search index, and the response is cached
+        for dgu.latest_datasets.cache_ttl seconds, or until a package is
+        committed by this process.
         '''
         try:
             limit = int(request.params.get('limit', default_limit))
@@ -40,6 +77,13 @@ class DguApiController(ApiController):
 
         limit = min(100, limit) # max value
 
+        from pylons import config
+        ttl = int(config.get('dgu.latest_datasets.cache_ttl', 60))
+        key = (limit, published_only)
+        cached = _latest_datasets_cache.get(key)
+        if cached and cached[0] > time.time():
+            return self._finish_ok(cached[1])
+
         from ckan.lib.search import SearchError
         fq = 'capacity:"public"'
         if published_only:
@@ -60,27 +104,29 @@ class DguApiController(ApiController):
             query = get_action('package_search')(context,data_dict)
         except SearchError, se:
             log.error('Search error: %s', se)
+            return self._finish_ok([])
 
         pkg_dicts = []
         for pkg_dict in query['results']:
-            pkg = model.Package.get(pkg_dict['id'])
-            publisher = pkg.get_organization()
+            # the indexed dict has the organization and metadata_modified,
+            # so there's no need to go to the database
+            publisher = pkg_dict.get('organization')
             if publisher:
-                pub_title = publisher.title
-                pub_link = '/publisher/%s' % publisher.name
+                pub_title = publisher['title']
+                pub_link = '/publisher/%s' % publisher['name']
             else:
                 pub_title = pub_link = None
-            last_modified = pkg.metadata_modified
-            pkg_dict = OrderedDict((
-                ('name', pkg.name),
-                ('title', pkg.title),
-                ('notes', pkg.notes),
-                ('dataset_link', '/dataset/%s' % pkg.name),
+            pkg_dicts.append(OrderedDict((
+                ('name', pkg_dict['name']),
+                ('title', pkg_dict['title']),
+                ('notes', pkg_dict['notes']),
+                ('dataset_link', '/dataset/%s' % pkg_dict['name']),
                 ('publisher_title', pub_title),
                 ('publisher_link', pub_link),
-                ('metadata_modified', last_modified.isoformat()),
-                ))
-            pkg_dicts.append(pkg_dict)
+                ('metadata_modified', pkg_dict['metadata_modified']),
+                )))
+        with _latest_datasets_lock:
+            _latest_datasets_cache[key] = (time.time() + ttl, pkg_dicts)
         return self._finish_ok(pkg_dicts)
 
     def revisions(self):
@@ -88,21 +134,37 @@ class DguApiController(ApiController):
         Similar to the revision search API, lists all revisions for which
         a dataset or group changed in some way.
 
-        URL Params:
+        URL Params (one of):
           since-revision-id
           since-timestamp (utc)
           in-the-last-x-minutes
+          after-revision-id - for the next page of results, give the
+                              next_after_revision_id of the previous page
+        and optionally:
+          limit - the number of revisions per page (maximum 50, or 1000 for
+                  sysadmins)
+
+        Revisions are returned in order of timestamp, a page at a time. When
+        results_limited is true, get the rest by following
+        next_after_revision_id.
         '''
         # parse options
         rev_id = request.params.get('since-revision-id')
+        after_rev_id = request.params.get('after-revision-id')
         since_timestamp = request.params.get('since-timestamp')
         in_the_last_x_minutes = request.params.get('in-the-last-x-minutes')
         now = datetime.datetime.utcnow()
+        after_rev = None
         if rev_id is not None:
             rev = model.Session.query(model.Revision).get(rev_id)
             if not rev:
                 abort(400, 'Revision ID "%s" does not exist' % rev_id)
             since_timestamp = rev.timestamp
+        elif after_rev_id is not None:
+            after_rev = model.Session.query(model.Revision).get(after_rev_id)
+            if not after_rev:
+                abort(400, 'Revision ID "%s" does not exist' % after_rev_id)
+            since_timestamp = after_rev.timestamp
         elif since_timestamp is not None:
             try:
                 since_timestamp = date_str_to_datetime(since_timestamp)
@@ -117,119 +179,85 @@ class DguApiController(ApiController):
             since_timestamp = now - \
                          datetime.timedelta(minutes=in_the_last_x_minutes)
         else:
-            abort(400, 'Must specify revisions parameter. It must be one from: since-revision-id since-timestamp in-the-last-x-minutes')
+            abort(400, 'Must specify revisions parameter. It must be one from: since-revision-id since-timestamp in-the-last-x-minutes after-revision-id')
 
         # limit is higher if sysadmin
         if is_sysadmin():
             max_limit = 1000
         else:
             max_limit = 50
+        try:
+            limit = min(int(request.params.get('limit', max_limit)), max_limit)
+        except ValueError:
+            abort(400, 'Could not parse limit "%s"' % request.params.get('limit'))
+        if limit < 1:
+            abort(400, 'Limit must be at least 1')
 
-        # Get the revisions in the requested time frame
-        revs = model.Session.query(model.Revision) \
-               .filter(model.Revision.timestamp >= since_timestamp) \
-               .order_by(model.Revision.timestamp.asc()) \
-               .limit(max_limit) \
-               .all()
+        # Get a page of the revisions in the requested time frame. Paging is
+        # by (timestamp, id), so a page never splits or repeats revisions with
+        # the same timestamp. One more than the limit is got, to see if there
+        # are more.
+        if after_rev:
+            condition = '(timestamp, id) > (:timestamp, :id)'
+            params = {'timestamp': after_rev.timestamp, 'id': after_rev.id}
+        else:
+            condition = 'timestamp >= :timestamp'
+            params = {'timestamp': since_timestamp}
+        params['limit'] = limit + 1
+        revs = model.Session.execute(
+            'SELECT id FROM revision WHERE %s '
+            'ORDER BY timestamp, id LIMIT :limit' % condition,
+            params).fetchall()
+        results_limited = len(revs) > limit
+        rev_ids = [rev_id for (rev_id,) in revs[:limit]]
         result = OrderedDict((
-            ('number_of_revisions', len(revs)),
+            ('number_of_revisions', len(rev_ids)),
             ('since_timestamp', since_timestamp.strftime('%Y-%m-%d %H:%M')),
             ('current_timestamp', now.strftime('%Y-%m-%d %H:%M')),
-            ('since_revision_id', revs[0].id if revs else None),
-            ('newest_revision_id', revs[-1].id if revs else None),
-            ('results_limited', len(revs) == max_limit)))
+            ('since_revision_id', rev_ids[0] if rev_ids else None),
+            ('newest_revision_id', rev_ids[-1] if rev_ids else None),
+            ('results_limited', results_limited),
+            ('next_after_revision_id', rev_ids[-1] if results_limited else None),
+            ))
 
-        # See which packages have changed in the time frame
+        # See which packages have changed in those revisions
         changed_package_ids = set()
-        query = model.Session.query(model.PackageRevision) \
-                .join(model.Revision) \
-                .filter(model.Revision.timestamp >= since_timestamp) \
-                .limit(max_limit)
-        if query.count() == max_limit:
-            result['results_limited'] = True
-        changed_package_ids.update([pkg_rev.id for pkg_rev in query.all()])
-
-        if not result['results_limited']:
-            for related_type in (model.PackageTagRevision,
-                                 model.PackageExtraRevision):
-                query = model.Session.query(related_type) \
-                        .join(model.Revision) \
-                        .filter(model.Revision.timestamp >= since_timestamp) \
-                        .limit(max_limit)
-                res = query.all()
-                if len(res) == max_limit:
-                    result['results_limited'] = True
-                changed_package_ids.update([obj_rev.package_id \
-                                            for obj_rev in res])
-
-        if not result['results_limited']:
-            query = model.Session.query(model.ResourceRevision) \
-                    .join(model.Revision) \
-                    .filter(model.Revision.timestamp >= since_timestamp) \
-                    .join(model.ResourceGroup,
-                          model.ResourceRevision.resource_group_id == model.ResourceGroup.id) \
-                    .limit(max_limit)
-            res = query.all()
-            if len(res) == max_limit:
-                result['results_limited'] = True
-            changed_package_ids.update([obj_rev.resource_group.package_id \
-                                        for obj_rev in res])
-
-        if not result['results_limited']:
-            query = model.Session.query(model.MemberRevision) \
-                    .filter_by(table_name='package') \
-                    .join(model.Revision) \
-                    .filter(model.Revision.timestamp >= since_timestamp) \
-                    .limit(max_limit)
-            res = query.all()
-            if len(res) == max_limit:
-                result['results_limited'] = True
-            changed_package_ids.update([obj_rev.table_id for obj_rev in res])
+        if rev_ids:
+            changed_package_ids.update(
+                package_id for (package_id,) in model.Session.execute(
+                    CHANGED_PACKAGE_IDS_SQL, {'revision_ids': rev_ids}))
 
         # due to corrupt old obj revision tables, some package_ids may be blank
         changed_package_ids.discard(None)
 
-        result['datasets'] = [self._mini_pkg_dict(pkg_id) for pkg_id in changed_package_ids]
+        result['datasets'] = self._mini_pkg_dicts(changed_package_ids)
         return self._finish_ok(result)
 
-    def _mini_pkg_dict(self, pkg_id):
-        '''For a package id, return the basic details for the package in a
-        dictionary.
-        Quite expensive - does two database lookups - so be careful with running it
-        lots of times.
+    def _mini_pkg_dicts(self, pkg_ids):
+        '''For some package ids, return the basic details for each package in
+        a dictionary, getting them all with one query.
         '''
-        pkg = model.Session.query(model.Package).get(pkg_id)
-        pub = pkg.get_organization()
-        return OrderedDict((('id', pkg_id),
-                            ('name', pkg.name),
-                            ('title', pkg.title),
-                            ('notes', markdown_extract(pkg.notes)),
-                            ('dataset_link', '/dataset/%s' % pkg.name),
-                            ('publisher_title', pub.title if pub else None),
-                            ('publisher_link', '/publisher/%s' % pub.name if pub else None),
-                            # Metadata modified is a big query, so leave out unless required
-                            # ('metadata_modified', pkg.metadata_modified.isoformat()),
-                            ))
+        if not pkg_ids:
+            return []
+        rows = model.Session.execute(
+            '''SELECT package.id, package.name, package.title, package.notes,
+                      "group".name, "group".title
+               FROM package
+               LEFT OUTER JOIN "group" ON "group".id = package.owner_org
+               WHERE package.id = ANY(:ids)
+               ORDER BY package.name''',
+            {'ids': list(pkg_ids)})
+        return [OrderedDict((('id', pkg_id),
+                             ('name', name),
+                             ('title', title),
+                             ('notes', markdown_extract(notes)),
+                             ('dataset_link', '/dataset/%s' % name),
+                             ('publisher_title', pub_title),
+                             ('publisher_link', '/publisher/%s' % pub_name if pub_name else None),
+                             ))
+                for pkg_id, name, title, notes, pub_name, pub_title in rows]
 
     def dataset_count(self):
-        from ckan.lib.search import SearchError
-        try:
-            # package search
-            context = {'model': model, 'session': model.Session,
-                       'user': 'visitor'}
-            fq = 'capacity:"public" unpublished:false'
-            data_dict = {
-                'q':'',
-                'fq':fq,
-                'facet':'false',
-                'rows':0,
-                'start':0,
-            }
-            query = get_action('package_search')(context,data_dict)
-            count = query['count']
-        except SearchError, se:
-            log.error('Search error: %s', se)
-            count = 0
-
-        return self._finish_ok(count)
+        from ckanext.dgu.lib.home import Counters
+        return self._finish_ok(Counters.get().published_datasets)
 
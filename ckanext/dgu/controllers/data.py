@@ -17,7 +17,7 @@ from ckan.lib.helpers import flash_success, flash_error
 from ckanext.dgu.lib import helpers as dgu_helpers
 from ckan.lib.base import BaseController, model, abort, h, redirect
 from ckanext.dgu.plugins_toolkit import request, c, render, _, NotAuthorized, get_action
-from ckanext.dgu.lib.home import get_themes
+from ckanext.dgu.lib.home import get_themes, Counters
 
 
 log = logging.getLogger(__name__)
@@ -43,21 +43,9 @@ class DataController(BaseController):
     def home(self):
         extra_vars = {}
 
-        # Get the dataset count using search
-        # (shouldn't cache, as it makes it more likely to be out of sync with
-        # the data page)
-        from ckan.lib.search import SearchError, SearchQueryError
-        context = {'model': model, 'session': model.Session,
-                   'user': c.user or c.author, 'for_view': True,
-                   'auth_user_obj': c.userobj}
-        data_dict = {
-                'q': '*:*',
-                'fq': '+dataset_type:dataset',
-                #'facet.field': facets.keys(),
-                'rows': 0,
-            }
-        query = get_action('package_search')(context, data_dict)
-        extra_vars['num_datasets'] = query['count']
+        # Get the dataset count from the shared counters, which are dropped
+        # whenever a dataset is saved, so it stays in step with the data page
+        extra_vars['num_datasets'] = Counters.get().datasets
 
         extra_vars['themes'] = get_themes()
 
@@ -159,8 +159,12 @@ class InventoryController(BaseController):
 
         c.task = root
         c.task.packages = None
+        c.progress = None
 
         for t in tasks:
+            # The rows processed so far, while it is still running
+            if t.key == u'progress' and t.value:
+                c.progress = json.loads(t.value)
             # Looks for a completed version with errors and stuff
             if t.state == 'Complete':
                 c.task = t
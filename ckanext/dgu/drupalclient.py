@@ -1,5 +1,10 @@
 import logging
+import re
 import socket
+import threading
+import time
+import urllib
+import xmlrpclib
 from xmlrpclib import ServerProxy, Fault, ProtocolError
 from xml.parsers.expat import ExpatError
 from httplib import BadStatusLine
@@ -11,6 +16,184 @@ log = logging.getLogger(__name__)
 class DrupalXmlRpcSetupError(Exception): pass
 class DrupalRequestError(Exception): pass
 class DrupalKeyError(Exception): pass
+# A socket.error so that callers handle it like Drupal being unreachable
+class DrupalCircuitOpenError(socket.error): pass
+
+
+class CircuitBreaker(object):
+    '''Fails calls fast when Drupal is down.
+
+    After `threshold` consecutive failed calls the circuit "opens" and calls
+    fail immediately for `reset_seconds`. Then one trial call is let through:
+    if it succeeds the circuit closes again, otherwise it stays open for
+    another reset_seconds.
+    '''
+    def __init__(self, threshold=5, reset_seconds=30):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.time() - self.opened_at < self.reset_seconds or \
+                    self._trial_in_progress:
+                raise DrupalCircuitOpenError(
+                    'Drupal calls suspended after %s consecutive failures'
+                    % self.failures)
+            self._trial_in_progress = True
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                log.info('Drupal is responding again - circuit closed')
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_progress = False
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    log.error('Drupal failed %s times in a row - suspending '
+                              'calls for %ss', self.failures,
+                              self.reset_seconds)
+                self.opened_at = time.time()
+
+
+class DrupalTransport(object):
+    '''HTTP connections to Drupal, shared by the XML-RPC and REST calls.
+
+    The connections are kept alive in a pool. Each call has a timeout and is
+    retried with exponential backoff if it fails to connect, times out or
+    gets a 5xx response. A CircuitBreaker stops calls when Drupal is down.
+    The latency of each method is recorded (see stats()).
+    '''
+    def __init__(self, timeout=10, retries=2, backoff=0.5, pool_size=10,
+                 breaker_threshold=5, breaker_reset_seconds=30):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset_seconds)
+        self._stats = {}  # {method_name: [calls, errors, seconds, max_seconds]}
+        self._stats_lock = threading.Lock()
+
+    def request(self, http_method, url, method_name, **kwargs):
+        '''Makes the request and returns the requests Response.
+
+        Raises socket.error if Drupal could not be reached, so that it is
+        handled like the errors from xmlrpclib.
+        '''
+        self.breaker.before_call()
+        ok = False
+        try:
+            for attempt in xrange(self.retries + 1):
+                if attempt:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+                start = time.time()
+                try:
+                    response = self.session.request(http_method, url,
+                                                    timeout=self.timeout,
+                                                    **kwargs)
+                except requests.RequestException, e:
+                    error = e
+                    response = None
+                else:
+                    error = None
+                ok = response is not None and response.status_code < 500
+                self._record(method_name, time.time() - start, ok)
+                if ok:
+                    return response
+                log.warning('Drupal call %s failed (attempt %s/%s): %s',
+                            method_name, attempt + 1, self.retries + 1,
+                            error or response.status_code)
+        finally:
+            # whatever happened, so that a trial call can't leave the
+            # circuit open for good
+            if ok:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+        if error:
+            raise socket.error('Error calling %s: %r' % (url, error))
+        return response
+
+    def _record(self, method_name, seconds, ok):
+        with self._stats_lock:
+            stats = self._stats.setdefault(method_name, [0, 0, 0.0, 0.0])
+            stats[0] += 1
+            if not ok:
+                stats[1] += 1
+            stats[2] += seconds
+            stats[3] = max(stats[3], seconds)
+
+    def stats(self):
+        '''Returns the latency of each method, as {method_name: {'calls':,
+        'errors':, 'mean_seconds':, 'max_seconds':}}'''
+        with self._stats_lock:
+            return dict(
+                (method_name, {'calls': calls, 'errors': errors,
+                               'mean_seconds': seconds / calls,
+                               'max_seconds': max_seconds})
+                for method_name, (calls, errors, seconds, max_seconds)
+                in self._stats.iteritems())
+
+    _shared = {}  # {(scheme, domain): DrupalTransport}
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def get_shared(cls, scheme, domain, **settings):
+        '''Returns the transport for the Drupal server, creating it the
+        first time, so that all DrupalClients share its connections.'''
+        key = (scheme, domain)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(**settings)
+            return cls._shared[key]
+
+
+class XmlRpcTransport(xmlrpclib.Transport):
+    '''Sends XML-RPC calls through a DrupalTransport, instead of a new
+    connection per call.'''
+    method_name_regex = re.compile(r'<methodName>(.*?)</methodName>')
+
+    def __init__(self, drupal_transport, scheme):
+        xmlrpclib.Transport.__init__(self)
+        self.drupal_transport = drupal_transport
+        self.scheme = scheme
+
+    def request(self, host, handler, request_body, verbose=0):
+        auth, domain = urllib.splituser(host)
+        if auth:
+            username, password = urllib.splitpasswd(auth)
+            requests_auth = (urllib.unquote(username),
+                             urllib.unquote(password or ''))
+        else:
+            requests_auth = None
+        match = self.method_name_regex.search(request_body)
+        method_name = match.group(1) if match else 'xmlrpc'
+        response = self.drupal_transport.request(
+            'POST', '%s://%s%s' % (self.scheme, domain, handler), method_name,
+            data=request_body, auth=requests_auth,
+            headers={'Content-Type': 'text/xml'})
+        if response.status_code != 200:
+            raise ProtocolError(domain + handler, response.status_code,
+                                response.reason, response.headers)
+        parser, unmarshaller = self.getparser()
+        parser.feed(response.content)
+        parser.close()
+        return unmarshaller.close()
 
 class DrupalClient(object):
     def __init__(self, xmlrpc_settings=None):
@@ -23,7 +206,43 @@ class DrupalClient(object):
         '''
         self.xmlrpc_url, self.xmlrpc_url_log_safe, self.rest_url, \
             self.requests_auth = DrupalClient.get_xmlrpc_url(xmlrpc_settings)
-        self.drupal_xmlrpc = ServerProxy(self.xmlrpc_url)
+        scheme, domain = self.rest_url.split('://', 1)
+        domain = domain.split('/', 1)[0]
+        self.transport = DrupalTransport.get_shared(
+            scheme, domain, **DrupalClient.get_transport_settings(xmlrpc_settings))
+        self.drupal_xmlrpc = ServerProxy(
+            self.xmlrpc_url, transport=XmlRpcTransport(self.transport, scheme))
+
+    @staticmethod
+    def get_transport_settings(xmlrpc_settings=None):
+        '''Returns the DrupalTransport settings from xmlrpc_settings (without
+        the 'dgu.drupal.' prefix) or else the pylons config.'''
+        if xmlrpc_settings is None:
+            from pylons import config
+            xmlrpc_settings = dict((key[len('dgu.drupal.'):], value)
+                                   for key, value in config.items()
+                                   if key.startswith('dgu.drupal.'))
+        settings = {}
+        for key, type_, default in (('timeout', float, 10),
+                                    ('retries', int, 2),
+                                    ('backoff', float, 0.5),
+                                    ('pool_size', int, 10),
+                                    ('breaker_threshold', int, 5),
+                                    ('breaker_reset_seconds', float, 30)):
+            settings[key] = type_(xmlrpc_settings.get(key, default))
+        return settings
+
+    def stats(self):
+        '''Returns the latency of each Drupal method called in this
+        process.'''
+        return self.transport.stats()
+
+    def _rest_get(self, url, method_name):
+        try:
+            return self.transport.request('GET', url, method_name,
+                                          auth=self.requests_auth)
+        except socket.error, e:
+            raise DrupalRequestError('Socket error with url \'%s\': %r' % (url, e))
 
     @staticmethod
     def get_xmlrpc_url(xmlrpc_settings=None):
@@ -191,28 +410,14 @@ class DrupalClient(object):
 
     def get_organogram_files(self):
         url = self.rest_url + '/organogram'
-        try:
-            response = requests.get(url, auth=self.requests_auth)
-        except socket.error, e:
-            raise DrupalRequestError('Socket error with url \'%s\': %r' % (url, e))
-        except Fault, e:
-            raise DrupalRequestError('Drupal url %s returned error: %r' % (url, e))
-        except ProtocolError, e:
-            raise DrupalRequestError('Drupal url %s returned protocol error: %r' % (url, e))
+        response = self._rest_get(url, 'rest.organogram')
         organogram_files = response.json()
         log.info('Obtained %s organogram files', len(organogram_files))
         return organogram_files
 
     def get_organogram_file_properties(self, fid):
         url = self.rest_url + '/organogram/%s' % fid
-        try:
-            response = requests.get(url, auth=self.requests_auth)
-        except socket.error, e:
-            raise DrupalRequestError('Socket error with url \'%s\': %r' % (url, e))
-        except Fault, e:
-            raise DrupalRequestError('Drupal url %s returned error: %r' % (url, e))
-        except ProtocolError, e:
-            raise DrupalRequestError('Drupal url %s returned protocol error: %r' % (url, e))
+        response = self._rest_get(url, 'rest.organogram_file')
         organogram = response.json()
         log.info('Obtained organogram file properties %r', organogram)
         return organogram
@@ -220,14 +425,7 @@ class DrupalClient(object):
     def get_dataset_referrers(self):
         '''Includes apps'''
         url = self.rest_url + '/views/dataset_referrers'
-        try:
-            response = requests.get(url, auth=self.requests_auth)
-        except socket.error, e:
-            raise DrupalRequestError('Socket error with url \'%s\': %r' % (url, e))
-        except Fault, e:
-            raise DrupalRequestError('Drupal url %s returned error: %r' % (url, e))
-        except ProtocolError, e:
-            raise DrupalRequestError('Drupal url %s returned protocol error: %r' % (url, e))
+        response = self._rest_get(url, 'rest.dataset_referrers')
         referrers = response.json()
         log.info('Obtained %s referrers/apps e.g. %r',
                  (len(referrers), referrers[0]))
@@ -236,14 +434,7 @@ class DrupalClient(object):
     def get_node(self, nid):
         '''Includes apps'''
         url = self.rest_url + '/node/{nid}'.format(nid=nid)
-        try:
-            response = requests.get(url, auth=self.requests_auth)
-        except socket.error, e:
-            raise DrupalRequestError('Socket error with url \'%s\': %r' % (url, e))
-        except Fault, e:
-            raise DrupalRequestError('Drupal url %s returned error: %r' % (url, e))
-        except ProtocolError, e:
-            raise DrupalRequestError('Drupal url %s returned protocol error: %r' % (url, e))
+        response = self._rest_get(url, 'rest.node')
         node = response.json()
         log.info('Obtained node %r', node)
         return node
@@ -256,14 +447,7 @@ class DrupalClient(object):
         url = self.rest_url + '/node'
         if type_filter:
             url += '?parameters[type]=%s' % type_filter
-        try:
-            response = requests.get(url, auth=self.requests_auth)
-        except socket.error, e:
-            raise DrupalRequestError('Socket error with url \'%s\': %r' % (url, e))
-        except Fault, e:
-            raise DrupalRequestError('Drupal url %s returned error: %r' % (url, e))
-        except ProtocolError, e:
-            raise DrupalRequestError('Drupal url %s returned protocol error: %r' % (url, e))
+        response = self._rest_get(url, 'rest.nodes')
         nodes = response.json()
         log.info('Obtained %s nodes e.g. %r', len(nodes),
                  nodes[0] if nodes else None)
@@ -286,14 +470,7 @@ class DrupalClient(object):
 
         url = self.rest_url + '/views/replies' \
             '?entity_type=node&entity_id={nid}'.format(nid=node_id)
-        try:
-            response = requests.get(url, auth=self.requests_auth)
-        except socket.error, e:
-            raise DrupalRequestError('Socket error with url \'%s\': %r' % (url, e))
-        except Fault, e:
-            raise DrupalRequestError('Drupal url %s returned error: %r' % (url, e))
-        except ProtocolError, e:
-            raise DrupalRequestError('Drupal url %s returned protocol error: %r' % (url, e))
+        response = self._rest_get(url, 'rest.replies')
         replies = response.json()
         log.info('Obtained %s replies', len(replies))
         # Fix commas appearing in some fields!
@@ -309,14 +486,7 @@ class DrupalClient(object):
         # https://data.gov.uk/services/rest/views/replies?entity_type=ckan_dataset
         url = self.rest_url + '/views/replies' \
             '?entity_type=ckan_dataset&entity_id={id}'.format(id=entity_id)
-        try:
-            response = requests.get(url, auth=self.requests_auth)
-        except socket.error, e:
-            raise DrupalRequestError('Socket error with url \'%s\': %r' % (url, e))
-        except Fault, e:
-            raise DrupalRequestError('Drupal url %s returned error: %r' % (url, e))
-        except ProtocolError, e:
-            raise DrupalRequestError('Drupal url %s returned protocol error: %r' % (url, e))
+        response = self._rest_get(url, 'rest.dataset_replies')
         replies = response.json()
         log.info('Obtained %s dataset replies', len(replies))
         # Fix commas appearing in some fields!
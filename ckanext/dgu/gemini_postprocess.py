@@ -4,12 +4,13 @@ import urllib2
 import socket
 import httplib
 from lxml import etree
-import traceback
 import urlparse
 import urllib
 import json
-
-from owslib import wms as owslib_wms
+import hashlib
+import datetime
+import threading
+from multiprocessing.pool import ThreadPool
 
 from ckan.common import OrderedDict
 import ckan.plugins as p
@@ -18,11 +19,43 @@ log = logging.getLogger(__name__)
 
 MAX_BYTES_READ_DURING_WMS_CHECK = 10000000  # 10 MB
 
+# DataCache key for the results of probe_wms, keyed by capabilities URL
+WMS_PROBE_CACHE_KEY = 'wms-probe'
+# DataCache key for the resource_fingerprints of the package when it was last
+# processed, keyed by package id
+RESOURCE_FINGERPRINTS_CACHE_KEY = 'gemini-postprocess-resources'
+
 
 def hash_a_dict(dict_):
     return json.dumps(dict_, sort_keys=True)
 
 
+def resource_fingerprints(resources):
+    '''Given (resource_id, url) pairs, returns a set of hashes of them, so
+    that added resources and changed URLs show up as hashes not in a
+    previous set.'''
+    return set(hashlib.sha1(('%s %s' % (res_id, url)).encode('utf8'))
+               .hexdigest()
+               for res_id, url in resources)
+
+
+def get_stored_fingerprints(package_id):
+    '''Returns the resource_fingerprints of the package when it was last
+    processed, or None if it has not been.'''
+    from ckanext.report.model import DataCache
+    fingerprints, created = DataCache.get(
+        package_id, RESOURCE_FINGERPRINTS_CACHE_KEY, convert_json=True)
+    if fingerprints is None:
+        return None
+    return set(fingerprints)
+
+
+def store_fingerprints(package_id, fingerprints):
+    from ckanext.dgu.lib.publisher import set_data_cache
+    set_data_cache([(package_id, RESOURCE_FINGERPRINTS_CACHE_KEY,
+                     json.dumps(sorted(fingerprints)))])
+
+
 def process_package_(package_id):
     from ckan import model
 
@@ -34,15 +67,20 @@ def process_package_(package_id):
     package = p.toolkit.get_action('package_show')(
         context_, {'id': package_id})
     package_changed = None
+    resources = package.get('individual_resources', []) + \
+        package.get('timeseries_resources', []) + \
+        package.get('additional_resources', [])
+
+    # probe the resources' services all at once
+    probes = probe_wms_urls([resource['url'] for resource in resources],
+                            **probe_settings())
 
     # process each resource
-    for resource in package.get('individual_resources', []) + \
-            package.get('timeseries_resources', []) + \
-            package.get('additional_resources', []):
+    for resource in resources:
         log.info('Processing package=%s resource=%s',
                  package['name'], resource['id'][:4])
         resource_hash_before = hash_a_dict(resource)
-        process_resource(resource)
+        process_resource(resource, probes[resource['url']])
         # note if it made a change
         if not package_changed:
             resource_changed = hash_a_dict(resource) != resource_hash_before
@@ -51,6 +89,12 @@ def process_package_(package_id):
             if resource_changed:
                 package_changed = True
 
+    # Stored before the package_update, so that when its notify compares
+    # them with the resources it finds no change and doesn't start another
+    # post-process
+    store_fingerprints(package['id'], resource_fingerprints(
+        (resource['id'], resource['url']) for resource in resources))
+
     if package_changed:
         log.info('Writing dataset changes')
         tidy_up_package(package)
@@ -65,23 +109,144 @@ def process_package_(package_id):
         p.toolkit.get_action('package_update')(context, package)
     else:
         log.info('No changes to write')
+        model.Session.commit()
 
 
-def process_resource(resource):
+def process_resource(resource, probe=None):
     '''
     Edits resource in-place.
+
+    probe is the result of probe_wms for the resource's URL, if it has already
+    been done.
     '''
-    url = resource['url']
+    if probe is None:
+        probe = probe_wms(resource['url'])
 
     # Check if the service is a view service
-    is_wms = _is_wms(url)
-    if is_wms:
+    if probe['is_wms']:
         # this no longer sets 'verified' or 'verified_date'
-        base_urls = _wms_base_urls(url)
-        resource['wms_base_urls'] = ' '.join(base_urls)
+        resource['wms_base_urls'] = ' '.join(probe['base_urls'])
         resource['format'] = 'WMS'
 
 
+def probe_settings():
+    '''Returns the probe_wms_urls options from the config.'''
+    from pylons import config
+    return dict(
+        workers=int(config.get('dgu.wms_probe.workers', 8)),
+        per_host=int(config.get('dgu.wms_probe.per_host', 2)),
+        cache_max_age=datetime.timedelta(
+            hours=float(config.get('dgu.wms_probe.cache_hours', 24))),
+        )
+
+
+def probe_key(url):
+    '''Returns the URL that identifies the service that a resource URL
+    points to. Resources with the same probe_key get the same probe_wms
+    result.'''
+    return wms_capabilities_url(strip_session_id(url), version=None)
+
+
+def probe_wms_urls(urls, workers=8, per_host=2, cache_max_age=None):
+    '''Runs probe_wms for the given resource URLs, probing each service
+    once, with up to `workers` probes at a time but no more than `per_host`
+    to any one host.
+
+    With cache_max_age (a timedelta), probes less than that old are taken
+    from the DataCache instead, and new results are stored in it, apart from
+    timeouts, which get tried again next time.
+
+    Returns {url: probe}
+    '''
+    url_by_key = {}  # a resource url for each service
+    for url in urls:
+        url_by_key.setdefault(probe_key(url), url)
+
+    probes = {}  # key: probe
+    if cache_max_age:
+        from ckanext.report.model import DataCache
+        oldest = datetime.datetime.now() - cache_max_age
+        for key in url_by_key:
+            probe, created = DataCache.get(key, WMS_PROBE_CACHE_KEY,
+                                           convert_json=True)
+            if probe and created > oldest:
+                probes[key] = probe
+    keys_to_probe = [key for key in url_by_key if key not in probes]
+    log.info('WMS probes: %s services, %s cached, %s to probe',
+             len(url_by_key), len(probes), len(keys_to_probe))
+
+    # the lock for each host is made here, before the threads need them
+    host_limits = dict(
+        (urlparse.urlparse(key).netloc, threading.BoundedSemaphore(per_host))
+        for key in keys_to_probe)
+
+    def probe_service(key):
+        with host_limits[urlparse.urlparse(key).netloc]:
+            return probe_wms(url_by_key[key])
+
+    if len(keys_to_probe) > 1 and workers > 1:
+        pool = ThreadPool(min(workers, len(keys_to_probe)))
+        try:
+            new_probes = pool.map(probe_service, keys_to_probe)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        new_probes = [probe_service(key) for key in keys_to_probe]
+    probes.update(zip(keys_to_probe, new_probes))
+
+    cache_values = [(key, WMS_PROBE_CACHE_KEY, json.dumps(probe))
+                    for key, probe in zip(keys_to_probe, new_probes)
+                    if probe['is_wms'] is not None]
+    if cache_max_age and cache_values:
+        from ckan import model
+        from ckanext.dgu.lib.publisher import set_data_cache
+        set_data_cache(cache_values)
+        model.Session.commit()
+
+    return dict((url, probes[probe_key(url)]) for url in urls)
+
+
+def probe_wms(url):
+    '''Works out whether the URL is a WMS and, if so, its base URLs, usually
+    from a single GetCapabilities request.
+
+    The request has no version, as for the base URLs (see _wms_base_urls).
+    Only if that gets an HTTP error or a ServiceException are explicit
+    versions tried, as in _is_wms - a response that is some other document
+    (e.g. CSV or HTML) means it is not a WMS.
+
+    Returns a dict: {'is_wms': True/False/None, 'base_urls': [...]}
+    where is_wms None means the host timed out.
+    '''
+    is_wms = False
+    base_urls = set()
+    try_versions = False
+    try:
+        capabilities_url = wms_capabilities_url(url, version=None)
+        capabilities = _get_capabilities(capabilities_url,
+                                         raise_http_error=True)
+        if capabilities is None:
+            return {'is_wms': None, 'base_urls': []}
+        if capabilities:
+            version = '1.1.1' if capabilities.root_tag == WMS_1_1_1_TAG \
+                else '1.3'
+            is_wms = _check_capabilities(url, capabilities, version)
+            if is_wms:
+                base_urls = _base_urls(capabilities)
+            else:
+                try_versions = _is_service_exception(capabilities)
+    except urllib2.HTTPError:
+        try_versions = True
+    except Exception, e:
+        log.exception('WMS probe for %s failed with uncaught exception: %s' % (url, str(e)))
+    if try_versions:
+        # the server may need the version param
+        is_wms = _is_wms(url)
+    log.debug('WMS probe result: %s %r', is_wms, base_urls)
+    return {'is_wms': is_wms, 'base_urls': sorted(base_urls)}
+
+
 def _is_wms(url):
     '''Given a WMS URL this method returns whether it thinks it is a WMS
     server or not. It does it by making basic WMS requests.
@@ -135,6 +300,96 @@ def wms_capabilities_url(url, version=None):
     return url.split('?')[0] + '?' + urlqs
 
 
+WMS_NAMESPACE = '{http://www.opengis.net/wms}'
+WMS_1_3_TAG = WMS_NAMESPACE + 'WMS_Capabilities'
+WMS_1_1_1_TAG = 'WMT_MS_Capabilities'
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+
+
+class Capabilities(object):
+    '''The parts of a GetCapabilities response that the WMS checks need, as
+    read by inspect_capabilities.'''
+    def __init__(self):
+        self.root_tag = None
+        self.service_exception = None  # its text, if there is one
+        self.has_layer = False
+        # hrefs of the wms:OnlineResources in wms:HTTP elements
+        self.online_resources = []
+        self.bytes_read = 0
+        self.error = None  # 'empty', 'too large' or an XML syntax error
+
+
+class _CappedReader(object):
+    '''File-like wrapper that ends after max_bytes, noting if there was
+    more.'''
+    def __init__(self, fileobj, max_bytes):
+        self.fileobj = fileobj
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+        self.too_large = False
+        self.blank = True
+
+    def read(self, size=16384):
+        if self.bytes_read > self.max_bytes:
+            self.too_large = True
+            return ''
+        data = self.fileobj.read(min(size, self.max_bytes + 1 -
+                                     self.bytes_read))
+        self.bytes_read += len(data)
+        if self.blank and data.strip():
+            self.blank = False
+        return data
+
+
+def inspect_capabilities(fileobj, max_bytes=MAX_BYTES_READ_DURING_WMS_CHECK):
+    '''Reads a GetCapabilities response from fileobj incrementally, stopping
+    as soon as it has what the WMS checks need: the root element, any
+    ServiceException, and the OnlineResource URLs of the requests, which come
+    before the first Layer. So for a big service with thousands of layers,
+    only the first few KB are read and no tree is kept.
+
+    Returns a Capabilities.
+    '''
+    capabilities = Capabilities()
+    reader = _CappedReader(fileobj, max_bytes)
+    http_depth = 0  # number of wms:HTTP elements we are inside
+    try:
+        for event, elem in etree.iterparse(reader, events=('start', 'end')):
+            local_name = etree.QName(elem.tag).localname
+            if event == 'start':
+                if capabilities.root_tag is None:
+                    capabilities.root_tag = elem.tag
+                    if elem.tag not in (WMS_1_3_TAG, WMS_1_1_1_TAG) and \
+                            local_name != 'ServiceExceptionReport':
+                        break
+                elif local_name == 'Layer':
+                    capabilities.has_layer = True
+                    break
+                elif elem.tag == WMS_NAMESPACE + 'HTTP':
+                    http_depth += 1
+                elif http_depth and \
+                        elem.tag == WMS_NAMESPACE + 'OnlineResource':
+                    href = elem.get(XLINK_HREF)
+                    if href:
+                        capabilities.online_resources.append(href)
+            else:
+                if local_name == 'ServiceException':
+                    capabilities.service_exception = (elem.text or '').strip()
+                    break
+                if elem.tag == WMS_NAMESPACE + 'HTTP':
+                    http_depth -= 1
+                elem.clear()
+    except etree.XMLSyntaxError, e:
+        if reader.too_large:
+            capabilities.error = 'too large'
+        elif reader.blank:
+            capabilities.error = 'empty'
+        else:
+            capabilities.error = str(e)
+    capabilities.bytes_read = reader.bytes_read
+    return capabilities
+
+
 def _try_wms_url(url, version='1.3'):
     # Here's a neat way to run this manually:
     # python -c "import logging; logging.basicConfig(level=logging.INFO); from ckanext.dgu.gemini_postprocess import _try_wms_url; print _try_wms_url('http://soilbio.nerc.ac.uk/datadiscovery/WebPage5.aspx')"
@@ -149,79 +404,103 @@ def _try_wms_url(url, version='1.3'):
 
     try:
         capabilities_url = wms_capabilities_url(url, version)
-        log.debug('WMS check url: %s', capabilities_url)
-        try:
-            res = urllib2.urlopen(capabilities_url, None, 10)
-            xml = res.read(MAX_BYTES_READ_DURING_WMS_CHECK + 1)
-        except urllib2.HTTPError, e:
-            # e.g. http://aws2.caris.com/sfs/services/ows/download/feature/UKHO_TS_DS
-            log.info('WMS check for %s failed due to HTTP error status "%s". Response body: %s', capabilities_url, e, e.read())
-            return False
-        except urllib2.URLError, e:
-            log.info('WMS check for %s failed due to HTTP connection error "%s".', capabilities_url, e)
-            return False
-        except socket.timeout, e:
-            log.info('WMS check for %s failed due to HTTP connection timeout error "%s".', capabilities_url, e)
-            return None
-        except socket.error, e:
-            log.info('WMS check for %s failed due to HTTP socket connection error "%s".', capabilities_url, e)
-            return False
-        except httplib.HTTPException, e:
-            log.info('WMS check for %s failed due to HTTP error "%s".', capabilities_url, e)
-            return False
-        if not xml.strip():
-            log.info('WMS check for %s failed due to empty response')
-            return False
-        if len(xml) > MAX_BYTES_READ_DURING_WMS_CHECK:
-            log.info('WMS check for %s failed due to the response being too large (>%s bytes)', capabilities_url, MAX_BYTES_READ_DURING_WMS_CHECK)
-            return False
-        # owslib only supports reading WMS 1.1.1 (as of 10/2014)
-        if version == '1.1.1':
-            try:
-                wms = owslib_wms.WebMapService(url, xml=xml)
-            except AttributeError, e:
-                # e.g. http://csw.data.gov.uk/geonetwork/srv/en/csw
-                log.info('WMS check for %s failed due to GetCapabilities response not containing a required field', url)
-                return False
-            except etree.XMLSyntaxError, e:
-                # e.g. http://www.ordnancesurvey.co.uk/oswebsite/xml/atom/
-                log.info('WMS check for %s failed parsing the XML response: %s', url, e)
-                return False
-            except owslib_wms.ServiceException:
-                # e.g. https://gatewaysecurity.ceh.ac.uk/wss/service/LCM2007_GB_25m_Raster/WSS
-                log.info('WMS check for %s failed - OGC error message: %s', url, traceback.format_exc())
-                return False
-            except socket.timeout, e:
-                # e.g. http://lichfielddc.maps.arcgis.com/apps/webappviewer/index.html?id=2be0619b59a5418c8c9d785c09504f57
-                log.info('WMS check for %s failed due to HTTP connection timeout error "%s".', capabilities_url, e)
-                return False
-            except socket.error, e:
-                log.info('WMS check for %s failed due to HTTP socket connection error "%s".', capabilities_url, e)
-                return False
-            is_wms = isinstance(wms.contents, dict) and wms.contents != {}
-            return is_wms
-        else:
-            try:
-                tree = etree.fromstring(xml)
-            except etree.XMLSyntaxError, e:
-                # e.g. http://www.ordnancesurvey.co.uk/oswebsite/xml/atom/
-                log.info('WMS check for %s failed parsing the XML response: %s', url,  e)
-                return False
-            if tree.tag != '{http://www.opengis.net/wms}WMS_Capabilities':
-                # e.g. https://gatewaysecurity.ceh.ac.uk/wss/service/LCM2007_GB_25m_Raster/WSS
-                log.info('WMS check for %s failed as top tag is not wms:WMS_Capabilities, it was %s', url, tree.tag)
-                return False
-            # check based on https://github.com/geopython/OWSLib/blob/master/owslib/wms.py
-            se = tree.find('ServiceException')
-            if se:
-                log.info('WMS check for %s failed as it contained a ServiceException: %s', url, str(se.text).strip())
-                return False
-            return True
+        capabilities = _get_capabilities(capabilities_url)
+        if not capabilities:
+            return capabilities
+        return _check_capabilities(url, capabilities, version)
     except Exception, e:
         log.exception('WMS check for %s failed with uncaught exception: %s' % (url, str(e)))
     return False
 
 
+def _get_capabilities(capabilities_url, raise_http_error=False):
+    '''Does a GetCapabilities request and inspects the response.
+
+    With raise_http_error, an HTTP error status is raised as the
+    urllib2.HTTPError, rather than returning False.
+
+    Returns:
+      a Capabilities
+      False - got HTTP error, or a response that is empty, too large or not
+              XML
+      None - socket timeout
+    '''
+    log.debug('WMS check url: %s', capabilities_url)
+    try:
+        res = urllib2.urlopen(capabilities_url, None, 10)
+        try:
+            capabilities = inspect_capabilities(res)
+        finally:
+            res.close()
+    except urllib2.HTTPError, e:
+        # e.g. http://aws2.caris.com/sfs/services/ows/download/feature/UKHO_TS_DS
+        log.info('WMS check for %s failed due to HTTP error status "%s". Response body: %s', capabilities_url, e, e.read())
+        if raise_http_error:
+            raise
+        return False
+    except urllib2.URLError, e:
+        log.info('WMS check for %s failed due to HTTP connection error "%s".', capabilities_url, e)
+        return False
+    except socket.timeout, e:
+        log.info('WMS check for %s failed due to HTTP connection timeout error "%s".', capabilities_url, e)
+        return None
+    except socket.error, e:
+        log.info('WMS check for %s failed due to HTTP socket connection error "%s".', capabilities_url, e)
+        return False
+    except httplib.HTTPException, e:
+        log.info('WMS check for %s failed due to HTTP error "%s".', capabilities_url, e)
+        return False
+    if capabilities.error == 'empty':
+        log.info('WMS check for %s failed due to empty response', capabilities_url)
+        return False
+    if capabilities.error == 'too large':
+        log.info('WMS check for %s failed due to the response being too large (>%s bytes)', capabilities_url, MAX_BYTES_READ_DURING_WMS_CHECK)
+        return False
+    if capabilities.error:
+        # e.g. http://www.ordnancesurvey.co.uk/oswebsite/xml/atom/
+        log.info('WMS check for %s failed parsing the XML response: %s', capabilities_url, capabilities.error)
+        return False
+    return capabilities
+
+
+def _check_capabilities(url, capabilities, version):
+    '''Returns whether an inspected GetCapabilities response is from a WMS
+    of the given version.'''
+    if _is_service_exception(capabilities):
+        # e.g. https://gatewaysecurity.ceh.ac.uk/wss/service/LCM2007_GB_25m_Raster/WSS
+        log.info('WMS check for %s failed - OGC error message: %s', url, capabilities.service_exception)
+        return False
+    if version == '1.1.1':
+        if capabilities.root_tag != WMS_1_1_1_TAG:
+            # e.g. http://csw.data.gov.uk/geonetwork/srv/en/csw
+            log.info('WMS check for %s failed as top tag is not WMT_MS_Capabilities, it was %s', url, capabilities.root_tag)
+            return False
+        if not capabilities.has_layer:
+            log.info('WMS check for %s failed as it has no layers', url)
+            return False
+        return True
+    if capabilities.root_tag != WMS_1_3_TAG:
+        log.info('WMS check for %s failed as top tag is not wms:WMS_Capabilities, it was %s', url, capabilities.root_tag)
+        return False
+    return True
+
+
+def _is_service_exception(capabilities):
+    return capabilities.service_exception is not None or \
+        capabilities.root_tag.endswith('ServiceExceptionReport')
+
+
+def _base_urls(capabilities):
+    '''Returns the base URLs given in an inspected GetCapabilities
+    response.'''
+    base_urls = set()
+    for url in capabilities.online_resources:
+        base_url = get_wms_base_url(url)
+        base_urls.add(base_url)
+    log.info('Extra WMS base urls: %r', base_urls)
+    return base_urls
+
+
 def _wms_base_urls(url):
     '''Given a WMS URL this method returns the base URLs it uses (so that they
     can be proxied when previewing it). It does it by making basic WMS
@@ -234,55 +513,18 @@ def _wms_base_urls(url):
         capabilities_url = wms_capabilities_url(url, version=None)
         # We don't want a "version" param, because the OS WMS previewer doesn't
         # specify a version, so may receive later versions by default.  And
-        # versions like 1.3 may have different base URLs. It does mean that we
-        # can't use OWSLIB to parse the result though.
-        try:
-            log.debug('WMS base url check: %s', capabilities_url)
-            res = urllib2.urlopen(capabilities_url, None, 10)
-            xml_str = res.read(MAX_BYTES_READ_DURING_WMS_CHECK + 1)
-        except urllib2.HTTPError, e:
-            # e.g. http://aws2.caris.com/sfs/services/ows/download/feature/UKHO_TS_DS
-            log.info('WMS check for %s failed due to HTTP error status "%s". Response body: %s', capabilities_url, e, e.read())
-            return False, set()
-        except urllib2.URLError, e:
-            log.info('WMS check for %s failed due to HTTP connection error "%s".', capabilities_url, e)
-            return False, set()
-        except socket.timeout, e:
-            log.info('WMS check for %s failed due to HTTP connection timeout error "%s".', capabilities_url, e)
-            return False, set()
-        except socket.error, e:
-            log.info('WMS check for %s failed due to HTTP connection socket error "%s".', capabilities_url, e)
-            return False, set()
-        except httplib.HTTPException, e:
-            log.info('WMS check for %s failed due to HTTP error "%s".', capabilities_url, e)
-            return False
-        if len(xml_str) > MAX_BYTES_READ_DURING_WMS_CHECK:
-            log.info('WMS check for %s failed due to the response being too large (>%s bytes)', capabilities_url, MAX_BYTES_READ_DURING_WMS_CHECK)
-            return False
-        parser = etree.XMLParser(remove_blank_text=True)
-        try:
-            xml_tree = etree.fromstring(xml_str, parser=parser)
-        except etree.XMLSyntaxError, e:
-            # e.g. http://www.ordnancesurvey.co.uk/oswebsite/xml/atom/
-            log.info('WMS base urls for %s failed parsing the XML response: %s', url, traceback.format_exc())
-            return []
+        # versions like 1.3 may have different base URLs.
+        capabilities = _get_capabilities(capabilities_url)
+        if not capabilities:
+            return set()
         # check it is a WMS
-        if not 'wms' in str(xml_tree).lower():
-            log.info('WMS base urls %s failed - XML top tag was not WMS response: %s', url, str(xml_tree))
-            return []
-        base_urls = set()
-        namespaces = {'wms': 'http://www.opengis.net/wms', 'xlink': 'http://www.w3.org/1999/xlink'}
-        xpath = '//wms:HTTP//wms:OnlineResource/@xlink:href'
-        urls = xml_tree.xpath(xpath, namespaces=namespaces)
-        for url in urls:
-            if url:
-                base_url = get_wms_base_url(url)
-                base_urls.add(base_url)
-        log.info('Extra WMS base urls: %r', base_urls)
-        return base_urls
+        if not 'wms' in capabilities.root_tag.lower():
+            log.info('WMS base urls %s failed - XML top tag was not WMS response: %s', url, capabilities.root_tag)
+            return set()
+        return _base_urls(capabilities)
     except Exception, e:
         log.exception('WMS base url extraction %s failed with uncaught exception: %s' % (url, str(e)))
-    return False
+    return set()
 
 
 def tidy_up_package(package):
@@ -1,42 +1,34 @@
 """
 This file contain code analogous to ckan.lib.dumper except that instead
 of dumping all of the packages and resources in the same table, it dumps
-them to individual files (datasets.csv and resources.csv) before zipping
-them.
+them to individual files (datasets.csv and resources.csv) in a zip.
+
+The columns are fixed (DATASET_COLUMNS) and the datasets are read in
+batches, with a few bulk queries per batch rather than building a package
+dict per dataset. The rows are streamed into the zip, so memory use does not
+grow with the number of datasets, and the batches can be spread over several
+worker processes.
 """
 import unicodecsv as csv
 import json
-import tempfile
+import logging
+import multiprocessing
+import struct
+import time
 import urlparse
+import zipfile
+import zlib
+from cStringIO import StringIO
 
 from paste.deploy.converters import asbool
 
 from pylons import config
 import ckan.logic as logic
 import ckan.model as model
+from ckanext.dgu.lib import formats
+from ckanext.dgu.lib.publisher import PublisherHierarchy
 
-IGNORE_KEYS = [
-    u'ratings_count',
-    u'ratings_average',
-    u'revision_id',
-    u'creator_user_id',
-    u'groups',
-    u'ckan_url',
-    u'owner_org',
-    u'id',
-    u'name',
-    u'private',
-    u'relationships',
-    u'notes_rendered',
-    u'state',
-    u'title',
-    u'type',
-    u'ckan_url',
-    u'url',
-    u'author_email',
-    u'maintainer_email',
-    # emails, license, unpublished
-]
+log = logging.getLogger(__name__)
 
 INTERESTING_EXTRAS = [
     u'geographic_coverage',
@@ -59,35 +51,125 @@ def make_nice_name(name):
     return name.replace('_', ' ').replace('-', ' ').title()
 
 
-class CSVDumper(object):
-
+# The dataset columns after the fixed ones at the start of each row. These
+# are the package fields and INTERESTING_EXTRAS (with odi-certificate
+# replaced by its URL), in alphabetical order.
+DATASET_KEYS = [
+    u'author',
+    u'geographic_coverage',
+    u'isopen',
+    u'license_id',
+    u'maintainer',
+    u'mandate',
+    u'metadata_created',
+    u'metadata_modified',
+    u'notes',
+    u'odi-certificate-url',
+    u'tags',
+    u'temporal_coverage-from',
+    u'temporal_coverage-to',
+    u'theme-primary',
+    u'theme-secondary',
+    u'update_frequency',
+    u'version',
+]
 
-    def __init__(self, *args, **kwargs):
-        self.dataset_file = tempfile.NamedTemporaryFile(delete=False)
-        self.resource_file = tempfile.NamedTemporaryFile(delete=False)
+DATASET_COLUMNS = [
+    'Name', 'Title', 'URL', 'Organization', 'Top level organisation',
+    'License', 'Published', 'NII', 'Location', 'Import source'
+    ] + [make_nice_name(k) for k in DATASET_KEYS]
 
-        self.dataset_csv = csv.writer(self.dataset_file)
-        self.resource_csv = csv.writer(self.resource_file)
+RESOURCE_COLUMNS = [
+    'Dataset Name', 'URL', 'Format', 'Description', 'Resource ID',
+    'Position', 'Date', 'Organization', 'Top level organization'
+    ]
 
-        self.dataset_filename = self.dataset_file.name
-        self.resource_filename = self.resource_file.name
 
+class CSVDumper(object):
+    '''Writes the public datasets and their resources to datasets.csv and
+    resources.csv in a zip file.
+
+    e.g. CSVDumper(workers=4).dump('data.gov.uk-ckan-meta-data.csv.zip')
+    '''
+    def __init__(self, batch_size=500, workers=1):
+        self.batch_size = batch_size
+        self.workers = workers
         self.organization_cache = {}
+        self.site_url = config.get('ckan.site_url')
 
-        self.keys = []
-
-    def dump(self, limit=None):
-        packages = model.Session.query(model.Package)\
+    def package_ids(self, limit=None):
+        packages = model.Session.query(model.Package.id)\
             .filter(model.Package.state == 'active')\
             .filter(model.Package.private == False)\
             .order_by('name')
         if limit:
             packages = packages.limit(limit)
-
-        first = True
-        for pkg in packages.yield_per(200):
-            self.write_object(pkg, first)
-            first = False
+        return [row[0] for row in packages]
+
+    def dump(self, zip_filepath, limit=None):
+        '''Writes the zip file. Returns the number of datasets and resources
+        dumped.'''
+        start = time.time()
+        pkg_ids = self.package_ids(limit)
+        batches = [pkg_ids[i:i + self.batch_size]
+                   for i in xrange(0, len(pkg_ids), self.batch_size)]
+        log.info('Dumping %s datasets in %s batches with %s worker(s)',
+                 len(pkg_ids), len(batches), self.workers)
+
+        pool = None
+        if self.workers > 1:
+            # Connections can't be shared with the workers
+            model.Session.remove()
+            model.meta.engine.dispose()
+            pool = multiprocessing.Pool(self.workers,
+                                        initializer=_init_worker)
+        counts = {}
+        zip_file = zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            for filename, columns, row_type in (
+                    ('datasets.csv', DATASET_COLUMNS, 'dataset'),
+                    ('resources.csv', RESOURCE_COLUMNS, 'resource')):
+                entry = ZipEntryWriter(zip_file, filename)
+                entry.write(self.to_csv([columns]))
+                tasks = [(row_type, batch) for batch in batches]
+                if pool:
+                    # imap returns the batches in order
+                    chunks = pool.imap(_write_batch, tasks)
+                else:
+                    chunks = (self.write_batch(*task) for task in tasks)
+                counts[row_type] = 0
+                for chunk, num_rows in chunks:
+                    entry.write(chunk)
+                    counts[row_type] += num_rows
+                entry.close()
+                log.info('Dumped %s: %s rows, %dMb uncompressed',
+                         filename, counts[row_type],
+                         entry.file_size / (1024 * 1024))
+        finally:
+            zip_file.close()
+            if pool:
+                pool.close()
+                pool.join()
+        log.info('CSV dump took %.1fs', time.time() - start)
+        return counts['dataset'], counts['resource']
+
+    def write_batch(self, row_type, pkg_ids):
+        '''Returns the CSV for the given datasets (or their resources) and
+        the number of rows.'''
+        if row_type == 'dataset':
+            rows = self.dataset_rows(pkg_ids)
+        else:
+            rows = self.resource_rows(pkg_ids)
+        # don't let the session grow with every batch
+        model.Session.remove()
+        return self.to_csv(rows), len(rows)
+
+    def to_csv(self, rows):
+        buf = StringIO()
+        csv_writer = csv.writer(buf)
+        for row in rows:
+            csv_writer.writerow(row)
+        return buf.getvalue()
 
     def _encode(self, s):
         ''' csv.write doesn't do encoding - call this on all row cells
@@ -105,108 +187,143 @@ class CSVDumper(object):
             s = str(s)
         return s
 
-    def write_object(self, pkg, first=False):
-        pkg_dict, resources = self._flatten(pkg)
-
-        if first:
-            # TODO Get a better list of fields to dump than just what we see in
-            # the first dataset...
-            self.dataset_keys = sorted(pkg_dict.keys())
-            self.dataset_keys.remove('license')  # duplicate
-            self.write_header(self.dataset_keys)
-
-        url = config.get('ckan.site_url')
-        full_url = urlparse.urljoin(url, '/dataset/%s' % pkg.name)
-
-        if pkg.owner_org in self.organization_cache:
-            organization, top_level_publisher = self.organization_cache.get(pkg.owner_org)
-        else:
-            org = model.Group.get(pkg.owner_org)
-            organization = org.title
-
-            parent_group_hierarchy = org.get_parent_group_hierarchy('organization')
-            if parent_group_hierarchy:
-                top_level_publisher = parent_group_hierarchy[0].title
+    def _extras(self, pkg_ids):
+        extras = dict((pkg_id, {}) for pkg_id in pkg_ids)
+        q = model.Session.query(model.PackageExtra.package_id,
+                                model.PackageExtra.key,
+                                model.PackageExtra.value)\
+            .filter(model.PackageExtra.package_id.in_(pkg_ids))\
+            .filter(model.PackageExtra.state == 'active')
+        for pkg_id, key, value in q:
+            extras[pkg_id][key] = value
+        return extras
+
+    def _tags(self, pkg_ids):
+        tags = dict((pkg_id, []) for pkg_id in pkg_ids)
+        q = model.Session.query(model.PackageTag.package_id, model.Tag.name)\
+            .join(model.Tag, model.Tag.id == model.PackageTag.tag_id)\
+            .filter(model.PackageTag.package_id.in_(pkg_ids))\
+            .filter(model.PackageTag.state == 'active')\
+            .filter(model.Tag.vocabulary_id == None)
+        for pkg_id, tag_name in q:
+            tags[pkg_id].append(tag_name)
+        return tags
+
+    def _packages(self, pkg_ids):
+        '''Returns the packages in the order of pkg_ids.'''
+        packages = dict((pkg.id, pkg) for pkg in
+                        model.Session.query(model.Package)
+                        .filter(model.Package.id.in_(pkg_ids)))
+        return [packages[pkg_id] for pkg_id in pkg_ids if pkg_id in packages]
+
+    def _organization(self, org_id):
+        if org_id not in self.organization_cache:
+            hierarchy = PublisherHierarchy.get_for(org_id)
+            ancestors = hierarchy.ancestors(org_id)
+            if ancestors:
+                self.organization_cache[org_id] = (ancestors[0]['title'],
+                                                   ancestors[-1]['title'])
             else:
-                top_level_publisher = organization
-
-            self.organization_cache[pkg.owner_org] = (organization, top_level_publisher)
-
-        license = pkg.license or ''
-        if license:
-            license = pkg.license.title
-
-        # This really should have been published, rather than unpublished.
-        published = not asbool(pkg.extras.get('unpublished') or False)
-        nii = asbool(pkg.extras.get('core-dataset') or False)
-        location = asbool(pkg.extras.get('UKLP') or False)
-        import_source = pkg.extras.get('import_source') or \
-            'harvest' if pkg.extras.get('harvest_object_id') else ''
-
-        vals = [self._encode(val) for val in [pkg.name, pkg.title, full_url, organization, top_level_publisher, license, published, nii, location, import_source]]
-        vals += [self._encode(pkg_dict.get(k)) for k in self.dataset_keys]
-
-        self.dataset_csv.writerow(vals)
-
-        # Flatten the list
-        resources = sum(resources, [])
-
-        for resource in resources:
-            # Important to include the date column for timeseries.
-            date = resource.get('date', '')
-
-            row = [pkg.name, resource['url'], resource['format'], resource.get('description', ''),
-                resource['id'], resource['position'], date, organization, top_level_publisher]
-            self.resource_csv.writerow(row)
-
-    def write_header(self, dataset_keys):
-        """
-        Generate the header row for datasets.csv (with some preset fields) and then
-        the fixed headers for resources.
-        """
-        dataset_header_row = [
-            'Name', 'Title', 'URL', 'Organization', 'Top level organisation', 'License', 'Published', 'NII', 'Location', 'Import source'
-        ]
-
-        resource_header_row = [
-            'Dataset Name', 'URL', 'Format', 'Description', 'Resource ID', 'Position', 'Date', 'Organization', 'Top level organization'
-        ]
-
-        for k in dataset_keys:
-            dataset_header_row.append(self._encode(make_nice_name(k)))
-
-        self.dataset_csv.writerow(dataset_header_row)
-        self.resource_csv.writerow(resource_header_row)
-
-    def _flatten(self, pkg):
+                self.organization_cache[org_id] = (None, None)
+        return self.organization_cache[org_id]
+
+    def dataset_rows(self, pkg_ids):
+        rows_by_pkg = self.dataset_rows_by_package(pkg_ids)
+        return [row for pkg_id in pkg_ids
+                for row in rows_by_pkg.get(pkg_id, [])]
+
+    def resource_rows(self, pkg_ids):
+        rows_by_pkg = self.resource_rows_by_package(pkg_ids)
+        return [row for pkg_id in pkg_ids
+                for row in rows_by_pkg.get(pkg_id, [])]
+
+    def dataset_rows_by_package(self, pkg_ids):
+        '''Returns the datasets.csv row for each dataset, as
+        {pkg_id: [row]}.'''
+        extras_by_pkg = self._extras(pkg_ids)
+        tags_by_pkg = self._tags(pkg_ids)
+        license_register = model.Package.get_license_register()
+        rows = {}
+        for pkg in self._packages(pkg_ids):
+            extras = extras_by_pkg[pkg.id]
+            organization, top_level_publisher = \
+                self._organization(pkg.owner_org)
+            full_url = urlparse.urljoin(self.site_url,
+                                        '/dataset/%s' % pkg.name)
+            license = license_register.get(pkg.license_id) \
+                if pkg.license_id else None
+
+            # This really should have been published, rather than unpublished.
+            published = not asbool(extras.get('unpublished') or False)
+            nii = asbool(extras.get('core-dataset') or False)
+            location = asbool(extras.get('UKLP') or False)
+            import_source = extras.get('import_source') or \
+                'harvest' if extras.get('harvest_object_id') else ''
+
+            pkg_dict = self._flatten(pkg, extras, tags_by_pkg[pkg.id],
+                                     license)
+            vals = [pkg.name, pkg.title, full_url, organization,
+                    top_level_publisher, license.title if license else '',
+                    published, nii, location, import_source]
+            vals += [pkg_dict.get(k) for k in DATASET_KEYS]
+            rows[pkg.id] = [[self._encode(val) for val in vals]]
+        return rows
+
+    def resource_rows_by_package(self, pkg_ids):
+        '''Returns the resources.csv rows for each dataset, as
+        {pkg_id: [row, ...]}.'''
+        packages = dict((pkg_id, (name, owner_org)) for pkg_id, name, owner_org
+                        in model.Session.query(model.Package.id,
+                                               model.Package.name,
+                                               model.Package.owner_org)
+                        .filter(model.Package.id.in_(pkg_ids)))
+        resources_by_pkg = dict((pkg_id, []) for pkg_id in pkg_ids)
+        q = model.Session.query(model.ResourceGroup.package_id,
+                                model.Resource)\
+            .join(model.Resource,
+                  model.Resource.resource_group_id == model.ResourceGroup.id)\
+            .filter(model.ResourceGroup.package_id.in_(pkg_ids))\
+            .filter(model.Resource.state == 'active')\
+            .order_by(model.Resource.position)
+        for pkg_id, resource in q:
+            resources_by_pkg[pkg_id].append(resource)
+
+        rows = {}
+        for pkg_id in pkg_ids:
+            if pkg_id not in packages:
+                continue
+            pkg_name, owner_org = packages[pkg_id]
+            organization, top_level_publisher = self._organization(owner_org)
+            rows[pkg_id] = []
+            for resource in resources_by_pkg[pkg_id]:
+                # Important to include the date column for timeseries.
+                date = (resource.extras or {}).get('date', '')
+
+                rows[pkg_id].append([pkg_name, resource.url,
+                                     formats.clean_format(resource.format),
+                                     resource.description or '', resource.id,
+                                     resource.position, date, organization,
+                                     top_level_publisher])
+        return rows
+
+    def _flatten(self, pkg, extras, tags, license):
         """
-        Pull and flatten the package dict, making sure to promote any interesting
-        extras we find.
+        Get the dataset fields in DATASET_KEYS, making sure to promote any
+        interesting extras we find.
         """
-        pkg_dict = pkg.as_dict()
-        resources = []
-
-        new_dict = {}
-
-        for name, value in pkg_dict.items()[:]:
-            if name == 'extras' or name in IGNORE_KEYS:
-                continue
-
-            if name == 'resources':
-                resources.append(value)
-                continue
-
-            if isinstance(value, (list, tuple)):
-                new_dict[name] = ','.join(value)
-                continue
-
-            if isinstance(value, dict):
-                for name_, value_ in value.items():
-                    if name_ not in IGNORE_KEYS:
-                        new_dict[name_] = value_
-                continue
-
-            new_dict[name] = value
+        new_dict = {
+            'author': pkg.author,
+            'isopen': license.isopen() if license else False,
+            'license_id': pkg.license_id,
+            'maintainer': pkg.maintainer,
+            'metadata_created': pkg.metadata_created.isoformat()
+                if pkg.metadata_created else None,
+            'metadata_modified': pkg.metadata_modified.isoformat()
+                if pkg.metadata_modified else None,
+            'notes': pkg.notes,
+            'tags': ','.join(sorted(tags)),
+            'version': pkg.version,
+            }
 
         # Make sure all the extras we are interested in have keys
         for k in INTERESTING_EXTRAS:
@@ -217,7 +334,7 @@ class CSVDumper(object):
 
         # If we have values for those extras, then we should add
         # them.
-        for k, v in pkg_dict['extras'].iteritems():
+        for k, v in extras.iteritems():
             # Temporary workaround for themes-secondary
             if k == 'theme-secondary' and isinstance(v, (str, unicode)):
                 try:
@@ -232,11 +349,10 @@ class CSVDumper(object):
 
             if k == 'odi-certificate':
                 self._add_cert_info(new_dict, v)
-                del new_dict['odi-certificate']
             elif k in INTERESTING_EXTRAS:
                 new_dict[k] = v
 
-        return new_dict, resources
+        return new_dict
 
     def _add_cert_info(self, d, v):
         """
@@ -250,8 +366,62 @@ class CSVDumper(object):
             # just pass on those.
             pass
 
-    def close(self):
-        self.dataset_file.close()
-        self.resource_file.close()
 
-        return self.dataset_filename, self.resource_filename
+_worker_dumper = None
+
+def _init_worker():
+    global _worker_dumper
+    _worker_dumper = CSVDumper()
+
+def _write_batch(task):
+    return _worker_dumper.write_batch(*task)
+
+
+class ZipEntryWriter(object):
+    '''Writes a file into a ZipFile bit by bit, so that it does not all
+    have to be in memory or a temporary file first. (ZipFile.open can only
+    read in Python 2.) Only one entry can be written at a time and it must be
+    less than 2GB.'''
+    def __init__(self, zip_file, filename):
+        self.zip_file = zip_file
+        zinfo = zipfile.ZipInfo(filename, time.localtime(time.time())[:6])
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.external_attr = 0644 << 16L
+        # bit 3: the CRC and sizes follow the data, in a data descriptor
+        zinfo.flag_bits = 0x08
+        zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+        zinfo.header_offset = zip_file.fp.tell()
+        zip_file._writecheck(zinfo)
+        zip_file._didModify = True
+        zip_file.fp.write(zinfo.FileHeader())
+        self.zinfo = zinfo
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                           zlib.DEFLATED, -15)
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        self.file_size += len(data)
+        self._write_compressed(self.compressor.compress(data))
+
+    def _write_compressed(self, data):
+        self.compress_size += len(data)
+        self.zip_file.fp.write(data)
+
+    def close(self):
+        self._write_compressed(self.compressor.flush())
+        if self.compress_size > zipfile.ZIP64_LIMIT or \
+                self.file_size > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile('%s is too large to stream into the '
+                                       'zip' % self.zinfo.filename)
+        zinfo = self.zinfo
+        zinfo.CRC = self.crc
+        zinfo.file_size = self.file_size
+        zinfo.compress_size = self.compress_size
+        self.zip_file.fp.write(struct.pack('<4sLLL', 'PK\x07\x08', zinfo.CRC,
+                                           zinfo.compress_size,
+                                           zinfo.file_size))
+        self.zip_file.filelist.append(zinfo)
+        self.zip_file.NameToInfo[zinfo.filename] = zinfo
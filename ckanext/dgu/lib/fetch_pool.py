@@ -0,0 +1,135 @@
+'''
+Calls a function for many items over a bounded pool of threads, for work such
+as fetching from a remote service or an API that would otherwise spend most
+of its time waiting on one request at a time.
+
+ * FetchPool - calls fetch(item) concurrently, with a cap on the requests in
+   flight and on the requests per second, and yields the results in the
+   order of the items.
+'''
+import Queue
+import sys
+import threading
+import time
+
+
+class RateLimiter(object):
+    '''Spaces out calls to wait() across all threads so there are no more
+    than `rate` per second. A rate of None or 0 means no limit.'''
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            start_time = max(now, self.next_time)
+            self.next_time = start_time + self.interval
+        if start_time > now:
+            time.sleep(start_time - now)
+
+
+class FetchPool(object):
+    '''Calls fetch(item) for each item using a pool of worker threads.
+
+    workers - the number of threads, and therefore the maximum number of
+              requests in flight at once
+    rate - the maximum fetches per second, over all the workers
+    errors - exception classes that are expected of fetch, which are yielded
+             with the item rather than raised
+
+    e.g.
+        pool = FetchPool(workers=8, rate=20, errors=(DrupalRequestError,))
+        for nid, node, error in pool.imap(drupal.get_node, nids):
+            ...
+    '''
+    def __init__(self, workers=8, rate=None, errors=()):
+        self.workers = max(1, workers)
+        self.rate_limiter = RateLimiter(rate)
+        self.errors = tuple(errors)
+        self.fetched = 0
+        self.seconds = 0.0
+
+    def imap(self, fetch, items):
+        '''Yields (item, result, error) for each item, in the order of items.
+        error is None unless fetch raised one of the expected errors. Any
+        other exception is raised here. Only a few items are read ahead of
+        the one being yielded, so items can be a generator.
+        '''
+        items = iter(items)
+        tasks = Queue.Queue()
+        results = Queue.Queue()
+
+        def worker():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                index, item = task
+                self.rate_limiter.wait()
+                try:
+                    results.put((index, item, fetch(item), None, None))
+                except self.errors, e:
+                    results.put((index, item, None, e, None))
+                except Exception:
+                    results.put((index, item, None, None, sys.exc_info()))
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        window = self.workers * 2  # items queued or in flight
+        done = {}  # index: result, for results that arrive out of order
+        num_submitted = num_yielded = 0
+        items_exhausted = False
+        start = time.time()
+        try:
+            while True:
+                while not items_exhausted and \
+                        num_submitted - num_yielded < window:
+                    try:
+                        item = items.next()
+                    except StopIteration:
+                        items_exhausted = True
+                        break
+                    tasks.put((num_submitted, item))
+                    num_submitted += 1
+                if items_exhausted and num_yielded == num_submitted:
+                    break
+                while num_yielded not in done:
+                    result = self._get(results)
+                    done[result[0]] = result
+                index, item, result, error, exc_info = done.pop(num_yielded)
+                num_yielded += 1
+                self.fetched += 1
+                self.seconds = time.time() - start
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                yield item, result, error
+        finally:
+            # stop the workers, abandoning any queued items
+            try:
+                while True:
+                    tasks.get_nowait()
+            except Queue.Empty:
+                pass
+            for thread in threads:
+                tasks.put(None)
+
+    @staticmethod
+    def _get(results):
+        # a timeout lets KeyboardInterrupt through while waiting
+        while True:
+            try:
+                return results.get(timeout=1)
+            except Queue.Empty:
+                pass
+
+    def rate(self):
+        '''Returns the fetches per second so far.'''
+        return self.fetched / self.seconds if self.seconds else 0.0
@@ -48,6 +48,8 @@ def get_icon(format_):
     return ICON_MAP.get(format_)
 
 import re
+import threading
+from collections import OrderedDict
 
 class Formats(object):
     @classmethod
@@ -97,11 +99,13 @@ class Formats(object):
                     cls._by_reduced[reduced_name] = format_dict
         return cls._by_reduced
 
-    @staticmethod
-    def reduce(format_name):
+    _reduce_regex = re.compile('[^a-z/+]')
+
+    @classmethod
+    def reduce(cls, format_name):
         format_name = format_name.strip().lower()
         if format_name.startswith('.'): format_name = format_name[1:]
-        return re.sub('[^a-z/+]', '', format_name)
+        return cls._reduce_regex.sub('', format_name)
 
     @classmethod
     def match(cls, raw_resource_format):
@@ -174,3 +178,102 @@ class Formats(object):
 
 # Mime types which give not much clue to the format
 VAGUE_MIME_TYPES = set(('application/octet-stream',))
+
+
+class LRUCache(object):
+    '''A dict-like cache that holds at most max_size items, discarding the
+    least recently used. Safe to share between threads.'''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+class FormatNormaliser(object):
+    '''Turns the format strings that people type into resources (e.g.
+    ".Csv ", "excel") into canonical format names (e.g. "CSV", "XLS").
+
+    Matches against CKAN's resource_formats table first and then the
+    Formats.get_data() names. Results are memoized, since the same few
+    hundred raw strings turn up again and again. Use the shared instance via
+    canonical_format() and clean_format().
+    '''
+    _disallowed_characters = re.compile(r'[^a-zA-Z /+]')
+
+    def __init__(self, max_size=10000):
+        # {raw_format: (canonical_format or None, cleaned_format)}
+        self.cache = LRUCache(max_size)
+
+    def _normalise(self, raw_format):
+        import ckan.lib.helpers
+        format_line = ckan.lib.helpers.resource_formats().get(
+            raw_format.lower().strip(' .'))
+        if format_line:
+            canonical = format_line[1]
+        else:
+            format_dict = Formats.match(raw_format)
+            canonical = format_dict['display_name'] if format_dict else None
+        if canonical:
+            return canonical, canonical
+        return None, self._disallowed_characters.sub('', raw_format).strip()
+
+    def _lookup(self, raw_format):
+        result = self.cache.get(raw_format)
+        if result is None:
+            result = self._normalise(raw_format)
+            self.cache.set(raw_format, result)
+        return result
+
+    def canonical_format(self, raw_format):
+        '''Returns the canonical name for the format, or None if it is not
+        a known format.'''
+        if not isinstance(raw_format, basestring):
+            return None
+        return self._lookup(raw_format)[0]
+
+    def clean_format(self, raw_format):
+        '''Returns the canonical name for the format, or if it is not a known
+        format, the format with odd characters removed. Non-strings are
+        returned unchanged.'''
+        if not isinstance(raw_format, basestring):
+            return raw_format
+        return self._lookup(raw_format)[1]
+
+_normaliser = FormatNormaliser()
+
+def canonical_format(raw_format):
+    return _normaliser.canonical_format(raw_format)
+
+def clean_format(raw_format):
+    return _normaliser.clean_format(raw_format)
+
+def get_normaliser():
+    return _normaliser
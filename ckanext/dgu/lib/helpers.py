@@ -710,9 +710,8 @@ def list_flatten(data):
 
 def dgu_format_icon(format_string):
     icon_filename = None
-    format_line = ckan.lib.helpers.resource_formats().get(format_string.lower().strip(' .'))
-    if format_line:
-        canonical_format = format_line[1]
+    canonical_format = formats.canonical_format(format_string)
+    if canonical_format:
         icon_filename = formats.get_icon(canonical_format)
     if not icon_filename:
         icon_filename = 'document'
@@ -720,10 +719,7 @@ def dgu_format_icon(format_string):
     return icon_html(url)
 
 def dgu_format_name(format_string):
-    format_line = ckan.lib.helpers.resource_formats().get(format_string.lower().strip(' .'))
-    if format_line:
-        return format_line[1]
-    return format_string
+    return formats.canonical_format(format_string) or format_string
 
 def name_for_uklp_type(package):
     uklp_type = get_uklp_package_type(package)
@@ -1620,83 +1616,29 @@ def publisher_performance_data(publisher, include_sub_publishers):
         Returns additional info for publishers, as traffic lights so that
         it can be viewed on the publisher read page.
 
-        broken_links - green = 0%, amber <= 60% broken links, red > 60% broken
-        openness - green if all > 4 *, amber for 50%> 3*, red otherwise
+        These are calculated for all publishers at once by the
+        'publisher-performance' task of gov_daily.py, so this is normally a
+        single lookup. If that has not run yet, they are calculated just for
+        this publisher.
     """
     try:
         import ckanext.qa
     except ImportError:
         return None
-    import time
-    from ckanext.qa.reports import broken_resource_links_for_organisation
+    from ckanext.report.model import DataCache
     from ckanext.dgu.lib import publisher as publib
 
-    start_time = time.time()
-
-    rcount = publib.resource_count(publisher, include_sub_publishers)
-    log.debug("{p} has {r} resources".format(p=publisher.name, r=rcount))
-
-    # Issues data
-    issues = "green"
-
-    if 'issues' in config['ckan.plugins']:
-        # If issues are installed then we can use the info to determine
-        # whether the issues are older than a month, between a fortnight
-        # and a month, or less than a fortnight.
-        from ckanext.issues.lib import util
-
-        more_than_month = util.old_unresolved(publisher, days=30)
-        more_than_fortnight = util.old_unresolved(publisher, days=14)
-
-        if more_than_month:
-            issues = 'red'
-        elif more_than_fortnight:
-            issues = 'amber'
-        else:
-            issues = 'green'
-
-    spending = 'green'
-    if publisher_has_spend_data(publisher):
-        spending = 'red'
-
-    # TODO: Add a count to result of broken_resource_links_for_organisation or write a version
-    # that returns count().
-    data = broken_resource_links_for_organisation(publisher.name, include_sub_publishers, use_cache=True)
-    broken_count = len(data['data'])
-
-    if broken_count == 0 or rcount == 0:
-        pct = 0
-    else:
-        pct = int(100 * float(broken_count)/float(rcount))
-    log.debug("{d}% of resources in {p} are broken".format(d=pct, p=publisher.name))
-
-    broken_links = 'green'
-    if 1 < pct <= 60:
-        broken_links = 'amber'
-    elif pct > 60:
-        broken_links = 'red'
-
-    openness = ''
-    total, counters = publib.openness_scores(publisher, include_sub_publishers)
-    number_x_or_above = lambda x: sum(counters.get(str(c),0) for c in xrange(x, 6))
-
-    above_3 = number_x_or_above(3)
-    pct_above_3 = int(100 * float(total)/float(above_3)) if above_3 else 0
-
-    if number_x_or_above(4) == total:
-        openness = 'green'
-    elif pct_above_3 >= 50:
-        openness = 'amber'
-    else:
-        openness = 'red'
+    key = publib.performance_cache_key(include_sub_publishers)
+    data, created = DataCache.get(publisher.name, key, convert_json=True)
+    if data:
+        return data
 
-    log.debug("publisher performance data took {d} seconds".format(d=time.time()-start_time))
-    return {
-        'broken_links': broken_links,
-        'openness': openness,
-        'issues': issues,
-        'spending': spending
-    }
+    log.debug('No cached performance data for %s - calculating',
+              publisher.name)
+    performance = publib.publisher_performance([publisher.id])
+    if publisher.id not in performance:
+        return None
+    return performance[publisher.id][include_sub_publishers]
 
 def publisher_has_spend_data(publisher):
     return publisher.extras.get('category','') == 'ministerial-department'
@@ -1952,16 +1894,9 @@ def inventory_status(package_items):
         yield pkg,grp, pkg.extras.get('publish-date', ''), pkg.extras.get('release-notes', ''), action
 
 def themes_count():
-    from ckan import model
-    theme_count = {}
-    for theme, theme_dict in themes().items():
-        count = model.Session.query(model.Package)\
-            .join(model.PackageExtra)\
-            .filter(model.PackageExtra.key=='theme-primary')\
-            .filter(model.PackageExtra.value==theme_dict['title'])\
-            .filter(model.Package.state=='active').count()
-        theme_count[theme_dict['title']] = count
-    return theme_count
+    from ckanext.dgu.lib.home import Counters
+    counts = Counters.get().themes
+    return dict((theme, counts.get(theme, 0)) for theme in themes())
 
 def themes():
     from ckanext.dgu.lib.theme import Themes
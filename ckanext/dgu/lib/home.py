@@ -1,5 +1,4 @@
-import sqlalchemy
-from beaker.cache import cache_region
+import time
 
 from ckan import model
 from ckanext.dgu.plugins_toolkit import get_action
@@ -7,26 +6,84 @@ from ckanext.dgu.plugins_toolkit import get_action
 log = __import__('logging').getLogger(__name__)
 
 
-@cache_region('short_term', 'themes')
 def get_themes():
     '''
-    Get the themes from ckanext-taxonomy
+    Get the themes from ckanext-taxonomy, via the Themes
     '''
-    context = {'model': model}
-    try:
-        log.debug('Refreshing home page themes')
-        terms = get_action('taxonomy_term_list')(
-            context, {'name': 'dgu-themes'})
-    except sqlalchemy.exc.OperationalError, e:
-        if 'no such table: taxonomy' in str(e):
-            model.Session.remove()  # clear the erroring transaction
-            raise ImportError('ckanext-taxonomy tables not setup')
-        raise
+    from ckanext.dgu.lib.theme import Themes
+    themes = Themes.instance()
 
     def gds_style(name):
         # only first word can be capitalized
         return name.replace('&', 'and').replace('Economy', 'economy').replace('Justice', 'justice').replace('Spending', 'spending').replace('Cities', 'cities')
 
-    return [(gds_style(t['label']), t['label'],
-             t['extras']['short_description'])
-            for t in terms]
+    return [(gds_style(name), name, themes.data[name]['short_description'])
+            for name in themes.names]
+
+
+class Counters(object):
+    '''The dataset counts shown around the site, from one faceted search of
+    the public datasets:
+
+      datasets - number of public datasets
+      published_datasets - those of them not marked unpublished
+      themes - {theme-primary: number of datasets}
+      collections - {collection: number of datasets}
+
+    Use Counters.get() to share a snapshot. It is dropped when a package is
+    committed in this process (see SearchPlugin.before_commit) and otherwise
+    reloaded after dgu.counters.ttl seconds.
+    '''
+    _snapshot = None
+
+    def __init__(self, datasets, published_datasets, themes, collections,
+                 failed=False):
+        self.datasets = datasets
+        self.published_datasets = published_datasets
+        self.themes = themes
+        self.collections = collections
+        self.failed = failed  # the search failed, so these are not counts
+        self.created = time.time()
+
+    @classmethod
+    def load(cls):
+        from ckan.lib.search import SearchError
+        context = {'model': model, 'session': model.Session,
+                   'user': 'visitor'}
+        data_dict = {
+            'q': '*:*',
+            'fq': '+dataset_type:dataset capacity:"public"',
+            'facet': 'true',
+            'facet.field': ['unpublished', 'theme-primary', 'collection'],
+            'facet.limit': -1,
+            'rows': 0,
+        }
+        try:
+            query = get_action('package_search')(context, data_dict)
+        except SearchError, se:
+            log.error('Search error: %s', se)
+            return cls(0, 0, {}, {}, failed=True)
+        facets = query['facets']
+        return cls(query['count'],
+                   facets.get('unpublished', {}).get('false', 0),
+                   facets.get('theme-primary', {}),
+                   facets.get('collection', {}))
+
+    @classmethod
+    def get(cls):
+        '''Returns the shared snapshot, loading it if it is missing or
+        older than dgu.counters.ttl seconds. If the search fails, the previous
+        snapshot is kept and returned, or else zeros that aren't kept.'''
+        from pylons import config
+        ttl = int(config.get('dgu.counters.ttl', 300))
+        snapshot = cls._snapshot
+        if snapshot is None or time.time() - snapshot.created > ttl:
+            loaded = cls.load()
+            if loaded.failed:
+                return snapshot or loaded
+            snapshot = cls._snapshot = loaded
+        return snapshot
+
+    @classmethod
+    def invalidate(cls):
+        cls._snapshot = None
@@ -0,0 +1,417 @@
+'''
+Creates the daily dumps (JSON, CSV and unpublished CSV) incrementally.
+
+Each dataset's part of each dump is kept in a cache on disk, with the
+dataset's metadata_modified. Each run only serializes the datasets that are
+new, or have been changed (according to metadata_modified or the revision
+tables) since the previous run, and then stitches the cached parts together
+into the dump files. It also writes:
+
+ * a delta file, listing the datasets changed and deleted since the previous
+   run, for consumers who want to keep their copy up to date
+ * a manifest, listing the dump files with their sizes and md5 sums
+
+e.g.
+    IncrementalDump(cache_dir).run(dump_dir, 'data.gov.uk-ckan-meta-data-2015-01-01',
+                                   ['json', 'csv', 'unpublished.csv'])
+'''
+import anydbm
+import csv
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+import zipfile
+from cStringIO import StringIO
+
+from sqlalchemy import func
+
+from ckan import model
+from ckanext.dgu.lib import publisher_tree
+from ckanext.dgu.lib.dumper import (CSVDumper, ZipEntryWriter,
+                                    DATASET_COLUMNS, RESOURCE_COLUMNS)
+from ckanext.dgu.lib.inventory import unpublished_row, UNPUBLISHED_COLUMNS
+
+log = logging.getLogger(__name__)
+
+LATEST_BASE = 'data.gov.uk-ckan-meta-data-latest'
+
+# Datasets with a revision to their fields, resources, extras, tags or group
+# memberships since the previous run.
+CHANGED_SINCE_SQL = '''
+    SELECT id FROM package_revision WHERE revision_timestamp > :since
+    UNION
+    SELECT rg.package_id FROM resource_revision AS r
+        JOIN resource_group AS rg ON rg.id = r.resource_group_id
+        WHERE r.revision_timestamp > :since
+    UNION
+    SELECT package_id FROM package_extra_revision
+        WHERE revision_timestamp > :since
+    UNION
+    SELECT package_id FROM package_tag_revision
+        WHERE revision_timestamp > :since
+    UNION
+    SELECT table_id FROM member_revision
+        WHERE table_name = 'package' AND revision_timestamp > :since;'''
+
+# Organizations whose title or place in the tree has changed since the
+# previous run, which appear in the CSV rows of their datasets.
+CHANGED_ORGS_SQL = '''
+    SELECT id FROM group_revision WHERE revision_timestamp > :since
+    UNION
+    SELECT table_id FROM member_revision
+        WHERE table_name = 'group' AND revision_timestamp > :since;'''
+
+
+class DumpCache(object):
+    '''The serialized part of a dump for each dataset, stored in a dbm file
+    keyed by dataset id.'''
+    def __init__(self, filepath):
+        self.db = anydbm.open(filepath, 'c')
+
+    def get(self, pkg_id, metadata_modified):
+        '''Returns the cached part, or None if there is none for this
+        metadata_modified.'''
+        try:
+            value = self.db[str(pkg_id)]
+        except KeyError:
+            return None
+        modified, part = value.split('\n', 1)
+        if modified != metadata_modified:
+            return None
+        return part
+
+    def set(self, pkg_id, metadata_modified, part):
+        self.db[str(pkg_id)] = '%s\n%s' % (metadata_modified, part)
+
+    def delete(self, pkg_id):
+        del self.db[str(pkg_id)]
+
+    def ids(self):
+        return self.db.keys()
+
+    def close(self):
+        self.db.close()
+
+
+class DumpPart(object):
+    '''A file in a dump, made of a header, then each dataset's part, then a
+    footer.'''
+    name = None
+    header = ''
+    separator = ''
+    footer = ''
+    public_only = False
+
+    def serialize(self, pkg_ids):
+        '''Returns the part of the file for each dataset, as
+        {pkg_id: str}. Datasets that don't appear in the file are given an
+        empty string.'''
+        raise NotImplementedError
+
+
+class JsonPart(DumpPart):
+    '''The list of pkg.as_dict(), as written by ckan.lib.dumper.'''
+    name = 'json'
+    header = '[\n'
+    separator = ',\n'
+    footer = '\n]\n'
+
+    def serialize(self, pkg_ids):
+        return dict((pkg.id, json.dumps(pkg.as_dict(), indent=4))
+                    for pkg in model.Session.query(model.Package)
+                    .filter(model.Package.id.in_(pkg_ids)))
+
+
+class CsvPart(DumpPart):
+    '''datasets.csv or resources.csv, as written by CSVDumper.'''
+    public_only = True
+
+    def __init__(self, name, columns, rows_by_package):
+        self.name = name
+        self.dumper = CSVDumper()
+        self.header = self.dumper.to_csv([columns])
+        self.rows_by_package = rows_by_package
+
+    def serialize(self, pkg_ids):
+        rows = getattr(self.dumper, self.rows_by_package)(pkg_ids)
+        return dict((pkg_id, self.dumper.to_csv(rows.get(pkg_id, [])))
+                    for pkg_id in pkg_ids)
+
+
+class UnpublishedPart(DumpPart):
+    '''The unpublished datasets, as written by inventory.unpublished_dumper'''
+    name = 'unpublished.csv'
+
+    def __init__(self):
+        self.header = self._to_csv([UNPUBLISHED_COLUMNS])
+
+    def _to_csv(self, rows):
+        buf = StringIO()
+        writer = csv.writer(buf)
+        for row in rows:
+            writer.writerow(row)
+        return buf.getvalue()
+
+    def serialize(self, pkg_ids):
+        parts = {}
+        for pkg in model.Session.query(model.Package)\
+                .filter(model.Package.id.in_(pkg_ids)):
+            row = unpublished_row(pkg)
+            parts[pkg.id] = self._to_csv([row]) if row else ''
+        return parts
+
+
+# The dumps that can be made: {file_type: (parts, zip_only)}. A zip_only dump
+# has all its parts in the one zip. Otherwise there is just one part, and it
+# is written as a zip and as a gzip.
+DUMPS = {
+    'json': (lambda: [JsonPart()], False),
+    'csv': (lambda: [CsvPart('datasets.csv', DATASET_COLUMNS,
+                             'dataset_rows_by_package'),
+                     CsvPart('resources.csv', RESOURCE_COLUMNS,
+                             'resource_rows_by_package')], True),
+    'unpublished.csv': (lambda: [UnpublishedPart()], False),
+    }
+
+
+class IncrementalDump(object):
+    def __init__(self, cache_dir, batch_size=500):
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.state_filepath = os.path.join(cache_dir, 'state.json')
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def load_state(self):
+        if not os.path.exists(self.state_filepath):
+            return {}
+        with open(self.state_filepath) as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        tmp_filepath = self.state_filepath + '.tmp'
+        with open(tmp_filepath, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_filepath, self.state_filepath)
+
+    def current_datasets(self):
+        '''Returns the active datasets in name order, as a list of
+        (id, name, metadata_modified, private, owner_org).'''
+        return [(id_, name,
+                 metadata_modified.isoformat() if metadata_modified else '',
+                 private, owner_org)
+                for id_, name, metadata_modified, private, owner_org in
+                model.Session.query(model.Package.id, model.Package.name,
+                                    model.Package.metadata_modified,
+                                    model.Package.private,
+                                    model.Package.owner_org)
+                .filter(model.Package.state == 'active')
+                .order_by(model.Package.name)]
+
+    def changed_since(self, since):
+        '''Returns the ids of datasets with revisions after the given
+        timestamp, including those of organizations that have changed.'''
+        params = {'since': since}
+        changed = set(row[0] for row in
+                      model.Session.execute(CHANGED_SINCE_SQL, params))
+        org_ids = set()
+        for (org_id,) in model.Session.execute(CHANGED_ORGS_SQL, params):
+            # sub-publishers show this one as their top level organization
+            org_ids.update(publisher_tree.descendant_ids(org_id))
+        if org_ids:
+            changed.update(row[0] for row in
+                           model.Session.query(model.Package.id)
+                           .filter(model.Package.owner_org.in_(org_ids)))
+        return changed
+
+    def run(self, dump_dir, dump_file_base, file_types, full=False):
+        '''Writes the dumps of the given file_types (keys of DUMPS) into
+        dump_dir, plus the delta and manifest files. Returns the filepaths
+        written.
+
+        full - ignore the revisions and serialize any dataset not in the
+               cache for its current metadata_modified
+        '''
+        start = time.time()
+        state = self.load_state()
+        # Take the high water mark before reading any datasets, so that
+        # nothing committed during the run is missed next time.
+        revision_timestamp = model.Session.query(
+            func.max(model.Revision.timestamp)).scalar()
+        datasets = self.current_datasets()
+
+        since = state.get('revision_timestamp')
+        if since and not full:
+            changed = self.changed_since(since)
+        else:
+            changed = set()
+        log.info('Incremental dump: %s datasets, %s with revisions since %s',
+                 len(datasets), len(changed), since)
+
+        dumps = [(file_type, DUMPS[file_type][0](), DUMPS[file_type][1])
+                 for file_type in file_types]
+        parts = [part for file_type, parts_, zip_only in dumps
+                 for part in parts_]
+        caches = dict((part.name, DumpCache(
+            os.path.join(self.cache_dir, '%s.db' % part.name)))
+            for part in parts)
+        try:
+            serialized_ids = self.update_caches(datasets, changed, parts,
+                                                caches)
+            deleted_ids = self.remove_deleted(datasets, caches)
+            filepaths = []
+            for file_type, parts_, zip_only in dumps:
+                filepaths += self.write_dump(dump_dir, dump_file_base,
+                                             file_type, parts_, zip_only,
+                                             datasets, caches)
+        finally:
+            for cache in caches.values():
+                cache.close()
+
+        delta_filepath = os.path.join(dump_dir,
+                                      '%s.delta.json' % dump_file_base)
+        datasets_by_id = dict((dataset[0], dataset) for dataset in datasets)
+        with open(delta_filepath, 'w') as f:
+            json.dump({
+                'since': since,
+                'until': revision_timestamp.isoformat()
+                         if revision_timestamp else None,
+                'changed': [{'id': id_, 'name': datasets_by_id[id_][1],
+                             'metadata_modified': datasets_by_id[id_][2]}
+                            for id_ in sorted(serialized_ids)],
+                'deleted': sorted(deleted_ids),
+                }, f, indent=2)
+        filepaths.append(delta_filepath)
+        filepaths.append(self.write_manifest(dump_dir, dump_file_base,
+                                             filepaths, len(datasets)))
+        for filepath in filepaths[-2:]:
+            self.link_latest(dump_dir, filepath, dump_file_base)
+
+        if revision_timestamp:
+            state['revision_timestamp'] = revision_timestamp.isoformat()
+        self.save_state(state)
+        log.info('Incremental dump took %.1fs: %s datasets serialized, '
+                 '%s deleted', time.time() - start, len(serialized_ids),
+                 len(deleted_ids))
+        return filepaths
+
+    def update_caches(self, datasets, changed, parts, caches):
+        '''Serializes the datasets that are changed or missing from the
+        caches. Returns their ids.'''
+        stale_ids = {}  # {part_name: [pkg_id, ...]}
+        for id_, name, metadata_modified, private, owner_org in datasets:
+            for part in parts:
+                if id_ in changed or caches[part.name].get(
+                        id_, metadata_modified) is None:
+                    stale_ids.setdefault(part.name, []).append(id_)
+        metadata_modified_by_id = dict((dataset[0], dataset[2])
+                                       for dataset in datasets)
+        private_ids = set(dataset[0] for dataset in datasets if dataset[3])
+
+        serialized_ids = set()
+        for part in parts:
+            pkg_ids = stale_ids.get(part.name, [])
+            log.info('Serializing %s datasets for %s', len(pkg_ids),
+                     part.name)
+            for i in xrange(0, len(pkg_ids), self.batch_size):
+                batch = pkg_ids[i:i + self.batch_size]
+                if part.public_only:
+                    public_batch = [id_ for id_ in batch
+                                    if id_ not in private_ids]
+                    serialized = part.serialize(public_batch) \
+                        if public_batch else {}
+                else:
+                    serialized = part.serialize(batch)
+                for id_ in batch:
+                    caches[part.name].set(id_, metadata_modified_by_id[id_],
+                                          serialized.get(id_, ''))
+                serialized_ids.update(batch)
+                # don't let the session grow with every batch
+                model.Session.remove()
+        return serialized_ids
+
+    def remove_deleted(self, datasets, caches):
+        '''Removes datasets that are no longer active from the caches.
+        Returns their ids.'''
+        current_ids = set(str(dataset[0]) for dataset in datasets)
+        deleted_ids = set()
+        for cache in caches.values():
+            for id_ in cache.ids():
+                if id_ not in current_ids:
+                    cache.delete(id_)
+                    deleted_ids.add(id_)
+        return deleted_ids
+
+    def write_dump(self, dump_dir, dump_file_base, file_type, parts,
+                   zip_only, datasets, caches):
+        '''Stitches the cached parts into the dump file(s) and links them
+        as the latest. Returns the filepaths.'''
+        dump_filename = '%s.%s' % (dump_file_base, file_type)
+        zip_filepath = os.path.join(dump_dir, dump_filename + '.zip')
+        filepaths = [zip_filepath]
+        zip_file = zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            for part in parts:
+                outputs = [ZipEntryWriter(
+                    zip_file, part.name if zip_only else dump_filename)]
+                if not zip_only:
+                    gz_filepath = os.path.join(dump_dir, dump_filename + '.gz')
+                    filepaths.append(gz_filepath)
+                    outputs.append(gzip.open(gz_filepath, 'wb'))
+                self.write_part(part, datasets, caches[part.name], outputs)
+                for output in outputs:
+                    output.close()
+        finally:
+            zip_file.close()
+        for filepath in filepaths:
+            self.link_latest(dump_dir, filepath, dump_file_base)
+        return filepaths
+
+    def write_part(self, part, datasets, cache, outputs):
+        def write(data):
+            for output in outputs:
+                output.write(data)
+        write(part.header)
+        first = True
+        for id_, name, metadata_modified, private, owner_org in datasets:
+            data = cache.get(id_, metadata_modified)
+            if not data:
+                continue
+            if not first:
+                write(part.separator)
+            write(data)
+            first = False
+        write(part.footer)
+
+    def write_manifest(self, dump_dir, dump_file_base, filepaths,
+                       num_datasets):
+        files = []
+        for filepath in filepaths:
+            md5 = hashlib.md5()
+            with open(filepath, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                    md5.update(chunk)
+            files.append({'filename': os.path.basename(filepath),
+                          'size': os.path.getsize(filepath),
+                          'md5': md5.hexdigest()})
+        manifest_filepath = os.path.join(dump_dir,
+                                         '%s.manifest.json' % dump_file_base)
+        with open(manifest_filepath, 'w') as f:
+            json.dump({'created': datetime.datetime.now().isoformat(),
+                       'num_datasets': num_datasets,
+                       'files': files}, f, indent=2)
+        return manifest_filepath
+
+    def link_latest(self, dump_dir, filepath, dump_file_base):
+        '''Sets up a symbolic link to the file from
+        data.gov.uk-ckan-meta-data-latest.* so that it is up-to-date.'''
+        link_filepath = os.path.join(
+            dump_dir,
+            os.path.basename(filepath).replace(dump_file_base, LATEST_BASE))
+        if os.path.lexists(link_filepath):
+            os.unlink(link_filepath)
+        os.symlink(filepath, link_filepath)
@@ -20,10 +20,27 @@ The processing function should have the following signature:
 and should return nothing. If a failure occurs then the function should raise
 a IngestException which accepts a message and whether the process should
 attempt to continue of fail immediately.
+
+If process is given a batch_size then the processor is instead passed a list
+of up to that many validated rows at a time, so that it can look up what it
+needs for them together and commit once per batch:
+
+    def processor(rows)
+
+Each row is a Row - a list of the cell values, read once, which can also be
+indexed by the column's header e.g. row['Department'].
+
+The rows are read and validated in a separate thread, a few batches ahead of
+the processor, so that reading the file overlaps with the processor's writes
+to the database.
 """
 import logging
 import messytables
 import os
+import Queue
+import sys
+import threading
+import time
 
 log = logging.getLogger(__name__)
 
@@ -38,8 +55,35 @@ class IngestException(Exception):
         super(IngestException,self).__init__(err_message)
 
 
+class Row(list):
+    """
+    The values of a row's cells. As well as by position, a value can be got by
+    its column's header e.g. row['Department'] or row.get('Further notes').
+    """
+    __slots__ = ('number', 'columns')
+
+    def __init__(self, values, number=None, columns=None):
+        super(Row, self).__init__(values)
+        self.number = number
+        self.columns = columns or {}  # header:index
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            key = self.columns[key]
+        return list.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, IndexError):
+            return default
+
+
 class Ingester(object):
 
+    # batches read ahead of the processor
+    prefetch = 4
+
     def __init__(self, filename):
         """
         When provided with a filename (to a CSV, XLS, or XLSX) the constructor
@@ -47,64 +91,152 @@ class Ingester(object):
         process it.
         """
         self.tableset = None
+        # seconds spent in each stage of the last process()
+        self.timings = {'parse': 0.0, 'validate': 0.0, 'process': 0.0}
 
         try:
             _, ext = os.path.splitext( filename )
-            self.tableset = messytables.any_tableset(open(filename, 'r'),
+            # binary, as XLS and XLSX are read from it by offset
+            self.tableset = messytables.any_tableset(open(filename, 'rb'),
                 extension=ext[1:])
         except Exception, e:
             if str(e) == "Unrecognized MIME type: text/plain":
                 # Attempt to force the load as a CSV file to work around messytables
                 # not recognising text/plain
-                self.tableset = messytables.any_tableset(filename, mimetype="text/csv")
+                self.tableset = messytables.any_tableset(open(filename, 'rb'),
+                                                         mimetype="text/csv")
             else:
                 log.exception(e)
                 raise Exception(u"Failed to load the file at {0}".format(filename))
 
-    def process(self, processor, header_validator=None, row_validator=None):
+    def process(self, processor, header_validator=None, row_validator=None,
+                batch_size=None):
         """
         This method will iterate through the tabular data (in the first table/sheet)
         and after running any validators (on headers, and each row) will attempt to
         use the user-supplied processor to handle each row.
+
+        If batch_size is given, the processor is passed a list of up to that
+        many rows at a time.
         """
-        first = True
         count = 0
+        start = time.time()
+        self.timings = dict.fromkeys(self.timings, 0.0)
 
-        for row in self.tableset.tables[0]:
-
-            raw_row = [x.value for x in row]
-            if first:
-                # Process the validation of the header row if we have
-                # been given a validator
-                first = False
-
-                if header_validator:
-                    ok,err = header_validator(raw_row)
-                    if not ok:
-                        raise IngestException(err,False)
-            else:
-                # If the entire row is empty, then we should probably stop
-                # processing and explain why but this will then not handle
-                # blank rows in the middle of the table. We will raise an
-                # exception in this case so that the processor() can decide
-                # how to notify the user.
-                if not any(raw_row):
-                    raise IngestException("Encountered a blank row in the table")
-
-                # Process the individual rows in the file
-                if row_validator:
-                    ok,err = row_validator(raw_row)
-                    if not ok:
-                        raise IngestException(err,False)
-
-                # Pass
+        batches = self._read_batches(header_validator, row_validator,
+                                     batch_size or 1)
+        try:
+            for batch in batches:
+                process_start = time.time()
                 try:
-                    processor(raw_row)
-                    count = count + 1
+                    if batch_size:
+                        processor(batch)
+                    else:
+                        processor(batch[0])
+                    count = count + len(batch)
                 except IngestException, ie:
                     if ie.should_continue:
                         log.warning('Ingest error, but continuing: %s', ie)
                         continue
                     raise ie
+                finally:
+                    self.timings['process'] += time.time() - process_start
+        finally:
+            # stops the reading thread
+            batches.close()
+
+        log.info("Processed {0} rows in {1:.1f}s (parse {parse:.1f}s, "
+                 "validate {validate:.1f}s, process {process:.1f}s)".format(
+                     count, time.time() - start, **self.timings))
 
-        log.info("Processed {0} rows".format(count))
+    def _read_batches(self, header_validator, row_validator, batch_size):
+        """
+        Yields the validated rows in lists of batch_size. They are read in a
+        thread, up to `prefetch` batches ahead. An error reading or validating
+        a row is raised here when its batch is reached, so the rows before it
+        are still processed.
+        """
+        batches = Queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            # wait for room, unless process() has given up
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def read():
+            batch = []
+            exc_info = None
+            try:
+                for row in self._validated_rows(header_validator,
+                                                row_validator):
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        if not put((batch, None)):
+                            return
+                        batch = []
+            except Exception:
+                exc_info = sys.exc_info()
+            if batch and not put((batch, None)):
+                return
+            # the end, or the error that stopped the reading
+            put((None, exc_info))
+
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                batch, exc_info = batches.get()
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if batch is None:
+                    return
+                yield batch
+        finally:
+            stop.set()
+
+    def _validated_rows(self, header_validator, row_validator):
+        columns = None
+        parse_start = time.time()
+        for number, cells in enumerate(self.tableset.tables[0], 1):
+            row = Row([x.value for x in cells], number, columns)
+            self.timings['parse'] += time.time() - parse_start
+
+            validate_start = time.time()
+            if columns is None:
+                # Process the validation of the header row if we have
+                # been given a validator
+                columns = dict((header.strip(), i) for i, header in enumerate(row)
+                               if isinstance(header, basestring))
+
+                if header_validator:
+                    ok,err = header_validator(row)
+                    if not ok:
+                        raise IngestException(err,False)
+                self.timings['validate'] += time.time() - validate_start
+                parse_start = time.time()
+                continue
+
+            # If the entire row is empty, then we should probably stop
+            # processing and explain why but this will then not handle
+            # blank rows in the middle of the table. We will raise an
+            # exception in this case so that the processor() can decide
+            # how to notify the user.
+            if not any(row):
+                raise IngestException("Encountered a blank row in the table")
+
+            # Process the individual rows in the file
+            if row_validator:
+                ok,err = row_validator(row)
+                if not ok:
+                    raise IngestException(err,False)
+            self.timings['validate'] += time.time() - validate_start
+
+            yield row
+            parse_start = time.time()
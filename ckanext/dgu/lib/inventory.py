@@ -6,41 +6,52 @@ from ckanext.dgu.plugins_toolkit import (c, NotAuthorized,
     ValidationError, get_action, check_access)
 from ckan.lib.search import SearchIndexError
 
+UNPUBLISHED_COLUMNS = ["Name", "Description", "Department", "Publish date",
+                       "Release notes"]
+
 def unpublished_dumper(tmpfile, query):
     """ Dumps all of the unpublished items to the open tmpfile using the
         packages provided by query """
     import csv
-    import dateutil.parser
 
     writer = csv.writer(tmpfile)
-    writer.writerow(["Name", "Description", "Department", "Publish date", "Release notes"])
+    writer.writerow(UNPUBLISHED_COLUMNS)
     for pkg in query.yield_per(200):
-        if not pkg.extras.get('unpublished', False):
-            continue
-
-        org = pkg.get_organization()
-        if not org:
-            # This should not happen, but does appear in test data during development
-            grp = 'Unknown'
-        else:
-            grp = org.title
-
-
-        publish_date = pkg.extras.get('publish-date', '')
-        if publish_date:
-            try:
-                dt = dateutil.parser.parse(publish_date)
-                publish_date = dt.strftime('%d/%m/%Y')
-            except Exception, e:
-                publish_date = ""
-
-        row = [pkg.title.encode('utf-8')]
-        row.append(pkg.notes.encode('utf-8') or "")
-        row.append(grp)
-        row.append(publish_date)
-        row.append(pkg.extras.get('release-notes', '').encode('utf-8'))
+        row = unpublished_row(pkg)
+        if row:
+            writer.writerow(row)
 
-        writer.writerow(row)
+
+def unpublished_row(pkg):
+    """ Returns the unpublished dump row for the package, or None if it is
+        published """
+    import dateutil.parser
+
+    if not pkg.extras.get('unpublished', False):
+        return None
+
+    org = pkg.get_organization()
+    if not org:
+        # This should not happen, but does appear in test data during development
+        grp = 'Unknown'
+    else:
+        grp = org.title
+
+
+    publish_date = pkg.extras.get('publish-date', '')
+    if publish_date:
+        try:
+            dt = dateutil.parser.parse(publish_date)
+            publish_date = dt.strftime('%d/%m/%Y')
+        except Exception, e:
+            publish_date = ""
+
+    row = [pkg.title.encode('utf-8')]
+    row.append(pkg.notes.encode('utf-8') or "")
+    row.append(grp)
+    row.append(publish_date)
+    row.append(pkg.extras.get('release-notes', '').encode('utf-8'))
+    return row
 
 
 
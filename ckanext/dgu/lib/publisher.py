@@ -1,6 +1,9 @@
-from ckan import model
+import time
 import logging
 
+from ckan import model
+from ckanext.dgu.lib import publisher_tree
+
 log = logging.getLogger(__name__)
 
 def go_up_tree(publisher):
@@ -9,24 +12,155 @@ def go_up_tree(publisher):
 
     Essentially this is a slower version of Group.get_parent_group_hierarchy
     because it returns Group objects, rather than dicts. And it includes the
-    publisher you supply.
+    publisher you supply. The tree is fetched in one query by publisher_tree.
     '''
-    yield publisher
-    for parent in publisher.get_parent_groups(type='organization'):
-        for grandparent in go_up_tree(parent):
-            yield grandparent
+    for ancestor in publisher_tree.ancestors(publisher):
+        yield ancestor
 
 def go_down_tree(publisher):
     '''Provided with a publisher object, it walks down the hierarchy and yields
     each publisher, including the one you supply.
-   
+
     Essentially this is a slower version of Group.get_children_group_hierarchy
-    because it returns Group objects, rather than dicts.
+    because it returns Group objects, rather than dicts. The tree is fetched in
+    one query by publisher_tree.
     '''
-    yield publisher
-    for child in publisher.get_children_groups(type='organization'):
-        for grandchild in go_down_tree(child):
-            yield grandchild
+    for descendant in publisher_tree.descendants(publisher):
+        yield descendant
+
+class PublisherHierarchy(object):
+    '''An in-memory snapshot of every publisher's name, title, abbreviation
+    and parent, loaded with a handful of bulk queries.
+
+    Indexing a dataset needs the publisher's ancestry and abbreviation, which
+    otherwise costs a query per level of the tree for every dataset. Use
+    PublisherHierarchy.get() to share one snapshot across an indexing run. It
+    is dropped when a publisher is changed in this process (see
+    SearchPlugin.before_commit) and reloaded after max_age seconds in case
+    another process changed one. Use get_for() to also reload it early for a
+    publisher it doesn't know, which may have been created since.
+    '''
+    _snapshot = None
+    _missed = 0  # time it was last reloaded for an unknown publisher
+
+    def __init__(self, publishers, parent_ids):
+        # publishers: {id: {'id':, 'name':, 'title':, 'state':, 'abbreviation':}}
+        # parent_ids: {child_id: [parent_id, ...]}
+        self.publishers = publishers
+        self.parent_ids = parent_ids
+        self.id_by_name = dict((pub['name'], id_)
+                               for id_, pub in publishers.iteritems())
+        self.children_ids = {}
+        for child_id, parents in parent_ids.iteritems():
+            for parent_id in parents:
+                self.children_ids.setdefault(parent_id, []).append(child_id)
+        self.created = time.time()
+
+    @classmethod
+    def load(cls):
+        publishers = {}
+        for id_, name, title, state in model.Session.query(
+                model.Group.id, model.Group.name, model.Group.title,
+                model.Group.state) \
+                .filter(model.Group.type == 'organization'):
+            publishers[id_] = {'id': id_, 'name': name, 'title': title,
+                               'state': state, 'abbreviation': None}
+
+        abbreviations = model.Session.query(model.GroupExtra.group_id,
+                                            model.GroupExtra.value) \
+            .filter(model.GroupExtra.key == 'abbreviation') \
+            .filter(model.GroupExtra.state == 'active')
+        for group_id, abbreviation in abbreviations:
+            if group_id in publishers:
+                publishers[group_id]['abbreviation'] = abbreviation
+
+        parent_ids = {}
+        members = model.Session.query(model.Member.table_id,
+                                      model.Member.group_id) \
+            .filter(model.Member.table_name == 'group') \
+            .filter(model.Member.state == 'active')
+        for child_id, parent_id in members:
+            if child_id in publishers and parent_id in publishers:
+                parent_ids.setdefault(child_id, []).append(parent_id)
+
+        log.info('Loaded publisher hierarchy: %s publishers',
+                 len(publishers))
+        return cls(publishers, parent_ids)
+
+    @classmethod
+    def get(cls):
+        '''Returns the shared snapshot, loading it if it is missing or
+        older than dgu.publisher_hierarchy.max_age seconds.'''
+        from pylons import config
+        max_age = int(config.get('dgu.publisher_hierarchy.max_age', 300))
+        snapshot = cls._snapshot
+        if snapshot is None or time.time() - snapshot.created > max_age:
+            snapshot = cls._snapshot = cls.load()
+        return snapshot
+
+    @classmethod
+    def get_for(cls, id_or_name):
+        '''Returns the shared snapshot, like get(). If it doesn't know the
+        publisher then it is reloaded once first, unless it was loaded (or
+        reloaded for a miss) in the last
+        dgu.publisher_hierarchy.miss_interval seconds.'''
+        snapshot = cls.get()
+        if not id_or_name or snapshot.publisher(id_or_name):
+            return snapshot
+        from pylons import config
+        interval = int(config.get('dgu.publisher_hierarchy.miss_interval', 10))
+        now = time.time()
+        if now - max(snapshot.created, cls._missed) < interval:
+            return snapshot
+        cls._missed = now
+        log.info('Publisher %s not in the hierarchy - reloading it',
+                 id_or_name)
+        snapshot = cls._snapshot = cls.load()
+        return snapshot
+
+    @classmethod
+    def invalidate(cls):
+        cls._snapshot = None
+
+    def publisher(self, id_or_name):
+        '''Returns the dict for the publisher or None.'''
+        if id_or_name in self.publishers:
+            return self.publishers[id_or_name]
+        id_ = self.id_by_name.get(id_or_name)
+        return self.publishers[id_] if id_ else None
+
+    def ancestors(self, id_or_name):
+        '''Returns the publisher dict and then those of its parent,
+        grandparent etc. up to the top of the tree. Where a publisher has more
+        than one parent, only the first is followed.'''
+        publisher = self.publisher(id_or_name)
+        ancestors = []
+        while publisher is not None and publisher not in ancestors:
+            ancestors.append(publisher)
+            parent_ids = self.parent_ids.get(publisher['id'])
+            if not parent_ids:
+                break
+            if len(parent_ids) > 1:
+                log.warning('Publisher %s has more than one parent publisher. '
+                            'Ignoring all but the first. %r',
+                            publisher['name'], parent_ids)
+            publisher = self.publishers[parent_ids[0]]
+        return ancestors
+
+    def descendants(self, id_or_name):
+        '''Returns the ids of the publisher and all the publishers below it
+        in the tree.'''
+        publisher = self.publisher(id_or_name)
+        if not publisher:
+            return []
+        ids = [publisher['id']]
+        seen = set(ids)
+        for id_ in ids:
+            for child_id in self.children_ids.get(id_, []):
+                if child_id not in seen:
+                    seen.add(child_id)
+                    ids.append(child_id)
+        return ids
 
 def find_group_admins(group):
     '''Look for publisher admins up the tree'''
@@ -43,11 +177,15 @@ def find_group_admins(group):
 
 def cached_openness_scores(reports_to_run=None):
     """
-    This function is called by the ICachedReport plugin which will
-    iterate over all of the publishers and generate an openness score
-    for them on a regular basis
+    This function is called by the ICachedReport plugin and generates the
+    openness scores for every publisher, with and without sub-publishers, on
+    a regular basis.
+
+    The scores are counted for all publishers with one query and then added
+    up the publisher tree in memory.
     """
     import json
+    from collections import defaultdict
     from ckan.lib.json import DateTimeJsonEncoder
 
     local_reports = set(['openness-scores', 'openness-scores-withsub'])
@@ -57,25 +195,97 @@ def cached_openness_scores(reports_to_run=None):
     if not local_reports:
       return
 
-    publishers = model.Session.query(model.Group).\
-        filter(model.Group.type=='publisher').\
-        filter(model.Group.state=='active')
-
     log.info("Generating openness-scores report")
-    log.info("Fetching %d publishers" % publishers.count())
+    start_time = time.time()
+    hierarchy = PublisherHierarchy.load()
+    counts = openness_score_counts()
+    log.info("Counted openness scores of resources in %d publishers",
+             len(counts))
 
-    for publisher in publishers.all():
-        # Run the openness report with and without include_sub_organisations set
-        if 'openness-scores' in local_reports:
-          log.info("Generating openness scores for %s" % publisher.name)
-          val = openness_scores(publisher, use_cache=False)
-          model.DataCache.set(publisher.name, "openness-scores", json.dumps(val,cls=DateTimeJsonEncoder))
-
-        if 'openness-scores-withsub' in local_reports:
-          val = openness_scores(publisher, include_sub_publishers=True, use_cache=False)
-          model.DataCache.set(publisher.name, "openness-scores-withsub", json.dumps(val,cls=DateTimeJsonEncoder))
+    values = []
+    publishers = [pub for pub in hierarchy.publishers.values()
+                  if pub['state'] == 'active']
+    for publisher in publishers:
+        # With and without include_sub_organisations set
+        for include_sub_publishers in (False, True):
+            key = 'openness-scores'
+            if include_sub_publishers:
+                key = "".join([key, '-withsub'])
+            if key not in local_reports:
+                continue
+            if include_sub_publishers:
+                ids = hierarchy.descendants(publisher['id'])
+            else:
+                ids = [publisher['id']]
+            d = defaultdict(int)
+            for id_ in ids:
+                for score, count in counts.get(id_, {}).iteritems():
+                    d[score] += count
+            val = (sum(d.values()), d)
+            values.append((publisher['name'], key,
+                           json.dumps(val, cls=DateTimeJsonEncoder)))
 
+    set_data_cache(values)
     model.Session.commit()
+    log.info("Cached %d openness scores for %d publishers in %.1f seconds",
+             len(values), len(publishers), time.time() - start_time)
+
+def set_data_cache(values):
+    """
+    Stores many values in the DataCache at once, replacing any existing
+    ones. values is a list of (object_id, key, value) with each value already
+    serialized as JSON.
+    """
+    import datetime
+    from sqlalchemy.orm import class_mapper
+
+    if not values:
+        return
+    # the table that DataCache.get_fresh and the report's DataCache read
+    table = class_mapper(model.DataCache).mapped_table
+    model.Session.execute(
+        table.delete()
+        .where(table.c.key.in_(set(key for _, key, _ in values)))
+        .where(table.c.object_id.in_(
+            set(object_id for object_id, _, _ in values))))
+    created = datetime.datetime.now()
+    model.Session.execute(
+        table.insert(),
+        [{'object_id': object_id, 'key': key, 'value': value,
+          'created': created}
+         for object_id, key, value in values])
+
+def openness_score_counts(group_ids=None):
+    """
+        Counts the resources with each openness score, for each publisher
+        (not including their sub-publishers), in one query.
+
+        Returns {group_id: {'0': 3, '1': 0, '3': 10, ...}}
+    """
+    from collections import defaultdict
+
+    q = """SELECT M.group_id, TS.value::INT, count(TS.id) FROM task_status as TS
+           INNER JOIN resource as R ON R.id = TS.entity_id
+           INNER JOIN resource_group as RG ON RG.id = R.resource_group_id
+           INNER JOIN package as P ON P.id = RG.package_id
+           INNER JOIN member as M ON M.table_id = P.id
+           WHERE TS.task_type = 'qa' AND TS.entity_type = 'resource' AND
+                 TS.key = 'openness_score' AND
+                 P.state = 'active' AND R.state = 'active' AND
+                 M.table_name = 'package' AND M.state = 'active'
+                 {group_filter}
+           GROUP BY M.group_id, TS.value::INT;"""
+    params = {}
+    if group_ids is not None:
+        q = q.format(group_filter='AND M.group_id IN :group_ids')
+        params['group_ids'] = tuple(group_ids)
+    else:
+        q = q.format(group_filter='')
+
+    counts = defaultdict(lambda: defaultdict(int))
+    for group_id, score, count in model.Session.execute(q, params):
+        counts[group_id][str(score)] += count
+    return counts
 
 def openness_scores(publisher, include_sub_publishers=False, use_cache=True):
     """
@@ -107,18 +317,18 @@ def openness_scores(publisher, include_sub_publishers=False, use_cache=True):
                    INNER JOIN package as P ON P.id = RG.package_id
                    WHERE P.state = 'active' AND R.state='active' AND
                          P.id in (SELECT table_id FROM member
-                                  WHERE group_id in ({pub_id})
+                                  WHERE group_id in :pub_ids
                                   AND table_name='package' AND state='active')
                                  );"""
 
     d = defaultdict(int)
 
     if include_sub_publishers:
-        pubids = ["'%s'" % p.id for p in go_down_tree(publisher)]
+        pubids = publisher_tree.descendant_ids(publisher)
     else:
-        pubids = ["'%s'" % publisher.id]
+        pubids = [publisher.id]
 
-    for m in model.Session.execute(q.format(pub_id=','.join(pubids))):
+    for m in model.Session.execute(q, {'pub_ids': tuple(pubids)}):
         d[str(m[0])] += 1
     total = sum(d.values())
 
@@ -134,13 +344,176 @@ def resource_count(publisher, include_sub_publishers=False):
            INNER JOIN package as P ON P.id = RG.package_id
            WHERE P.state = 'active' AND R.state='active' AND
                  P.id in (SELECT table_id FROM member
-                          WHERE group_id IN ({pub_id})
+                          WHERE group_id IN :pub_ids
                           AND table_name='package' AND state='active');"""
 
     if include_sub_publishers:
-        pubids = ["'%s'" % p.id for p in go_down_tree(publisher)]
+        pubids = publisher_tree.descendant_ids(publisher)
     else:
-        pubids = ["'%s'" % publisher.id]
+        pubids = [publisher.id]
+
+    return model.Session.execute(q, {'pub_ids': tuple(pubids)}).scalar()
+
+def _count_by_group(sql, group_ids):
+    return dict(model.Session.execute(sql, {'group_ids': tuple(group_ids)}))
+
+def publisher_performance(publisher_ids=None, hierarchy=None):
+    """
+        Works out the traffic lights shown on the publisher read page for
+        the given publishers (default is all of them), both with and without
+        their sub-publishers. The counting is done with one grouped query
+        each for resources, broken links and openness scores.
+
+        Returns {publisher_id: {False: traffic_lights,
+                                True: traffic_lights_including_sub_publishers}}
+    """
+    from collections import defaultdict
+    from pylons import config
 
-    return model.Session.scalar(q.format(pub_id=','.join(pubids)))
+    hierarchy = hierarchy or PublisherHierarchy.get()
+    if publisher_ids is None:
+        publisher_ids = hierarchy.publishers.keys()
+    descendants = dict((id_, hierarchy.descendants(id_))
+                       for id_ in publisher_ids)
+    group_ids = set(sum(descendants.values(), []))
+    if not group_ids:
+        return {}
 
+    resources_sql = """
+        SELECT M.group_id, count(R.id) FROM resource as R
+        INNER JOIN resource_group as RG ON RG.id = R.resource_group_id
+        INNER JOIN package as P ON P.id = RG.package_id
+        INNER JOIN member as M ON M.table_id = P.id
+        WHERE P.state = 'active' AND R.state = 'active' AND
+              M.table_name = 'package' AND M.state = 'active' AND
+              M.group_id IN :group_ids
+        GROUP BY M.group_id;"""
+    resource_counts = _count_by_group(resources_sql, group_ids)
+
+    broken_sql = """
+        SELECT M.group_id, count(R.id) FROM archival as A
+        INNER JOIN resource as R ON R.id = A.resource_id
+        INNER JOIN resource_group as RG ON RG.id = R.resource_group_id
+        INNER JOIN package as P ON P.id = RG.package_id
+        INNER JOIN member as M ON M.table_id = P.id
+        WHERE P.state = 'active' AND R.state = 'active' AND
+              A.is_broken = true AND
+              M.table_name = 'package' AND M.state = 'active' AND
+              M.group_id IN :group_ids
+        GROUP BY M.group_id;"""
+    broken_counts = _count_by_group(broken_sql, group_ids)
+
+    openness_counts = openness_score_counts(group_ids)
+
+    categories = dict(
+        model.Session.query(model.GroupExtra.group_id, model.GroupExtra.value)
+        .filter(model.GroupExtra.key == 'category')
+        .filter(model.GroupExtra.state == 'active')
+        .filter(model.GroupExtra.group_id.in_(publisher_ids)))
+
+    issues_enabled = 'issues' in config.get('ckan.plugins', '')
+    if issues_enabled:
+        from ckanext.issues.lib import util
+
+    performance = {}
+    for publisher_id in publisher_ids:
+        issues = 'green'
+        if issues_enabled:
+            # If issues are installed then we can use the info to determine
+            # whether the issues are older than a month, between a fortnight
+            # and a month, or less than a fortnight.
+            publisher = model.Group.get(publisher_id)
+            if util.old_unresolved(publisher, days=30):
+                issues = 'red'
+            elif util.old_unresolved(publisher, days=14):
+                issues = 'amber'
+
+        spending = 'green'
+        if categories.get(publisher_id) == 'ministerial-department':
+            spending = 'red'
+
+        performance[publisher_id] = {}
+        for include_sub_publishers in (False, True):
+            ids = descendants[publisher_id] if include_sub_publishers \
+                else [publisher_id]
+            counters = defaultdict(int)
+            for id_ in ids:
+                for score, count in openness_counts[id_].iteritems():
+                    counters[score] += count
+            performance[publisher_id][include_sub_publishers] = \
+                performance_traffic_lights(
+                    resource_count=sum(resource_counts.get(id_, 0)
+                                       for id_ in ids),
+                    broken_count=sum(broken_counts.get(id_, 0)
+                                     for id_ in ids),
+                    openness_counters=counters,
+                    issues=issues, spending=spending)
+    return performance
+
+def performance_traffic_lights(resource_count, broken_count,
+                               openness_counters, issues, spending):
+    """
+        Returns the traffic lights for a publisher, given the counts of its
+        resources.
+
+        broken_links - green = 0%, amber <= 60% broken links, red > 60% broken
+        openness - green if all > 4 *, amber for 50%> 3*, red otherwise
+    """
+    if broken_count == 0 or resource_count == 0:
+        pct = 0
+    else:
+        pct = int(100 * float(broken_count)/float(resource_count))
+
+    broken_links = 'green'
+    if 1 < pct <= 60:
+        broken_links = 'amber'
+    elif pct > 60:
+        broken_links = 'red'
+
+    total = sum(openness_counters.values())
+    number_x_or_above = lambda x: sum(openness_counters.get(str(c),0) for c in xrange(x, 6))
+
+    above_3 = number_x_or_above(3)
+    pct_above_3 = int(100 * float(total)/float(above_3)) if above_3 else 0
+
+    if number_x_or_above(4) == total:
+        openness = 'green'
+    elif pct_above_3 >= 50:
+        openness = 'amber'
+    else:
+        openness = 'red'
+
+    return {
+        'broken_links': broken_links,
+        'openness': openness,
+        'issues': issues,
+        'spending': spending
+    }
+
+def performance_cache_key(include_sub_publishers):
+    key = 'publisher-performance'
+    if include_sub_publishers:
+        key = "".join([key, '-withsub'])
+    return key
+
+def cached_publisher_performance():
+    """
+    Calculates the performance traffic lights for every publisher, with and
+    without sub-publishers, and stores them in the DataCache for the
+    publisher read page. Run nightly by gov_daily.py.
+    """
+    import json
+
+    start_time = time.time()
+    hierarchy = PublisherHierarchy.load()
+    performance = publisher_performance(hierarchy=hierarchy)
+    values = []
+    for publisher_id, lights in performance.iteritems():
+        name = hierarchy.publishers[publisher_id]['name']
+        for include_sub_publishers in (False, True):
+            values.append((name, performance_cache_key(include_sub_publishers),
+                           json.dumps(lights[include_sub_publishers])))
+    set_data_cache(values)
+    model.Session.commit()
+    log.info('Cached performance of %s publishers in %.1f seconds',
+             len(performance), time.time() - start_time)
@@ -0,0 +1,135 @@
+'''
+Walks the publisher tree with one recursive SQL query per publisher, rather
+than a query per publisher in the tree.
+
+The results are cached in the process until the member or group tables
+change, which is checked at most every dgu.publisher_tree.check_interval
+seconds. Requires PostgreSQL.
+'''
+import logging
+import threading
+import time
+
+from ckan import model
+
+log = logging.getLogger(__name__)
+
+DESCENDANTS_SQL = '''
+    WITH RECURSIVE tree(id, depth, path) AS (
+        SELECT g.id, 0, ARRAY[g.id] FROM "group" as g WHERE g.id = :id
+      UNION ALL
+        SELECT M.table_id, tree.depth + 1, tree.path || M.table_id
+        FROM tree
+        INNER JOIN member as M ON M.group_id = tree.id
+        INNER JOIN "group" as g ON g.id = M.table_id
+        WHERE M.table_name = 'group' AND M.state = 'active' AND
+              g.type = 'organization' AND g.state = 'active' AND
+              NOT M.table_id = ANY(tree.path)
+    )
+    SELECT id FROM tree ORDER BY depth;'''
+
+ANCESTORS_SQL = '''
+    WITH RECURSIVE tree(id, depth, path) AS (
+        SELECT g.id, 0, ARRAY[g.id] FROM "group" as g WHERE g.id = :id
+      UNION ALL
+        SELECT M.group_id, tree.depth + 1, tree.path || M.group_id
+        FROM tree
+        INNER JOIN member as M ON M.table_id = tree.id
+        INNER JOIN "group" as g ON g.id = M.group_id
+        WHERE M.table_name = 'group' AND M.state = 'active' AND
+              g.type = 'organization' AND g.state = 'active' AND
+              NOT M.group_id = ANY(tree.path)
+    )
+    SELECT id FROM tree ORDER BY depth;'''
+
+# Rows inserted, updated or deleted in the member and group tables since the
+# stats were last reset. Any change to the tree changes this number.
+CHANGE_COUNTER_SQL = '''
+    SELECT sum(n_tup_ins + n_tup_upd + n_tup_del) FROM pg_stat_user_tables
+    WHERE relname IN ('member', 'group');'''
+
+_cache = {}  # {(direction, publisher_id): [publisher_id, ...]}
+_cache_counter = None
+_checked = 0  # time the change counter was last checked
+_lock = threading.Lock()
+
+
+def change_counter():
+    return model.Session.execute(CHANGE_COUNTER_SQL).scalar()
+
+def invalidate():
+    '''Empties the cache. Called when this process changes a publisher, since
+    the table stats are only updated after a short delay.'''
+    global _cache_counter, _checked
+    with _lock:
+        _cache.clear()
+        _cache_counter = None
+        _checked = 0
+
+def _tree_ids(sql, direction, publisher_id):
+    global _cache_counter, _checked
+    from pylons import config
+    check_interval = int(config.get('dgu.publisher_tree.check_interval', 60))
+    key = (direction, publisher_id)
+    with _lock:
+        check = time.time() - _checked >= check_interval
+        counter = _cache_counter
+    if check:
+        counter = change_counter()
+    with _lock:
+        if check:
+            _checked = time.time()
+        if counter != _cache_counter:
+            _cache.clear()
+            _cache_counter = counter
+        elif key in _cache:
+            return _cache[key]
+    ids = []
+    for (id_,) in model.Session.execute(sql, {'id': publisher_id}):
+        if id_ not in ids:
+            ids.append(id_)
+    with _lock:
+        if counter == _cache_counter:
+            _cache[key] = ids
+    return ids
+
+def descendant_ids(publisher):
+    '''Returns the ids of the publisher and all publishers below it in the
+    tree, nearest first.
+
+    publisher can be a Group or its id.
+    '''
+    publisher_id = getattr(publisher, 'id', publisher)
+    return list(_tree_ids(DESCENDANTS_SQL, 'down', publisher_id))
+
+def ancestor_ids(publisher):
+    '''Returns the ids of the publisher, its parent, grandparent etc. up to
+    the top of the tree.
+
+    publisher can be a Group or its id.
+    '''
+    publisher_id = getattr(publisher, 'id', publisher)
+    return list(_tree_ids(ANCESTORS_SQL, 'up', publisher_id))
+
+def _groups(ids):
+    if not ids:
+        return []
+    groups = dict((group.id, group) for group in
+                  model.Session.query(model.Group)
+                  .filter(model.Group.id.in_(ids)))
+    return [groups[id_] for id_ in ids if id_ in groups]
+
+def descendants(publisher):
+    '''Returns the publisher and all publishers below it in the tree, as
+    Group objects.'''
+    return _groups(descendant_ids(publisher))
+
+def ancestors(publisher):
+    '''Returns the publisher, its parent, grandparent etc. up to the top of
+    the tree, as Group objects.'''
+    return _groups(ancestor_ids(publisher))
+
+def top_level(publisher):
+    '''Returns the publisher at the top of the tree that this one is in,
+    which may be itself.'''
+    return ancestors(publisher)[-1]
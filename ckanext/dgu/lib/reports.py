@@ -2,14 +2,16 @@ import collections
 import datetime
 import logging
 import os
+import time
 
 from paste.deploy.converters import asbool
+from sqlalchemy import func, and_
 
 from ckan import model
 from ckan.lib.helpers import OrderedDict
 import ckan.plugins as p
 from ckanext.report import lib
-from ckanext.dgu.lib.publisher import go_up_tree
+from ckanext.dgu.lib import publisher_tree
 from ckanext.dgu.lib import helpers as dgu_helpers
 
 log = logging.getLogger(__name__)
@@ -271,104 +273,208 @@ def publisher_activity(organization, include_sub_organizations=False):
                 'period': period_iso}
 
 
+# These are the authors whose revisions we ignore, as they are trivial
+# changes. NB we do want to know about revisions by:
+# * harvest (harvested metadata)
+# * dgu (NS Stat Hub imports)
+# * Fix national indicators
+SYSTEM_AUTHORS = ('autotheme', 'co-prod3.dh.bytemark.co.uk',
+                  'Date format tidier', 'current_revision_fixer',
+                  'current_revision_fixer2', 'fix_contact_details.py',
+                  'Repoint 410 Gone to webarchive url',
+                  'Fix duplicate resources',
+                  'fix_secondary_theme.py',
+                  )
+SYSTEM_AUTHOR_TEMPLATE = 'script%'  # "%" is a wildcard
+
+
+class PublisherActivity(object):
+    '''The creation and modification of every dataset in the given periods.
+
+    The revisions are fetched with one query per revision table for the whole
+    time window, and then bucketed by dataset and period in memory, so that
+    the activity of any organization can be picked out without more queries.
+    Only plain values are kept, not Package objects, as it is shared between
+    requests.
+    '''
+    def __init__(self, periods):
+        # periods: {period_name: (start_datetime, end_datetime)}
+        self.periods = periods
+        self.created = {}  # {pkg_id: (name, title, timestamp, author)}
+        self.modified = collections.defaultdict(dict)
+            # {pkg_id: {period_name: (set(authors), set(dates))}}
+        self.packages = {}  # {pkg_id: (name, title, notes)}
+        self.pkg_ids_by_org = collections.defaultdict(list)
+        self.unpublished_pkg_ids = set()
+        self.load()
+
+    def _filter_authors(self, query):
+        return query.filter(~model.Revision.author.in_(SYSTEM_AUTHORS)) \
+                    .filter(~model.Revision.author.like(SYSTEM_AUTHOR_TEMPLATE))
+
+    def load(self):
+        window_start = min(period[0] for period in self.periods.values())
+        window_end = max(period[1] for period in self.periods.values())
+
+        # Datasets created in the window (first revision by anyone)
+        first_revisions = model.Session.query(
+                model.PackageRevision.id.label('id'),
+                func.min(model.PackageRevision.revision_timestamp).label('timestamp'))\
+            .group_by(model.PackageRevision.id)\
+            .having(func.min(model.PackageRevision.revision_timestamp) > window_start)\
+            .subquery()
+        creations = model.Session.query(
+                model.PackageRevision.id, model.PackageRevision.name,
+                model.PackageRevision.title,
+                model.PackageRevision.revision_timestamp,
+                model.Revision.author)\
+            .join(first_revisions,
+                  and_(model.PackageRevision.id == first_revisions.c.id,
+                       model.PackageRevision.revision_timestamp ==
+                       first_revisions.c.timestamp))\
+            .join(model.Revision,
+                  model.Revision.id == model.PackageRevision.revision_id)
+        for pkg_id, name, title, timestamp, author in creations:
+            if pkg_id not in self.created:
+                self.created[pkg_id] = (name, title, timestamp, author)
+
+        # Modifications to the datasets and their resources and extras
+        pr_q = model.Session.query(
+                model.PackageRevision.id,
+                model.PackageRevision.revision_timestamp,
+                model.Revision.author, model.Revision.timestamp)\
+            .join(model.Revision,
+                  model.Revision.id == model.PackageRevision.revision_id)\
+            .filter(model.PackageRevision.state == 'active')\
+            .filter(model.PackageRevision.revision_timestamp > window_start)\
+            .filter(model.PackageRevision.revision_timestamp < window_end)
+        rr_q = model.Session.query(
+                model.Package.id,
+                model.ResourceRevision.revision_timestamp,
+                model.Revision.author, model.Revision.timestamp)\
+            .join(model.ResourceGroup,
+                  model.ResourceGroup.package_id == model.Package.id)\
+            .join(model.ResourceRevision,
+                  model.ResourceGroup.id == model.ResourceRevision.resource_group_id)\
+            .join(model.Revision,
+                  model.Revision.id == model.ResourceRevision.revision_id)\
+            .filter(model.Package.state == 'active')\
+            .filter(model.ResourceRevision.revision_timestamp > window_start)\
+            .filter(model.ResourceRevision.revision_timestamp < window_end)
+        pe_q = model.Session.query(
+                model.Package.id,
+                model.PackageExtraRevision.revision_timestamp,
+                model.Revision.author, model.Revision.timestamp)\
+            .join(model.PackageExtraRevision,
+                  model.Package.id == model.PackageExtraRevision.package_id)\
+            .join(model.Revision,
+                  model.Revision.id == model.PackageExtraRevision.revision_id)\
+            .filter(model.Package.state == 'active')\
+            .filter(model.PackageExtraRevision.revision_timestamp > window_start)\
+            .filter(model.PackageExtraRevision.revision_timestamp < window_end)
+        for q in (pr_q, rr_q, pe_q):
+            for pkg_id, revision_timestamp, author, timestamp in \
+                    self._filter_authors(q):
+                self._add_modification(pkg_id, revision_timestamp,
+                                       author, timestamp)
+
+        # Details of the datasets with any activity
+        pkg_ids = set(self.created) | set(self.modified)
+        if pkg_ids:
+            for pkg in model.Session.query(model.Package)\
+                    .filter(model.Package.id.in_(pkg_ids)):
+                self.packages[pkg.id] = (pkg.name, pkg.title,
+                                         lib.dataset_notes(pkg))
+                self.pkg_ids_by_org[pkg.owner_org].append(pkg.id)
+            self.unpublished_pkg_ids = set(
+                pkg_id for pkg_id, value in
+                model.Session.query(model.PackageExtra.package_id,
+                                    model.PackageExtra.value)
+                .filter(model.PackageExtra.key == 'unpublished')
+                .filter(model.PackageExtra.state == 'active')
+                .filter(model.PackageExtra.package_id.in_(pkg_ids))
+                if asbool(value))
+        log.info('Publisher activity: %s datasets created, %s modified',
+                 len(self.created), len(self.modified))
+
+    def _add_modification(self, pkg_id, revision_timestamp, author, timestamp):
+        created = self.created.get(pkg_id)
+        for period_name, period in self.periods.iteritems():
+            # exclude the creation revision
+            period_start = max(period[0], created[2]) if created else period[0]
+            if period_start < revision_timestamp < period[1]:
+                authors, dates = self.modified[pkg_id].setdefault(
+                    period_name, (set(), set()))
+                authors.add(author)
+                dates.add(timestamp.date())
+
+    def get_activity(self, organization_ids=None):
+        '''Returns the datasets created and modified in each period, for
+        datasets in the given organizations (default all of them).'''
+        created = dict((period_name, []) for period_name in self.periods)
+        modified = dict((period_name, []) for period_name in self.periods)
+
+        if organization_ids is None:
+            pkg_ids = self.packages.keys()
+        else:
+            pkg_ids = sum((self.pkg_ids_by_org.get(org_id, [])
+                           for org_id in organization_ids), [])
+        for pkg_id in pkg_ids:
+            pkg_name, pkg_title, notes = self.packages[pkg_id]
+            published = pkg_id not in self.unpublished_pkg_ids
+            for period_name, period in self.periods.iteritems():
+                if pkg_id in self.created:
+                    name, title, timestamp, author = self.created[pkg_id]
+                    if period[0] < timestamp < period[1]:
+                        created[period_name].append(
+                            (name, title, notes,
+                             'created', period_name,
+                             timestamp.isoformat(), author, published))
+                if period_name in self.modified.get(pkg_id, {}):
+                    authors, dates = self.modified[pkg_id][period_name]
+                    dates_formatted = ' '.join([date.isoformat()
+                                                for date in sorted(dates)])
+                    modified[period_name].append(
+                        (pkg_name, pkg_title, notes,
+                         'modified', period_name,
+                         dates_formatted, ' '.join(authors), published))
+        return created, modified
+
+# Reports for every organization and include_sub_organizations setting are
+# generated one after the other, so share the activity between them. The
+# periods end "now", so they are matched on their names and start dates.
+# {periods_key: (time_loaded, PublisherActivity)}
+_publisher_activity_cache = {}
+PUBLISHER_ACTIVITY_CACHE_SECONDS = 60 * 60
+
+
+def _get_publisher_activity(periods):
+    key = tuple(sorted((period_name, period[0])
+                       for period_name, period in periods.items()))
+    loaded, activity = _publisher_activity_cache.get(key, (None, None))
+    if loaded is None or \
+            time.time() - loaded > PUBLISHER_ACTIVITY_CACHE_SECONDS:
+        _publisher_activity_cache.clear()
+        activity = PublisherActivity(periods)
+        _publisher_activity_cache[key] = (time.time(), activity)
+    return activity
+
+
 def _get_activity(organization_name, include_sub_organizations, periods):
     import ckan.model as model
-    from paste.deploy.converters import asbool
-
-    created = dict((period_name, []) for period_name in periods)
-    modified = dict((period_name, []) for period_name in periods)
-
-    # These are the authors whose revisions we ignore, as they are trivial
-    # changes. NB we do want to know about revisions by:
-    # * harvest (harvested metadata)
-    # * dgu (NS Stat Hub imports)
-    # * Fix national indicators
-    system_authors = ('autotheme', 'co-prod3.dh.bytemark.co.uk',
-                      'Date format tidier', 'current_revision_fixer',
-                      'current_revision_fixer2', 'fix_contact_details.py',
-                      'Repoint 410 Gone to webarchive url',
-                      'Fix duplicate resources',
-                      'fix_secondary_theme.py',
-                      )
-    system_author_template = 'script%'  # "%" is a wildcard
 
     if organization_name:
         organization = model.Group.by_name(organization_name)
         if not organization:
             raise p.toolkit.ObjectNotFound()
-
-    if not organization_name:
-        pkgs = model.Session.query(model.Package)\
-                    .all()
+        if include_sub_organizations:
+            organization_ids = publisher_tree.descendant_ids(organization)
+        else:
+            organization_ids = [organization.id]
     else:
-        pkgs = model.Session.query(model.Package)
-        pkgs = lib.filter_by_organizations(pkgs, organization,
-                                           include_sub_organizations).all()
+        organization_ids = None
 
-    for pkg in pkgs:
-        created_ = model.Session.query(model.PackageRevision)\
-            .filter(model.PackageRevision.id == pkg.id) \
-            .order_by("revision_timestamp asc").first()
-
-        pr_q = model.Session.query(model.PackageRevision, model.Revision)\
-            .filter(model.PackageRevision.id == pkg.id)\
-            .filter_by(state='active')\
-            .join(model.Revision)\
-            .filter(~model.Revision.author.in_(system_authors)) \
-            .filter(~model.Revision.author.like(system_author_template))
-        rr_q = model.Session.query(model.Package, model.ResourceRevision, model.Revision)\
-            .filter(model.Package.id == pkg.id)\
-            .filter_by(state='active')\
-            .join(model.ResourceGroup)\
-            .join(model.ResourceRevision,
-                  model.ResourceGroup.id == model.ResourceRevision.resource_group_id)\
-            .join(model.Revision)\
-            .filter(~model.Revision.author.in_(system_authors))\
-            .filter(~model.Revision.author.like(system_author_template))
-        pe_q = model.Session.query(model.Package, model.PackageExtraRevision, model.Revision)\
-            .filter(model.Package.id == pkg.id)\
-            .filter_by(state='active')\
-            .join(model.PackageExtraRevision,
-                  model.Package.id == model.PackageExtraRevision.package_id)\
-            .join(model.Revision)\
-            .filter(~model.Revision.author.in_(system_authors))\
-            .filter(~model.Revision.author.like(system_author_template))
-
-        for period_name in periods:
-            period = periods[period_name]
-            # created
-            if period[0] < created_.revision_timestamp < period[1]:
-                published = not asbool(pkg.extras.get('unpublished'))
-                created[period_name].append(
-                    (created_.name, created_.title, lib.dataset_notes(pkg),
-                     'created', period_name,
-                     created_.revision_timestamp.isoformat(),
-                     created_.revision.author, published))
-
-            # modified
-            # exclude the creation revision
-            period_start = max(period[0], created_.revision_timestamp)
-            prs = pr_q.filter(model.PackageRevision.revision_timestamp > period_start)\
-                        .filter(model.PackageRevision.revision_timestamp < period[1])
-            rrs = rr_q.filter(model.ResourceRevision.revision_timestamp > period_start)\
-                        .filter(model.ResourceRevision.revision_timestamp < period[1])
-            pes = pe_q.filter(model.PackageExtraRevision.revision_timestamp > period_start)\
-                        .filter(model.PackageExtraRevision.revision_timestamp < period[1])
-            authors = ' '.join(set([r[1].author for r in prs] +
-                                   [r[2].author for r in rrs] +
-                                   [r[2].author for r in pes]))
-            dates = set([r[1].timestamp.date() for r in prs] +
-                        [r[2].timestamp.date() for r in rrs] +
-                        [r[2].timestamp.date() for r in pes])
-            dates_formatted = ' '.join([date.isoformat()
-                                        for date in sorted(dates)])
-            if authors:
-                published = not asbool(pkg.extras.get('unpublished'))
-                modified[period_name].append(
-                    (pkg.name, pkg.title, lib.dataset_notes(pkg),
-                        'modified', period_name,
-                        dates_formatted, authors, published))
-    return created, modified
+    return _get_publisher_activity(periods).get_activity(organization_ids)
 
 
 def publisher_activity_combinations():
@@ -491,7 +597,7 @@ def app_dataset_report():
                         .all():
         dataset = related.dataset
         org = dataset.get_organization()
-        top_org = list(go_up_tree(org))[-1]
+        top_org = publisher_tree.top_level(org)
 
         app_dataset_dict = OrderedDict((
             ('app title', related.related.title),
@@ -610,11 +716,11 @@ def admin_editor(org=None, include_sub_organizations=False):
             raise p.toolkit.ObjectNotFound('Publisher not found')
 
         if include_sub_organizations:
-            child_ids = [ch[0] for ch in parent.get_children_group_hierarchy(type='organization')]
+            org_ids = publisher_tree.descendant_ids(parent)
         else:
-            child_ids = []
+            org_ids = [parent.id]
 
-        q = q.filter(model.Group.id.in_([parent.id] + child_ids))
+        q = q.filter(model.Group.id.in_(org_ids))
 
         for g in q.all():
             record = {}
@@ -661,14 +767,13 @@ def user_is_admin(user, org=None):
 def user_is_rm(user, org=None):
     from pylons import config
     from ast import literal_eval
-    from ckanext.dgu.lib.publisher import go_up_tree
 
     relationship_managers = literal_eval(config.get('dgu.relationship_managers', '{}'))
 
     allowed_orgs = relationship_managers.get(user.name, [])
 
     if org:
-        for o in go_up_tree(org):
+        for o in publisher_tree.ancestors(org):
             if o.name in allowed_orgs:
                 return True
 
@@ -760,18 +865,13 @@ def licence_report(organization=None, include_sub_organizations=False):
             raise p.toolkit.ObjectNotFound('Publisher not found')
 
         if include_sub_organizations:
-            orgs = lib.go_down_tree(top_org)
+            org_ids = publisher_tree.descendant_ids(top_org)
         else:
-            orgs = [top_org]
-        pkgs = set()
-        for org in orgs:
-            org_pkgs = model.Session.query(model.Package)\
-                            .filter_by(state='active')
-            org_pkgs = lib.filter_by_organizations(
-                org_pkgs, organization,
-                include_sub_organizations=False)\
-                .all()
-            pkgs |= set(org_pkgs)
+            org_ids = [top_org.id]
+        pkgs = model.Session.query(model.Package)\
+                    .filter_by(state='active')\
+                    .filter(model.Package.owner_org.in_(org_ids))\
+                    .all()
     else:
         pkgs = model.Session.query(model.Package)\
                     .filter_by(state='active')\
@@ -870,7 +970,7 @@ def pdf_datasets_report():
         org = model.Session.query(model.Group) \
                    .filter_by(name=org_name) \
                    .first()
-        top_org = list(go_up_tree(org))[-1]
+        top_org = publisher_tree.top_level(org)
 
         row = OrderedDict((
             ('organization title', org.title),
@@ -941,7 +1041,7 @@ def html_datasets_report():
         org = model.Session.query(model.Group) \
                    .filter_by(name=org_name) \
                    .first()
-        top_org = list(go_up_tree(org))[-1]
+        top_org = publisher_tree.top_level(org)
 
         row = OrderedDict((
             ('organization title', org.title),
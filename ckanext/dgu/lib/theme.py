@@ -2,34 +2,80 @@ import os.path
 import simplejson as json
 import codecs
 import re
+import time
+import threading
+import multiprocessing
 from collections import defaultdict
 
 # Use nltk.download() to get the 'stopwords' corpus
 import nltk
 from nltk.corpus import stopwords
-from nltk.util import bigrams, trigrams
 import sqlalchemy
 
 from ckanext.dgu.schema import tag_munge
 from ckanext.dgu.plugins_toolkit import get_action
 from ckan import model
+from ckan.common import OrderedDict
 
 log = __import__('logging').getLogger(__name__)
 
 PRIMARY_THEME = 'theme-primary'
 SECONDARY_THEMES = 'theme-secondary'
 
+# The ckanext-taxonomy tables that the themes are loaded from
+TAXONOMY_TABLES = ('taxonomy', 'taxonomy_term')
+
+# Rows inserted, updated or deleted in the taxonomy tables since the stats
+# were last reset, which serves as the version of the themes.
+TAXONOMY_VERSION_SQL = '''
+    SELECT sum(n_tup_ins + n_tup_upd + n_tup_del) FROM pg_stat_user_tables
+    WHERE relname IN %s;''' % (TAXONOMY_TABLES,)
+
+def taxonomy_version():
+    return model.Session.execute(TAXONOMY_VERSION_SQL).scalar()
+
 class Themes(object):
-    '''Singleton class containing the themes data (from ckanext-taxonomy) with a bit of processing.'''
+    '''Singleton class containing the themes data (from ckanext-taxonomy) with a bit of processing.
+
+    This is the one source of the themes for the classifier, the home page and
+    the template helpers. instance() checks the taxonomy_version() at most
+    every dgu.themes.check_interval seconds, and loads a new instance if it
+    has changed. Changes made by this process reload it straight away (see
+    SearchPlugin.before_commit), and those made by other processes are picked
+    up within the check interval.
+    '''
     _instance = None
+    _checked = 0  # time the taxonomy version was last checked
+    _lock = threading.Lock()
+
     @classmethod
     def instance(cls):
-        if not cls._instance:
-            cls._instance = Themes()
-        return cls._instance
+        from pylons import config
+        check_interval = int(config.get('dgu.themes.check_interval', 60))
+        with cls._lock:
+            now = time.time()
+            if cls._instance and now - cls._checked < check_interval:
+                return cls._instance
+            version = taxonomy_version()
+            cls._checked = now
+            if not cls._instance or cls._instance.version != version:
+                if cls._instance:
+                    log.info('Taxonomy changed - reloading the themes')
+                cls._instance = Themes(version)
+            return cls._instance
 
-    def __init__(self):
+    @classmethod
+    def invalidate(cls):
+        '''Drops the themes, so the next instance() reloads them. Called by
+        SearchPlugin.before_commit when this process changes the taxonomy,
+        since the table stats are only updated after a short delay.'''
+        with cls._lock:
+            cls._instance = None
+
+    def __init__(self, version=None):
+        self.version = version
         self.data = {}
+        self.names = []  # theme names in the taxonomy's order
         self.topic_words = {}  # topic:[theme_name]
         self.topic_bigrams = {} # (topicword1, topicword2):[theme_name]
         self.topic_trigrams = {} # (topicword1, topicword2, topicword3):[theme_name]
@@ -97,15 +143,90 @@ class Themes(object):
             for keyword in theme_dict.get('odc', []):
                 self.odc[keyword] = name
             self.data[name] = theme_dict
+            self.names.append(name)
         self.topic_words_set = self.topic_words.viewkeys() # can do set-like operations on it
         self.topic_bigrams_set = self.topic_bigrams.viewkeys()
         self.topic_trigrams_set = self.topic_trigrams.viewkeys()
 
 
+
+class ThemeClassifier(object):
+    '''The Themes' topics compiled for matching against the text of
+    packages. The topic n-grams are indexed by their first word, so the words
+    of some text are scanned once, counting the matches as it goes.'''
+    _instance = None
+    @classmethod
+    def instance(cls):
+        themes = Themes.instance()
+        if not cls._instance or cls._instance.themes is not themes:
+            cls._instance = ThemeClassifier(themes)
+        return cls._instance
+
+    def __init__(self, themes):
+        self.themes = themes
+        self.stopwords = english_stopwords()
+        self.topic_ngrams = {1: themes.topic_words,
+                             2: themes.topic_bigrams,
+                             3: themes.topic_trigrams}
+        # first word: sizes of the topic n-grams that start with it
+        sizes_by_first_word = defaultdict(set)
+        for size, topic_ngrams in self.topic_ngrams.items():
+            for ngram in topic_ngrams:
+                first_word = ngram if size == 1 else ngram[0]
+                sizes_by_first_word[first_word].add(size)
+        self.sizes_by_first_word = dict(
+            (word, sorted(sizes))
+            for word, sizes in sizes_by_first_word.iteritems())
+
+    def match_topics(self, words):
+        '''Returns the topic n-grams in the (normalized) words, as a list of
+        (size, ngram, occurrences), ordered by size and then by first
+        occurrence. Single-word topics are not matched by stopwords.'''
+        counts = dict((size, OrderedDict()) for size in (1, 2, 3))
+        for i, word in enumerate(words):
+            for size in self.sizes_by_first_word.get(word, ()):
+                if size == 1:
+                    if word in self.stopwords:
+                        continue
+                    ngram = word
+                else:
+                    ngram = tuple(words[i:i + size])
+                    if ngram not in self.topic_ngrams[size]:
+                        continue
+                counts[size][ngram] = counts[size].get(ngram, 0) + 1
+        return [(size, ngram, occurrences)
+                for size in (1, 2, 3)
+                for ngram, occurrences in counts[size].iteritems()]
+
+    def score_by_topic(self, pkg, scores):
+        '''Examines the pkg and adds scores according to topics in it.'''
+        for level in range(3):
+            words = [normalize_token(w)
+                     for w in split_words(package_text(pkg, level))]
+            for num_words, ngram, occurrences in self.match_topics(words):
+                score = (3-level) * occurrences * num_words
+                ngram_printable = ' '.join(ngram) if isinstance(ngram, tuple) else ngram
+                reason = '"%s" matched %s' % (ngram_printable, LEVELS[level])
+                if occurrences > 1:
+                    reason += ' (%s times)' % occurrences
+                for theme in self.topic_ngrams[num_words][ngram]:
+                    scores[theme].append((score, reason))
+                log.debug(' %s %s %s', theme, score, reason)
+
+
+_stopwords = None
+def english_stopwords():
+    '''Returns the NLTK English stopwords, which are loaded just once.'''
+    global _stopwords
+    if _stopwords is None:
+        _stopwords = frozenset(stopwords.words('english'))
+    return _stopwords
+
 def normalize_text(text):
+    stopwords_ = english_stopwords()
     words = [normalize_token(w) for w in split_words(text)]
     words_without_stopwords = [word for word in words
-            if word not in stopwords.words('english')]
+            if word not in stopwords_]
     return words, words_without_stopwords
 
 def split_words(sentence):
@@ -118,27 +239,39 @@ def split_words(sentence):
 stem_exceptions = set(('parking', 'national', 'coordinates', 'granted', 'hospitality', 'employers', 'employer', 'employee', 'employees', 'nhs', 'consultation'))
 
 porter = None
+# token: normalized token, since stemming is slow and text repeats words
+_normalized_tokens = {}
+MAX_NORMALIZED_TOKENS = 100000
 def normalize_token(token):
     global porter
+    try:
+        return _normalized_tokens[token]
+    except KeyError:
+        pass
     if not porter:
         porter = nltk.PorterStemmer()
-    token = re.sub('[^\w]', '', token)
-    token = token.lower()
-    if token not in stem_exceptions:
-        token = porter.stem(token)
-    return token
+    normalized = re.sub('[^\w]', '', token)
+    normalized = normalized.lower()
+    if normalized not in stem_exceptions:
+        normalized = porter.stem(normalized)
+    if len(_normalized_tokens) >= MAX_NORMALIZED_TOKENS:
+        _normalized_tokens.clear()
+    _normalized_tokens[token] = normalized
+    return normalized
 
 def dictize_package_nice(pkg):
     # package comes in as dict or an object. Convert both to a convenient dict.
     if isinstance(pkg, model.Package):
-        return {'name': pkg.name,
+        return {'id': pkg.id,
+                'name': pkg.name,
                 'title': pkg.title,
                 'tags': [tag.name for tag in pkg.get_tags()],
                 'notes': pkg.notes,
                 'extras': pkg.extras
                 }
     else:
-        pkg_dict = {'name': pkg['name'],
+        pkg_dict = {'id': pkg.get('id'),
+                    'name': pkg['name'],
                     'title': pkg['title'],
                     'notes': pkg['notes'],
                     }
@@ -154,6 +287,60 @@ def dictize_package_nice(pkg):
             pkg_dict['extras'] = dict(pkg['extras'].items())
         return pkg_dict
 
+# the extras that categorization looks at
+CATEGORIZATION_EXTRAS = (PRIMARY_THEME, 'UKLP', 'external_reference',
+                         'la_function', 'la_service', 'dcat_subject')
+
+def stream_package_dicts(limit=None, batch_size=1000):
+    '''Yields each active dataset as a dict of just the fields that
+    categorization uses (id, name, title, notes, tags and the extras in
+    CATEGORIZATION_EXTRAS). They are streamed from a single server-side cursor,
+    rather than loading and dictizing package objects one by one, so that the
+    whole catalogue can be categorized without holding it in memory.
+    '''
+    sql = '''
+        SELECT package.id, package.name, package.title, package.notes,
+               ARRAY(SELECT tag.name FROM package_tag
+                     JOIN tag ON tag.id = package_tag.tag_id
+                     WHERE package_tag.package_id = package.id
+                       AND package_tag.state = 'active') AS tags,
+               ARRAY(SELECT key FROM package_extra
+                     WHERE package_extra.package_id = package.id
+                       AND package_extra.state = 'active'
+                       AND key IN :extra_keys
+                     ORDER BY key) AS extra_keys,
+               ARRAY(SELECT value FROM package_extra
+                     WHERE package_extra.package_id = package.id
+                       AND package_extra.state = 'active'
+                       AND key IN :extra_keys
+                     ORDER BY key) AS extra_values
+        FROM package
+        WHERE package.state = 'active' AND package.type = 'dataset'
+        ORDER BY package.name
+        LIMIT :limit
+    '''
+    connection = model.Session.connection() \
+        .execution_options(stream_results=True)
+    result = connection.execute(sqlalchemy.text(sql),
+                                extra_keys=CATEGORIZATION_EXTRAS,
+                                limit=limit)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for id_, name, title, notes, tags, extra_keys, extra_values \
+                    in rows:
+                yield {'id': id_,
+                       'name': name,
+                       'title': title,
+                       'notes': notes,
+                       'tags': tags,
+                       'extras': dict(zip(extra_keys, extra_values)),
+                       }
+    finally:
+        result.close()
+
 def categorize_package(pkg, stats=None):
     '''Given a package it does various searching for topic keywords and returns
     its estimate for primary-theme and secondary-theme.
@@ -179,20 +366,60 @@ def categorize_package2(pkg, stats=None):
          }]
 
     '''
-    if stats is None:
-        class MockStats:
-            def add(self, a, b):
-                return '%s: %s' % (a, b)
-        stats = MockStats()
-
     pkg = dictize_package_nice(pkg)
+    theme_scores = _theme_scores(pkg)
+    log_categorization(pkg, theme_scores, stats)
+    return theme_scores
+
+def categorize_packages(pkgs, processes=None, stats=None, chunksize=50):
+    '''Categorizes many packages, like categorize_package2, spread over a
+    pool of processes.
+
+    pkgs - iterable of package objects or dicts
+    processes - number of processes (default: number of CPUs). 1 means they
+                are done in this process.
+
+    Yields (pkg_dict, theme_scores) in the order of pkgs, where pkg_dict is
+    the package from dictize_package_nice.
+    '''
+    global _pool_classifier
+    # build the index before the pool forks, so the workers inherit it
+    # rather than each loading the themes from the database
+    classifier = _pool_classifier = ThemeClassifier.instance()
+    pkg_dicts = (dictize_package_nice(pkg) for pkg in pkgs)
+    if processes == 1:
+        results = ((pkg, _theme_scores(pkg, classifier)) for pkg in pkg_dicts)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(_categorize_package_dict, pkg_dicts, chunksize)
+    try:
+        for pkg, theme_scores in results:
+            log_categorization(pkg, theme_scores, stats)
+            yield pkg, theme_scores
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+# the classifier for the pool's workers, which must not query the database
+_pool_classifier = None
+
+def _categorize_package_dict(pkg):
+    return pkg, _theme_scores(pkg, _pool_classifier)
+
+def _theme_scores(pkg, classifier=None):
+    '''Returns the theme_scores for a package, as dictized by
+    dictize_package_nice.'''
+    classifier = classifier or ThemeClassifier.instance()
+    themes = classifier.themes
     scores = defaultdict(list)  # theme:[(score, reason), ...]
-    score_by_topic(pkg, scores)
-    score_by_gemet(pkg, scores)
-    score_by_ons_theme(pkg, scores)
-    score_by_la_service(pkg, scores)
-    score_by_la_function(pkg, scores)
-    score_by_odc_theme(pkg, scores)
+    classifier.score_by_topic(pkg, scores)
+    score_by_gemet(pkg, scores, themes)
+    score_by_ons_theme(pkg, scores, themes)
+    score_by_la_service(pkg, scores, themes)
+    score_by_la_function(pkg, scores, themes)
+    score_by_odc_theme(pkg, scores, themes)
 
     # add up scores and reasons
     theme_scores = defaultdict(lambda: {'name': '', 'score': 0, 'reasons': []})
@@ -210,10 +437,21 @@ def categorize_package2(pkg, stats=None):
         score_threshold = max_score / 3
         theme_scores = filter(lambda y: y['score'] > score_threshold, theme_scores)
 
-    primary_theme = theme_scores[0]['name'] if scores else None
+    return theme_scores
+
+def log_categorization(pkg, theme_scores, stats=None):
+    '''Logs how the theme_scores compare with the package's current theme,
+    adding to the stats.'''
+    if stats is None:
+        class MockStats:
+            def add(self, a, b):
+                return '%s: %s' % (a, b)
+        stats = MockStats()
+
+    primary_theme = theme_scores[0]['name'] if theme_scores else None
 
     current_primary_theme = pkg['extras'].get(PRIMARY_THEME)
-    if scores:
+    if theme_scores:
         if primary_theme == current_primary_theme:
             log.debug(stats.add('Theme matches', '%s %s %s' % (pkg['name'], primary_theme, theme_scores[0]['score'])))
         elif current_primary_theme:
@@ -223,45 +461,14 @@ def categorize_package2(pkg, stats=None):
     else:
         log.debug(stats.add('No match', pkg['name']))
 
-    return theme_scores
-
 def score_by_topic(pkg, scores):
     '''Examines the pkg and adds scores according to topics in it.'''
-    themes = Themes.instance()
-    for level in range(3):
-        pkg_text = package_text(pkg, level)
-        words, words_without_stopwords = normalize_text(pkg_text)
-        for num_words in (1, 2, 3):
-            if num_words == 1:
-                ngrams = words_without_stopwords
-                topic_ngrams = themes.topic_words
-                topic_ngrams_set = themes.topic_words_set
-            elif num_words == 2:
-                ngrams = bigrams(words)
-                topic_ngrams = themes.topic_bigrams
-                topic_ngrams_set = themes.topic_bigrams_set
-            elif num_words == 3:
-                ngrams = trigrams(words)
-                topic_ngrams = themes.topic_trigrams
-                topic_ngrams_set = themes.topic_trigrams_set
-            matching_ngrams = set(ngrams) & topic_ngrams_set
-            if matching_ngrams:
-                for ngram in matching_ngrams:
-                    occurrences = ngrams.count(ngram)
-                    score = (3-level) * occurrences * num_words
-                    themes_for_ngram = topic_ngrams[ngram]
-                    ngram_printable = ' '.join(ngram) if isinstance(ngram, tuple) else ngram
-                    reason = '"%s" matched %s' % (ngram_printable, LEVELS[level])
-                    if occurrences > 1:
-                        reason += ' (%s times)' % occurrences
-                    for theme in themes_for_ngram:
-                        scores[theme].append((score, reason))
-                    log.debug(' %s %s %s', theme, score, reason)
-
-def score_by_gemet(pkg, scores):
+    ThemeClassifier.instance().score_by_topic(pkg, scores)
+
+def score_by_gemet(pkg, scores, themes=None):
     if pkg['extras'].get('UKLP') != 'True':
         return
-    themes = Themes.instance()
+    themes = themes or Themes.instance()
     for tag in pkg['tags']:
         tag = normalize_keyword(tag)
         if tag in themes.gemet:
@@ -273,7 +480,7 @@ def score_by_gemet(pkg, scores):
         else:
             log.debug(' Non-GEMET keyword: %s', tag)
 
-def score_by_ons_theme(pkg, scores):
+def score_by_ons_theme(pkg, scores, themes=None):
     # There are 11 'Old ONS themes' e.g.: 'Agriculture and Environment', 'Business and Energy'
     # http://www.statistics.gov.uk/hub/browse-by-theme/index.html
     #
@@ -282,7 +489,7 @@ def score_by_ons_theme(pkg, scores):
     # http://digitalpublishing.ons.gov.uk/2013/12/05/no-longer-taxing-we-hope/
     if pkg['extras'].get('external_reference') != 'ONSHUB':
         return
-    themes = Themes.instance()
+    themes = themes or Themes.instance()
     for tag in pkg['tags']:
         tag = tag_munge(tag)
         if tag in themes.ons:
@@ -292,7 +499,7 @@ def score_by_ons_theme(pkg, scores):
             scores[theme].append((score, reason))
             log.debug(' %s %s %s' % (theme, score, reason))
 
-def score_by_la_function(pkg, scores):
+def score_by_la_function(pkg, scores, themes=None):
     '''
     Grants a score based on the presence of a Local Authority function extra.
     This is set by the Inventory harvester and will be a list of URLs to the
@@ -305,7 +512,7 @@ def score_by_la_function(pkg, scores):
     if not la_functions:
         return
 
-    themes = Themes.instance()
+    themes = themes or Themes.instance()
     for furl in la_functions:
         # function id is the last part of the URL
         fid = furl.split('/')[-1]
@@ -318,7 +525,7 @@ def score_by_la_function(pkg, scores):
         else:
             log.debug('A non-LA function identifier was found %s', furl)
 
-def score_by_la_service(pkg, scores):
+def score_by_la_service(pkg, scores, themes=None):
     '''
     Grants a score based on the presence of a Local Authority services extra.
     This is set by the Inventory harvester and will be a list of URLs to the
@@ -331,7 +538,7 @@ def score_by_la_service(pkg, scores):
     if not la_services:
         return
 
-    themes = Themes.instance()
+    themes = themes or Themes.instance()
     for surl in la_services:
         # service id is the last part of the URL
         sid = surl.split('/')[-1]
@@ -344,7 +551,7 @@ def score_by_la_service(pkg, scores):
         else:
             log.debug('A non-LA service identifier was found %s', surl)
 
-def score_by_odc_theme(pkg, scores):
+def score_by_odc_theme(pkg, scores, themes=None):
     ''' Grants a score based on the presence of an OpenDataCommunities theme
     extra. This is set by the DCAT harvester and will be a list of
     URLS like:
@@ -354,7 +561,7 @@ def score_by_odc_theme(pkg, scores):
     if not subjects:
         return
 
-    themes = Themes.instance()
+    themes = themes or Themes.instance()
     for subject_url in subjects:
         if not subject_url:
             continue
@@ -0,0 +1,25 @@
+from sqlalchemy import Column, types
+from sqlalchemy.ext.declarative import declarative_base
+
+import datetime
+
+Base = declarative_base()
+
+class ThemeProposal(Base):
+    '''A theme proposed for a dataset by the classify_themes command, staged
+    here for review before it is written to the dataset.'''
+    __tablename__ = 'theme_proposal'
+
+    package_id = Column('package_id', types.UnicodeText, primary_key=True)
+    package_name = Column('package_name', types.UnicodeText, nullable=False)
+    current_primary_theme = Column('current_primary_theme', types.UnicodeText)
+    primary_theme = Column('primary_theme', types.UnicodeText)
+    primary_score = Column('primary_score', types.Integer)
+    # JSON lists, in order of score
+    secondary_themes = Column('secondary_themes', types.UnicodeText)
+    secondary_scores = Column('secondary_scores', types.UnicodeText)
+    reasons = Column('reasons', types.UnicodeText)
+    created = Column('created', types.DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+def init_tables(e):
+    Base.metadata.create_all(e)
@@ -439,6 +439,44 @@ class SearchPlugin(p.SingletonPlugin):
     """
 
     p.implements(p.IPackageController, inherit=True)
+    p.implements(p.ISession, inherit=True)
+
+    def before_commit(self, session):
+        """
+        Drop the cached publisher hierarchy used for indexing and the cached
+        publisher tree walks if any publisher, its extras or its membership of
+        another publisher has changed. Drop the cached latest datasets and
+        dataset counters if any package has changed, and the themes if the
+        taxonomy has changed.
+        """
+        from ckan import model
+        from ckanext.dgu.lib import publisher_tree
+        from ckanext.dgu.lib.publisher import PublisherHierarchy
+        from ckanext.dgu.lib.home import Counters
+        from ckanext.dgu.lib.theme import Themes, TAXONOMY_TABLES
+        from ckanext.dgu.controllers.api import invalidate_latest_datasets
+
+        if not hasattr(session, '_object_cache'):
+            return
+        publishers_changed = packages_changed = taxonomy_changed = False
+        for objs in session._object_cache.values():
+            for obj in objs:
+                if isinstance(obj, (model.Group, model.GroupExtra)) or \
+                        (isinstance(obj, model.Member) and
+                         obj.table_name == 'group'):
+                    publishers_changed = True
+                elif isinstance(obj, model.Package):
+                    packages_changed = True
+                elif getattr(obj, '__tablename__', None) in TAXONOMY_TABLES:
+                    taxonomy_changed = True
+        if publishers_changed:
+            PublisherHierarchy.invalidate()
+            publisher_tree.invalidate()
+        if packages_changed:
+            invalidate_latest_datasets()
+            Counters.invalidate()
+        if taxonomy_changed:
+            Themes.invalidate()
 
     def read(self, entity):
         pass
@@ -510,23 +548,7 @@ class SearchPlugin(p.SingletonPlugin):
         reason is so that we can add search facets.
         """
         log.info('Indexing: %s', pkg_dict['name'])
-        SearchIndexing.clean_title_string(pkg_dict)
-        SearchIndexing.add_field__is_ogl(pkg_dict)
-        SearchIndexing.resource_format_cleanup(pkg_dict)
-        SearchIndexing.add_field__publisher(pkg_dict)
-        SearchIndexing.add_field__organization_title_and_abbreviation(pkg_dict)
-        if is_plugin_enabled('harvest'):
-            SearchIndexing.add_field__harvest_document(pkg_dict)
-        SearchIndexing.add_field__openness(pkg_dict)
-        SearchIndexing.add_popularity(pkg_dict)
-        SearchIndexing.add_inventory(pkg_dict)
-        SearchIndexing.add_its(pkg_dict)
-        SearchIndexing.add_register(pkg_dict)
-        SearchIndexing.add_api_flag(pkg_dict)
-        SearchIndexing.add_theme(pkg_dict)
-        if is_plugin_enabled('dgu_schema'):
-            SearchIndexing.add_schema(pkg_dict)
-        SearchIndexing.add_collections(pkg_dict)
+        SearchIndexing.enrich(pkg_dict)
 
         return pkg_dict
 
@@ -618,9 +640,14 @@ class DguSpatialPlugin(p.SingletonPlugin):
     def _is_it_sufficient_change_to_run_gemini_postprocess(self, package,
                                                            operation):
         ''' Returns True if it is a new dataset or there are resources that
-        have been added or URL changed in this revision.
+        have been added or URL changed since it was last post-processed.
+
+        Compares the resources with the fingerprints stored by the
+        post-process, rather than with the previous revision of the package,
+        so is just one small query during the commit.
         '''
-        from ckan import model
+        from ckanext.dgu.gemini_postprocess import (
+            resource_fingerprints, get_stored_fingerprints)
         if operation == 'new':
             log.debug('New package - will process')
             # even if it has no resources, QA needs to show 0 stars against it
@@ -631,58 +658,17 @@ class DguSpatialPlugin(p.SingletonPlugin):
         # therefore operation=changed
 
         # check to see if resources are added or URL changed
-
-        # look for the latest revision
-        rev_list = package.all_related_revisions
-        if not rev_list:
-            log.debug('No sign of previous revisions - will process')
+        stored_fingerprints = get_stored_fingerprints(package.id)
+        if stored_fingerprints is None:
+            log.debug('Not post-processed before - will process')
             return True
-        # I am not confident we can rely on the info about the current
-        # revision, because we are still in the 'before_commit' stage. So
-        # simply ignore that if it's returned.
-        if rev_list[0][0].id == model.Session.revision.id:
-            rev_list = rev_list[1:]
-        if not rev_list:
-            log.warn('No sign of previous revisions - will process')
+        fingerprints = resource_fingerprints(
+            (res.id, res.url) for res in package.resources)
+        new_fingerprints = fingerprints - stored_fingerprints
+        if new_fingerprints:
+            log.debug('Added resources or url changed - will process. '
+                      'num_resources=%s', len(new_fingerprints))
             return True
-        previous_revision = rev_list[0][0]
-        log.debug('Comparing with revision: %s %s',
-                  previous_revision.timestamp, previous_revision.id)
-
-        # get the package as it was at that previous revision
-        context = {'model': model, 'session': model.Session,
-                   #'user': c.user or c.author,
-                   'ignore_auth': True,
-                   'revision_id': previous_revision.id}
-        data_dict = {'id': package.id}
-        try:
-            old_pkg_dict = p.toolkit.get_action('package_show')(
-                context, data_dict)
-        except p.toolkit.NotFound:
-            log.warn('No sign of previous package - will process anyway')
-            return True
-
-        # have any resources been added?
-        old_resources = dict((res['id'], res)
-                             for res in old_pkg_dict['resources'])
-        old_res_ids = set(old_resources.keys())
-        new_res_ids = set((res.id for res in package.resources))
-        added_res_ids = new_res_ids - old_res_ids
-        if added_res_ids:
-            log.debug('Added resources - will process. res_ids=%r',
-                      added_res_ids)
-            return True
-
-        # have any resource urls changed?
-        for res in package.resources:
-            old_res_url = old_resources[res.id]['url']
-            if old_res_url != res.url:
-                log.debug('Resource url changed - will process. '
-                          'id=%s pos=%s url="%s"->"%s"',
-                          res.id[:4], res.position, old_res_url, res.url)
-                return True
-            log.debug('Resource unchanged. pos=%s id=%s',
-                      res.position, res.id[:4])
 
         log.debug('No new or changed resources - won\'t process')
         return False
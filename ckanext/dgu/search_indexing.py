@@ -1,22 +1,208 @@
 from logging import getLogger
-import re
 import string
 import json
+import time
+import datetime
+from collections import defaultdict
 
 from paste.deploy.converters import asbool
 
-from ckan.model.group import Group
 from ckan import model
-from ckan.lib import helpers
 from ckanext.dgu.lib import helpers as dgu_helpers
+from ckanext.dgu.lib import formats
+from ckanext.dgu.lib.publisher import PublisherHierarchy
 from ckanext.dgu.plugins_toolkit import ObjectNotFound
 
 log = getLogger(__name__)
 
+
+def _get_extra(pkg_dict, key, default=None):
+    '''Returns an extra of a package dict, whether it is in the form given to
+    before_index (extras as top-level keys) or by package_show (a list of
+    extras).'''
+    if key in pkg_dict:
+        return pkg_dict[key]
+    for extra in pkg_dict.get('extras') or []:
+        if isinstance(extra, dict) and extra.get('key') == key:
+            return extra.get('value')
+    return default
+
+
 class SearchIndexing(object):
     '''Functions that edit the package dictionary fields to affect the way it
     gets indexed in Solr.'''
 
+    # Values looked up in bulk by prefetch() for the batch of datasets being
+    # indexed. Each enricher looks here first and falls back to looking up a
+    # dataset individually.
+    #   {'popularity': {pkg_name: score},
+    #    'harvest_document': {harvest_object_id: content},
+    #    'schema': {schema_id: title}, 'codelist': {codelist_id: title}}
+    prefetched = {}
+
+    # Time spent in each enricher since the last reset_timings()
+    #   {enricher_name: [calls, seconds]}
+    timings = defaultdict(lambda: [0, 0.0])
+
+    @classmethod
+    def enrichers(cls):
+        '''Returns the functions that SearchPlugin.before_index runs on every
+        pkg_dict, in order.'''
+        from ckanext.dgu.lib.helpers import is_plugin_enabled
+        enrichers = [cls.clean_title_string,
+                     cls.add_field__is_ogl,
+                     cls.resource_format_cleanup,
+                     cls.add_field__publisher,
+                     cls.add_field__organization_title_and_abbreviation]
+        if is_plugin_enabled('harvest'):
+            enrichers.append(cls.add_field__harvest_document)
+        enrichers += [cls.add_field__openness,
+                      cls.add_popularity,
+                      cls.add_inventory,
+                      cls.add_its,
+                      cls.add_register,
+                      cls.add_api_flag,
+                      cls.add_theme]
+        if is_plugin_enabled('dgu_schema'):
+            enrichers.append(cls.add_schema)
+        enrichers.append(cls.add_collections)
+        return enrichers
+
+    @classmethod
+    def enrich(cls, pkg_dict):
+        '''Runs all the enrichers on the pkg_dict, recording how long each
+        one takes.'''
+        for enricher in cls.enrichers():
+            start = time.time()
+            enricher(pkg_dict)
+            timing = cls.timings[enricher.__name__]
+            timing[0] += 1
+            timing[1] += time.time() - start
+        return pkg_dict
+
+    @classmethod
+    def enrich_batch(cls, pkg_dicts):
+        '''Runs all the enrichers on a list of pkg_dicts, doing the database
+        lookups for the whole batch with one query each.'''
+        cls.prefetch(pkg_dicts)
+        try:
+            for pkg_dict in pkg_dicts:
+                cls.enrich(pkg_dict)
+        finally:
+            cls.clear_prefetched()
+        return pkg_dicts
+
+    @classmethod
+    def prefetch(cls, pkg_dicts):
+        '''Looks up the popularity scores, harvest documents and schema
+        titles for a batch of datasets, ready for enrich() to use.
+
+        pkg_dicts can be as given to before_index or as returned by
+        package_show.
+        '''
+        from pylons import config
+        from ckanext.dgu.lib.helpers import is_plugin_enabled
+
+        start = time.time()
+        prefetched = {}
+        if 'ga-report' in config.get('ckan.plugins', ''):
+            prefetched['popularity'] = cls._bulk_popularity(
+                [pkg_dict['name'] for pkg_dict in pkg_dicts])
+        if is_plugin_enabled('harvest'):
+            prefetched['harvest_document'] = cls._bulk_harvest_document(
+                [_get_extra(pkg_dict, 'harvest_object_id')
+                 for pkg_dict in pkg_dicts
+                 if _get_extra(pkg_dict, 'UKLP') == 'True'])
+        if is_plugin_enabled('dgu_schema'):
+            from ckanext.dgu.model.schema_codelist import Schema, Codelist
+            for key, model_class in (('schema', Schema),
+                                     ('codelist', Codelist)):
+                ids = set()
+                for pkg_dict in pkg_dicts:
+                    try:
+                        ids.update(json.loads(_get_extra(pkg_dict, key) or '[]'))
+                    except (ValueError, TypeError):
+                        pass
+                prefetched[key] = cls._bulk_titles(model_class, ids)
+        cls.prefetched = prefetched
+
+        timing = cls.timings['prefetch']
+        timing[0] += 1
+        timing[1] += time.time() - start
+
+    @classmethod
+    def clear_prefetched(cls):
+        cls.prefetched = {}
+
+    @classmethod
+    def _bulk_popularity(cls, names):
+        '''Returns the popularity scores for the given dataset names. This
+        is the same calculation as ckanext-ga-report's get_score_for_dataset,
+        but done for many datasets with one query.'''
+        from ckanext.ga_report.ga_model import GA_Url
+
+        if not names:
+            return {}
+        now = datetime.datetime.now()
+        last_month = now - datetime.timedelta(days=30)
+        period_names = ['%s-%02d' % (last_month.year, last_month.month),
+                        '%s-%02d' % (now.year, now.month),
+                        ]
+        entries = model.Session.query(GA_Url) \
+            .filter(GA_Url.period_name.in_(period_names)) \
+            .filter(GA_Url.package_id.in_(names))
+        views_per_day = defaultdict(dict)
+        for entry in entries:
+            by_period = views_per_day[entry.package_id]
+            if entry.period_name in by_period:
+                continue
+            views = float(entry.pageviews)
+            if entry.period_complete_day:
+                by_period[entry.period_name] = views / entry.period_complete_day
+            else:
+                by_period[entry.period_name] = views / 15  # guess
+        scores = {}
+        for name, by_period in views_per_day.iteritems():
+            score = 0
+            for period_name in period_names:
+                score /= 2  # previous periods are discounted by 50%
+                score += by_period.get(period_name, 0)
+            scores[name] = int(score * 100)
+        return scores
+
+    @classmethod
+    def _bulk_harvest_document(cls, harvest_object_ids):
+        from ckanext.harvest.model import HarvestObject
+
+        harvest_object_ids = [id_ for id_ in harvest_object_ids if id_]
+        if not harvest_object_ids:
+            return {}
+        return dict(model.Session.query(HarvestObject.id,
+                                        HarvestObject.content)
+                    .filter(HarvestObject.id.in_(harvest_object_ids)))
+
+    @classmethod
+    def _bulk_titles(cls, model_class, ids):
+        ids = [id_ for id_ in ids if isinstance(id_, basestring)]
+        if not ids:
+            return {}
+        return dict(model.Session.query(model_class.id, model_class.title)
+                    .filter(model_class.id.in_(ids)))
+
+    @classmethod
+    def reset_timings(cls):
+        cls.timings.clear()
+
+    @classmethod
+    def log_timings(cls):
+        '''Logs the time spent in each enricher, slowest first.'''
+        total = sum(seconds for calls, seconds in cls.timings.values())
+        for name, (calls, seconds) in sorted(cls.timings.items(),
+                                             key=lambda t: -t[1][1]):
+            log.info('Indexing time %-50s %6d calls %8.2fs %5.1f%%',
+                     name, calls, seconds,
+                     100 * seconds / total if total else 0)
+
     @classmethod
     def add_popularity(cls, pkg_dict):
         '''Adds the views field from the ga-report plugin, if it is installed'''
@@ -25,8 +211,12 @@ class SearchIndexing(object):
         score = 0
 
         if 'ga-report' in config.get('ckan.plugins'):
-            from ckanext.ga_report.ga_model import get_score_for_dataset
-            score += get_score_for_dataset(pkg_dict['name'])
+            scores = cls.prefetched.get('popularity')
+            if scores is not None:
+                score += scores.get(pkg_dict['name'], 0)
+            else:
+                from ckanext.ga_report.ga_model import get_score_for_dataset
+                score += get_score_for_dataset(pkg_dict['name'])
 
         pkg_dict['popularity'] = score
         log.debug('Popularity: %s', pkg_dict['popularity'])
@@ -116,76 +306,49 @@ class SearchIndexing(object):
         '''Standardises the res_format field.'''
         pkg_dict['res_format'] = [ cls._clean_format(f) for f in pkg_dict.get('res_format', []) ]
 
-    _disallowed_characters = re.compile(r'[^a-zA-Z /+]')
     @classmethod
     def _clean_format(cls, format_string):
-        if isinstance(format_string, basestring):
-            matched_format = helpers.resource_formats().get(format_string.lower().strip(' .'))
-            if matched_format:
-                return matched_format[1]
-            return re.sub(cls._disallowed_characters, '', format_string).strip()
-        else:
-            return format_string
+        return formats.clean_format(format_string)
 
     @classmethod
     def add_field__organization_title_and_abbreviation(cls, pkg_dict):
         '''Adds any group abbreviation '''
-        abbr = None
-
-        g = model.Group.get(pkg_dict['organization'])
+        g = PublisherHierarchy.get_for(pkg_dict['organization']) \
+            .publisher(pkg_dict['organization'])
         if not g:
             log.error("Package %s does not belong to an organization" % pkg_dict['name'])
             return
 
-        pkg_dict['organization_titles'] = [g.title]
-
-        try:
-            abbr = g.extras.get('abbreviation')
-        except:
-            raise
+        pkg_dict['organization_titles'] = [g['title']]
 
-        if abbr:
-            pkg_dict['organization_titles'].append(abbr)
+        if g['abbreviation']:
+            pkg_dict['organization_titles'].append(g['abbreviation'])
 
         log.debug('Organization title: %r', pkg_dict['organization_titles'])
 
     @classmethod
     def add_field__publisher(cls, pkg_dict):
         '''Adds the 'publisher' based on group.'''
-        import ckan.model as model
-
-        publisher = model.Group.get(pkg_dict.get('organization'))
-        if not publisher:
+        # Ancestry of publishers, starting with the dataset's own publisher
+        ancestors = PublisherHierarchy.get_for(pkg_dict.get('organization')) \
+            .ancestors(pkg_dict.get('organization'))
+        if not ancestors:
             log.warning('Dataset %s doesn\'t seem to have a publisher!  '
                         'Unable to add publisher to index.',
                         pkg_dict['name'])
             return pkg_dict
+        publisher = ancestors[0]
 
         # Publisher names
         if not pkg_dict.has_key('publisher'):
-            pkg_dict['publisher'] = publisher.name
-            log.debug(u"Publisher: %s", publisher.name)
+            pkg_dict['publisher'] = publisher['name']
+            log.debug(u"Publisher: %s", publisher['name'])
         else:
             log.warning('Unable to add "publisher" to index, as the datadict '
                         'already contains a key of that name')
 
-        # Ancestry of publishers
-        ancestors = []
-        while(publisher is not None):
-            ancestors.append(publisher)
-            parent_publishers = publisher.get_parent_groups('organization')
-            if len(parent_publishers) == 0:
-                publisher = None
-            else:
-                if len(parent_publishers) > 1:
-                    log.warning('Publisher %s has more than one parent publisher. '
-                                'Ignoring all but the first. %s',
-                                publisher, repr(parent_publishers))
-                publisher = parent_publishers[0]
-
-
         if not pkg_dict.has_key('parent_publishers'):
-            pkg_dict['parent_publishers'] = [ p.name for p in ancestors ]
+            pkg_dict['parent_publishers'] = [ p['name'] for p in ancestors ]
         else:
             log.warning('Unable to add "parent_publishers" to index, as the datadict '
                         'already contains a key of that name. '
@@ -206,6 +369,12 @@ class SearchIndexing(object):
 
             data_dict = {'id': pkg_dict.get('harvest_object_id', '')}
 
+            documents = cls.prefetched.get('harvest_document')
+            if documents is not None and data_dict['id'] in documents:
+                pkg_dict['extras_harvest_document_content'] = \
+                    documents[data_dict['id']] or ''
+                return
+
             try:
                 harvest_object = get_action('harvest_object_show')(context, data_dict)
                 pkg_dict['extras_harvest_document_content'] = harvest_object.get('content', '')
@@ -266,7 +435,7 @@ class SearchIndexing(object):
         schemas = []
         for schema_id in schema_ids:
             try:
-                schemas.append(Schema.get(schema_id).title)
+                schemas.append(cls._title(Schema, 'schema', schema_id))
             except AttributeError, e:
                 log.error('Invalid schema_id: %r %s', schema_id, e)
         pkg_dict['schema_multi'] = schemas
@@ -280,6 +449,15 @@ class SearchIndexing(object):
             codelists = None
         codelists = []
         for codelist_id in codelist_ids:
-            codelists.append(Codelist.get(codelist_id).title)
+            codelists.append(cls._title(Codelist, 'codelist', codelist_id))
         pkg_dict['codelist_multi'] = codelists
         #log.debug('Code lists: %s', ' '.join(codelists))
+
+    @classmethod
+    def _title(cls, model_class, key, id_):
+        '''Returns the title of a Schema or Codelist, using the prefetched
+        titles if available. Raises AttributeError if it does not exist.'''
+        titles = cls.prefetched.get(key)
+        if titles is not None and id_ in titles:
+            return titles[id_]
+        return model_class.get(id_).title
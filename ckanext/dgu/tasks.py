@@ -8,8 +8,10 @@ import datetime
 import json
 import os
 import requests
+import threading
 import urlparse
 import traceback
+from collections import defaultdict
 
 import messytables
 
@@ -17,6 +19,7 @@ from ckan.lib.celery_app import celery
 import ckan.lib.munge as munge
 from ckan.lib.field_types import DateType, DateConvertError
 from ckanclient import CkanClient, CkanApiError
+from ckanext.dgu.lib.fetch_pool import FetchPool
 
 def _process_upload(context, data):
     """
@@ -28,6 +31,9 @@ def _process_upload(context, data):
                  'package': 'a_package_id',
                  'action':  'Added' or 'Updated'
                 }
+
+    The rows are processed in bulk by an InventoryUploader, and the progress
+    is written to the task_status after each batch.
     """
     log = inventory_upload.get_logger()
 
@@ -35,11 +41,6 @@ def _process_upload(context, data):
     results = []
 
     filename = data['file']
-    publisher_name = data['publisher']
-
-    import urlparse
-    client = CkanClient(base_location=urlparse.urljoin(context['site_url'],'api'),
-                        api_key=context['apikey'])
 
     tableset = None
     try:
@@ -47,7 +48,7 @@ def _process_upload(context, data):
         tableset = messytables.any_tableset(open(filename, 'r'), extension=ext[1:])
     except Exception, e:
         if str(e) == "Unrecognized MIME type: text/plain":
-            tableset = messytables.any_tableset(f, mimetype="text/csv")
+            tableset = messytables.any_tableset(open(filename, 'r'), mimetype="text/csv")
         else:
             errors.append("Unable to load file: {0}".format(e))
 
@@ -55,35 +56,33 @@ def _process_upload(context, data):
         errors.append("Unable to read data from uploaded file. Please contact a sysadmin.")
         return errors, results
 
-    first = True
-    pos = 0
-    for row in tableset.tables[0]:
-        pos = pos + 1
-        if first:
-            # Validate the header row to make sure it hasn't been modified
-            ok, msg = validate_incoming_inventory_header(row)
-            if not ok:
-                errors.append(msg)
-                break
-            first = False
-            continue
+    rows = list(enumerate(tableset.tables[0], 1))
+    if rows:
+        # Validate the header row to make sure it hasn't been modified
+        ok, msg = validate_incoming_inventory_header(rows.pop(0)[1])
+        if not ok:
+            errors.append(msg)
+            return errors, results
 
-        try:
-            pkg, msg = \
-                process_incoming_inventory_row(pos, row, publisher_name, client, log)
-            if pkg:
-                results.append({'package': pkg['id'], 'action': msg})
-        except Exception, exc:
-            row_identity = str(pos)
-            try:
-                row_identity += ' (%s)' % row[0].value
-            except:
-                pass
-            errors.append('Row %s: %s' % (row_identity, str(exc)))
-
-    if pos < 2 and len(errors) == 0:
+    if not rows:
         errors.append("There was not enough data in the upload file")
+        return errors, results
+
+    def progress(num_processed, row_errors):
+        update_task_status(context, {
+            'entity_id': data['jobid'],
+            'entity_type': u'inventory',
+            'task_type': 'inventory.upload',
+            'key': u'progress',
+            'value': json.dumps({'rows': num_processed, 'total': len(rows)}),
+            'state': 'Started',
+            'error': json.dumps(row_errors),
+            'last_updated': datetime.datetime.now().isoformat()
+        }, log)
 
+    uploader = InventoryUploader(context, log, progress=progress)
+    row_errors, results = uploader.process(rows)
+    errors.extend(row_errors)
     return errors, results
 
 
@@ -206,13 +205,12 @@ def validate_incoming_inventory_header(header_row):
 
     return True, ""
 
-def process_incoming_inventory_row(row_number, row, default_group_name, client, log):
+def parse_inventory_row(row, log):
     """
-    Reads the provided row and updates the information found in the
-    database where appropriate.
+    Reads the values of a spreadsheet row into a dict, checking the encoding
+    and converting the publish date.
 
-    The text of any exception raised will be shown to the user and the
-    processing aborted.
+    The text of any exception raised will be shown to the user.
     """
     try:
         title = row[0].value.encode('utf-8')
@@ -245,142 +243,351 @@ def process_incoming_inventory_row(row_number, row, default_group_name, client,
         log.error(msg)
         raise Exception(msg)
 
-    group = None
-    if publisher_name:
-        try:
-            result = client.action('group_search', query=publisher_name, exact=True)
-            if result['count'] == 0:
-                group = None
-                raise Exception('Publisher does not exist in data.gov.uk: "%s"' % publisher_name)
-            else:
-                group = result['results'][0]
-        except Exception, e:
-            log.exception('System error on group_search: %s', e)
-            raise Exception('System error checking publisher: %s' % e)
+    return {'title': title,
+            'description': description,
+            'publisher_name': publisher_name,
+            'publish_date': publish_date,
+            'release_notes': release_notes}
 
-    # First validation check, make sure we have enough to either update or create an
-    # unpublished item
-    missing_fields = []
-    if not title.strip():
-        missing_fields.append("Dataset title")
 
-    if not description.strip():
-        missing_fields.append("Description of dataset")
+def _row_error(row_number, row, exc):
+    row_identity = str(row_number)
+    try:
+        row_identity += ' (%s)' % row[0].value
+    except:
+        pass
+    return 'Row %s: %s' % (row_identity, str(exc))
 
-    if not group:
-        missing_fields.append("Owner")
 
-    if missing_fields:
-        raise Exception("The following fields were missing: {1}".format(", ".join(missing_fields)))
+def _search_phrase(text):
+    return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"')
 
-    # Check if we can find the dataset by title (for inventory items)
-    # If this happens it's kinda hard to work out which we want.  The group might be different
-    # to the one that the user just sent us, it might be that it belongs to someone else.
-    possibles = []
-    existing_pkg = None
-    log.info(title)
 
-    try:
-        results = client.package_search('',{'title':title})
-    except Exception, e:
-        log.error(e)
-        raise Exception("There was an error looking for existing datasets")
+class InventoryUploader(object):
+    """
+    Creates and updates the unpublished datasets for the rows of an
+    inventory spreadsheet, in bulk rather than a row at a time:
+
+     * the publishers named in the rows are looked up in one call
+     * the existing unpublished datasets of those publishers are loaded in one
+       (paged) search, to match the rows against by title
+     * the rows are then written in batches of BATCH_SIZE. Each batch's titles
+       are checked against the published datasets in one search, and its
+       datasets are created or updated over WRITE_WORKERS concurrent
+       requests.
+
+    Rows are matched, and errors reported, the same as when they were done one
+    at a time.
+    """
+    BATCH_SIZE = 50
+    WRITE_WORKERS = 4
+    SEARCH_ROWS = 1000
+
+    def __init__(self, context, log, progress=None):
+        """
+        progress - optional function called after each batch with the number
+                   of rows processed and the errors so far
+        """
+        self.api_url = urlparse.urljoin(context['site_url'], 'api')
+        self.api_key = context['apikey']
+        self.log = log
+        self.progress = progress
+        self._clients = threading.local()
+        # (publisher name, lower case title): [unpublished package names]
+        self.unpublished = defaultdict(list)
+        # package names known to be in use, or claimed by a row being written
+        self.names_taken = set()
+        self._names_lock = threading.Lock()
+
+    @property
+    def client(self):
+        """A CkanClient for the current thread, as each remembers the status
+        of its last request."""
+        client = getattr(self._clients, 'client', None)
+        if client is None:
+            client = self._clients.client = CkanClient(
+                base_location=self.api_url, api_key=self.api_key)
+        return client
+
+    def process(self, rows):
+        """
+        rows - [(row_number, row), ...] of the spreadsheet, after the header
+
+        Returns (errors, results) like _process_upload, with the errors in row
+        order.
+        """
+        errors = []  # (row_number, message)
+        results = []
+
+        items = []
+        for row_number, row in rows:
+            try:
+                item = parse_inventory_row(row, self.log)
+            except Exception, exc:
+                errors.append((row_number, _row_error(row_number, row, exc)))
+                continue
+            item['row_number'] = row_number
+            item['row'] = row
+            items.append(item)
+
+        publisher_names = set(item['publisher_name'] for item in items
+                              if item['publisher_name'])
+        try:
+            publishers = self.get_publishers(publisher_names)
+            publishers_error = None
+        except Exception, e:
+            self.log.exception('System error on organization_list: %s', e)
+            publishers, publishers_error = {}, e
 
-    log.info("Title lookup found {0} results".format(results['count']))
-    for pname in results['results']:
-        possible_pkg = _get_package(client, pname)
-        if not possible_pkg:
-            continue
+        valid_items = []
+        for item in items:
+            try:
+                item['group'] = self.validate(item, publishers,
+                                              publishers_error)
+            except Exception, exc:
+                errors.append((item['row_number'],
+                               _row_error(item['row_number'], item['row'], exc)))
+                continue
+            valid_items.append(item)
 
         try:
-            encoded_title = possible_pkg['title'].lower().encode('utf-8')
+            self.load_unpublished(set(item['group']['name']
+                                      for item in valid_items))
         except Exception, e:
-            raise Exception('Error with encoding of Title for package name %s: %s' % (pname, e))
-        if not encoded_title == title.lower():
-            log.info("{0} does not match title {1}".format(encoded_title, title) )
-            continue
+            self.log.error(e)
+            for item in valid_items:
+                errors.append((item['row_number'], _row_error(
+                    item['row_number'], item['row'],
+                    "There was an error looking for existing datasets")))
+            valid_items = []
+
+        num_processed = len(rows) - len(valid_items)
+        pool = FetchPool(workers=self.WRITE_WORKERS, errors=(Exception,))
+        for batch in self.batches(valid_items):
+            try:
+                published_titles = self.get_published_titles(
+                    [item['title'] for item in batch])
+            except Exception, e:
+                self.log.error(e)
+                published_titles = None
+            for item in batch:
+                item['published_titles'] = published_titles
+            for item, result, exc in pool.imap(self.write, batch):
+                if exc:
+                    errors.append((item['row_number'], _row_error(
+                        item['row_number'], item['row'], exc)))
+                    continue
+                pkg, msg = result
+                results.append({'package': pkg['id'], 'action': msg})
+                if msg == 'Added':
+                    self.unpublished[self.match_key(item)] = [pkg['name']]
+            num_processed += len(batch)
+            self.log.info('Processed %s/%s rows', num_processed, len(rows))
+            if self.progress:
+                try:
+                    self.progress(num_processed,
+                                  [msg for _, msg in sorted(errors)])
+                except Exception, e:
+                    # not worth abandoning the upload for
+                    self.log.error('Could not record progress: %s', e)
+
+        errors.sort()
+        return [msg for row_number, msg in errors], results
+
+    def search(self, **params):
+        """Yields the datasets for a package_search, a page at a time."""
+        start = 0
+        while True:
+            result = self.client.action('package_search', rows=self.SEARCH_ROWS,
+                                        start=start, **params)
+            for pkg in result['results']:
+                yield pkg
+            start += len(result['results'])
+            if not result['results'] or start >= result['count']:
+                break
 
-        if not possible_pkg['extras'].get('unpublished', False):
+    def get_publishers(self, publisher_names):
+        """Returns the publishers named, as {name_given: organization dict},
+        looking them up by name or title."""
+        if not publisher_names:
+            return {}
+        orgs = self.client.action('organization_list', all_fields=True)
+        by_name = {}
+        for org in orgs:
+            by_name[org['name']] = org
+            by_name.setdefault(org['title'], org)
+        return dict((name, by_name[name]) for name in publisher_names
+                    if name in by_name)
+
+    def validate(self, item, publishers, publishers_error=None):
+        """Checks the row has enough to either update or create an
+        unpublished item, and returns its publisher."""
+        publisher_name = item['publisher_name']
+        group = None
+        if publisher_name:
+            if publishers_error:
+                raise Exception('System error checking publisher: %s'
+                                % publishers_error)
+            group = publishers.get(publisher_name)
+            if not group:
+                raise Exception('Publisher does not exist in data.gov.uk: "%s"'
+                                % publisher_name)
+
+        missing_fields = []
+        if not item['title'].strip():
+            missing_fields.append("Dataset title")
+
+        if not item['description'].strip():
+            missing_fields.append("Description of dataset")
+
+        if not group:
+            missing_fields.append("Owner")
+
+        if missing_fields:
+            raise Exception("The following fields were missing: {0}".format(", ".join(missing_fields)))
+        return group
+
+    @staticmethod
+    def match_key(item):
+        return (item['group']['name'], item['title'].lower())
+
+    def load_unpublished(self, group_names):
+        """Loads the unpublished datasets of the publishers, to match the rows
+        against by title."""
+        if not group_names:
+            return
+        fq = '+unpublished:true +organization:(%s)' % \
+            ' OR '.join(_search_phrase(name) for name in group_names)
+        for pkg in self.search(q='*:*', fq=fq):
+            try:
+                title = pkg['title'].lower().encode('utf-8')
+            except Exception, e:
+                self.log.error('Error with encoding of Title for package name %s: %s',
+                               pkg['name'], e)
+                continue
+            org_name = (pkg.get('organization') or {}).get('name')
+            self.unpublished[(org_name, title)].append(pkg['name'])
+            self.names_taken.add(pkg['name'])
+        self.log.info('Loaded %s unpublished datasets of %s publishers',
+                      len(self.names_taken), len(group_names))
+
+    def get_published_titles(self, titles):
+        """Returns the titles (lower case) of any published datasets that have
+        one of the given titles."""
+        q = 'title:(%s)' % ' OR '.join(
+            _search_phrase(title.decode('utf-8')) for title in titles)
+        lower_titles = set(title.lower() for title in titles)
+        published_titles = set()
+        for pkg in self.search(q=q, fq='-unpublished:true'):
+            title = pkg['title'].lower().encode('utf-8')
+            if title in lower_titles:
+                published_titles.add(title)
+        return published_titles
+
+    def batches(self, items):
+        """Yields the items in batches, starting a new one rather than
+        writing two rows with the same title and publisher at once, so that
+        the second updates the dataset created by the first."""
+        batch = []
+        keys = set()
+        for item in items:
+            key = self.match_key(item)
+            if len(batch) >= self.BATCH_SIZE or key in keys:
+                yield batch
+                batch = []
+                keys = set()
+            batch.append(item)
+            keys.add(key)
+        if batch:
+            yield batch
+
+    def write(self, item):
+        """
+        Updates the unpublished dataset with the row's title, or creates one,
+        and returns (package, "Updated" or "Added").
+
+        The text of any exception raised will be shown to the user.
+        """
+        title = item['title']
+        group = item['group']
+        log = self.log
+        if item['published_titles'] is None:
+            raise Exception("There was an error looking for existing datasets")
+        if title.lower() in item['published_titles']:
             # If the title has matched exactly, and the thing we matched isn't an
             # unpublished item, we should alert the user to the existing of the dataset
             raise Exception("The non-inventory dataset '{0}' already exists".format(title))
 
-        if group['name'] != possible_pkg.get('organization', {}).get('name'):
-            log.info("Group name {0} does not match this possible packages organization in {1}".format(group['name'],possible_pkg['organization']))
-            continue
-
-        log.info("Adding {0} as possible package".format(possible_pkg['name']))
-        possibles.append(possible_pkg)
-
-    log.info("There are {0} possible matches".format(len(possibles)))
-
-    # If we can edit only one of them, then we should do that.
-    existing_pkg = None
-    if len(possibles) == 1:
-        existing_pkg = possibles[0]
-    elif len(possibles) > 1:
-        raise Exception("Found {0} existing unpublished items with title '{1}'".format(len(possibles), title))
-
-    log.debug("Existing package? {0}".format(not existing_pkg is None))
-    if existing_pkg:
-        existing_pkg['extras']['release-notes'] = release_notes
-        existing_pkg['extras']['publish-date'] = publish_date
-        existing_pkg['notes'] = description or pkg.notes
+        # Only an unpublished item of the same publisher can be edited, as
+        # one with a different publisher belongs to someone else
+        possibles = self.unpublished.get(self.match_key(item), [])
+        log.info("There are {0} possible matches for {1}".format(len(possibles), title))
+        if len(possibles) > 1:
+            raise Exception("Found {0} existing unpublished items with title '{1}'".format(len(possibles), title))
+
+        existing_pkg = _get_package(self.client, possibles[0]) if possibles else None
+        if existing_pkg:
+            existing_pkg['extras']['release-notes'] = item['release_notes']
+            existing_pkg['extras']['publish-date'] = item['publish_date']
+            existing_pkg['notes'] = item['description']
+
+            self.client.package_entity_put(existing_pkg)
+
+            return (existing_pkg, "Updated",)
+
+        # Looks like a new unpublished item, so we'll create a new one.
+        package = {}
+        package["title"] = title
+        package["name"] = self.get_clean_name(title)
+        package["notes"] = item['description'] or " "
+        package["access_constraints"] = ""
+        package["api_version"] = "3"
+        package['license_id']  = "unpublished"
+        package['foi-name'] = ""
+        package['foi-email'] = ""
+        package['foi-web'] = ""
+        package['foi-phone'] = ""
+        package['contact-email'] = ""
+        package['contact-phone'] = ""
+        package['contact-name'] = ""
+        package['theme-primary'] = ""
+
+        package['owner_org'] = group['name']
+
+        # Setup unublished specific items
+        extras = {
+            'unpublished': True,
+            'publish-date': item['publish_date'],
+            'release-notes': item['release_notes']
+        }
+        package['extras'] = extras
 
-        client.package_entity_put(existing_pkg)
+        log.info("Creating new unpublished package: {0}".format(package['name']))
 
-        return (existing_pkg, "Updated",)
+        try:
+            package = self.client.package_register_post(package)
+        except Exception, e:
+            log.error(e)
+            raise Exception("There was a problem saving '{0}'".format(title))
 
-    log.info("Creating new dataset: {0}".format(title))
-    # Looks like a new unpublished item, so we'll create a new one.
+        return (package, "Added",)
 
-    def get_clean_name(s):
-        current = s
+    def get_clean_name(self, title):
+        """Returns an unused package name for the title, claiming it so that
+        another row being written at the same time doesn't get it too."""
+        current = title
         counter = 1
         while True:
             current = munge.munge_title_to_name(current)
-            if not _get_package(client, current):
+            with self._names_lock:
+                claimed = current in self.names_taken
+                self.names_taken.add(current)
+            if not claimed and not _get_package(self.client, current):
                 break
-            current = "{0}_{1}".format(s, counter)
+            current = "{0}_{1}".format(title, counter)
             counter = counter + 1
         return current
 
-    package = {}
-    package["title"] = title
-    package["name"] = get_clean_name(title)
-    package["notes"] = description or " "
-    package["access_constraints"] = ""
-    package["api_version"] = "3"
-    package['license_id']  = "unpublished"
-    package['foi-name'] = ""
-    package['foi-email'] = ""
-    package['foi-web'] = ""
-    package['foi-phone'] = ""
-    package['contact-email'] = ""
-    package['contact-phone'] = ""
-    package['contact-name'] = ""
-    package['theme-primary'] = ""
-
-    package['owner_org'] = group['name']
-
-    # Setup unublished specific items
-    extras = {
-        'unpublished': True,
-        'publish-date': publish_date,
-        'release-notes':release_notes
-    }
-    package['extras'] = extras
-
-    log.info("Creating new unpublished package: {0}".format(package['name']))
-
-    try:
-        package = client.package_register_post(package)
-    except Exception, e:
-        log.error(e)
-        raise Exception("There was a problem saving '{0}'".format(title))
-
-    return (package, "Added",)
-
 def _get_package(client, pkg_name):
     try:
         pkg = client.package_entity_get(pkg_name)
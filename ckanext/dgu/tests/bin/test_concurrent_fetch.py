@@ -0,0 +1,80 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.dgu.bin.concurrent_fetch import JsonlExport
+
+
+class TestJsonlExport(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output_fpath = os.path.join(self.tmp_dir, 'nodes.jsonl.gz')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def export(self, nids, resume=False, interrupt_at=None,
+               interrupt_after_write=False):
+        with JsonlExport(self.output_fpath, resume=resume,
+                         commit_every=3) as export:
+            for nid in nids:
+                if unicode(nid) in export.done:
+                    continue
+                export.mark_done(nid)
+                if nid == interrupt_at and not interrupt_after_write:
+                    raise KeyboardInterrupt
+                export.write({'nid': nid})
+                if nid == interrupt_at:
+                    # e.g. raised while fetching the next item
+                    raise KeyboardInterrupt
+
+    def read_nids(self):
+        return [json.loads(line)['nid']
+                for line in gzip.open(self.output_fpath, 'rb')]
+
+    def test_export(self):
+        self.export(range(10))
+        assert_equal(self.read_nids(), range(10))
+        assert not os.path.exists(self.output_fpath + '.checkpoint')
+
+    def test_resume(self):
+        assert_raises(KeyboardInterrupt, self.export, range(10),
+                      interrupt_at=7)
+        assert os.path.exists(self.output_fpath + '.checkpoint')
+        self.export(range(10), resume=True)
+        assert_equal(self.read_nids(), range(10))
+
+    def test_resume_truncated_output(self):
+        assert_raises(KeyboardInterrupt, self.export, range(10),
+                      interrupt_at=7)
+        # lose the gzip trailer, as if the process was killed
+        with open(self.output_fpath, 'rb') as f:
+            data = f.read()
+        with open(self.output_fpath, 'wb') as f:
+            f.write(data[:-8])
+        self.export(range(10), resume=True)
+        assert_equal(self.read_nids(), range(10))
+
+    def test_resume_after_record_written(self):
+        assert_raises(KeyboardInterrupt, self.export, range(10),
+                      interrupt_at=7, interrupt_after_write=True)
+        self.export(range(10), resume=True)
+        assert_equal(self.read_nids(), range(10))
+
+    def test_resume_after_kill(self):
+        export = JsonlExport(self.output_fpath, commit_every=3).__enter__()
+        for nid in range(8):
+            export.mark_done(nid)
+            export.write({'nid': nid})
+        # records 6 and 7 reach the disk, but not their ids, as if the
+        # process was killed before its next checkpoint
+        export.output_f.flush()
+        export.output_f.fileobj.flush()
+        export.checkpoint_f.close()
+
+        self.export(range(10), resume=True)
+        assert_equal(self.read_nids(), range(10))
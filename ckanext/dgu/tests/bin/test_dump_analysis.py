@@ -0,0 +1,102 @@
+import gzip
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.dgu.bin.dump_analysis import (iter_json_array, DumpAnalysis,
+                                           DumpAnalysisOptions, analyse_dumps)
+
+
+class TestIterJsonArray(object):
+    def test_small_chunks(self):
+        data = [{'name': u'caf\xe9', 'extras': {'a': [1, {'b': ']'}]}},
+                12345, None, 'string']
+        json_str = json.dumps(data, indent=4, ensure_ascii=False)\
+            .encode('utf-8')
+        for chunk_size in (1, 3, 100):
+            assert_equal(list(iter_json_array(StringIO(json_str),
+                                              chunk_size)), data)
+
+    def test_empty(self):
+        assert_equal(list(iter_json_array(StringIO(' [ ] '))), [])
+
+    def test_not_terminated(self):
+        assert_raises(ValueError, list,
+                      iter_json_array(StringIO('[{"a": 1}, ')))
+
+    def test_not_array(self):
+        assert_raises(ValueError, list, iter_json_array(StringIO('{"a": 1}')))
+
+
+class TestDumpAnalysis(object):
+    def test_analysis(self):
+        packages = [
+            {'name': 'ons1', 'state': 'active',
+             'extras': {'import_source': 'ONS-feed',
+                        'published_by': 'Office [123]'}},
+            {'name': 'uklp1', 'state': 'active',
+             'extras': {'UKLP': 'True', 'theme-primary': 'Transportation'}},
+            {'name': 'manual1', 'state': 'active',
+             'extras': {'unpublished': 'true'}},
+            {'name': 'deleted1', 'state': 'deleted', 'extras': {}},
+            ]
+        dump_filepath = tempfile.mktemp(suffix='-2015-01-02.json.gz')
+        f = gzip.open(dump_filepath, 'wb')
+        json.dump(packages, f)
+        f.close()
+        try:
+            analysis = DumpAnalysis(dump_filepath, DumpAnalysisOptions(
+                analyse_by_source=True, analyse_ons_by_published_by=True,
+                analyse_by_theme=True))
+        finally:
+            os.remove(dump_filepath)
+
+        assert_equal(analysis.date.isoformat(), '2015-01-02')
+        assert_equal(dict(analysis.analysis_dict), {
+            'Total datasets': 3,
+            'Datasets by source: National Statistics Publication Hub feed': 1,
+            'Datasets by source: UKLP': 1,
+            'Datasets by source: Spreadsheet upload for unpublished datasets': 1,
+            'National Statistics Pub Hub by published_by: Office': 1,
+            'Datasets by theme: Transport': 1,
+            'Datasets by theme: No value': 2,
+            })
+
+    def test_options_pickle(self):
+        options = DumpAnalysisOptions(analyse_by_theme=True)
+        options = pickle.loads(pickle.dumps(options))
+        assert_equal(options.analyse_by_theme, True)
+        assert_equal(options.analyse_by_source, None)
+
+    def test_analyse_dumps_in_processes(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dump_filepaths = []
+            for date, count in (('2015-01-02', 1), ('2015-02-03', 2)):
+                packages = [{'name': 'pkg%s' % i, 'state': 'active',
+                             'extras': {'theme-primary': 'Health'}}
+                            for i in range(count)]
+                dump_filepath = os.path.join(tmp_dir,
+                                             'data-%s.json.gz' % date)
+                f = gzip.open(dump_filepath, 'wb')
+                json.dump(packages, f)
+                f.close()
+                dump_filepaths.append(dump_filepath)
+
+            results = analyse_dumps(
+                dump_filepaths, DumpAnalysisOptions(analyse_by_theme=True),
+                processes=2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        assert_equal([(date.isoformat(), dict(analysis_dict))
+                      for date, analysis_dict in results],
+                     [('2015-01-02', {'Total datasets': 1,
+                                      'Datasets by theme: Health': 1}),
+                      ('2015-02-03', {'Total datasets': 2,
+                                      'Datasets by theme: Health': 2})])
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_almost_equal
+
+from ckanext.dgu.bin.server_log_tool import (
+    chunk_offsets, read_chunk_lines, parse_line, parse_chunk, LogSummary,
+    columns)
+
+LINE = '1.2.3.4 - - [10/Oct/2014:13:55:%02d +0000] "GET %s HTTP/1.1" 200 2326 "-" "Mozilla/5.0"%s\n'
+
+
+def log_line(path='/dataset/abc', times=' 0.250 0.240', second=0):
+    return LINE % (second, path, times)
+
+
+class TestServerLogTool(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmp_dir, 'access.log')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_log(self, lines):
+        with open(self.filepath, 'wb') as f:
+            f.write(''.join(lines))
+
+    def test_chunks_read_every_line_once(self):
+        lines = [log_line('/dataset/%s' % ('x' * i), second=i % 60)
+                 for i in range(30)]
+        self.write_log(lines)
+        for chunk_size in (1, 7, 100, len(lines[0]), len(lines[0]) + 1,
+                           10000):
+            read = []
+            for start, end in chunk_offsets(self.filepath, chunk_size):
+                read.extend(read_chunk_lines(self.filepath, start, end))
+            assert_equal(read, lines)
+
+    def test_parse_line_with_serve_times(self):
+        row = dict(zip(columns, parse_line(log_line())))
+        assert_equal(row['url'], 'GET /dataset/abc HTTP/1.1')
+        assert_equal(row['status'], 200)
+        assert_equal(row['serve_time'], 0.25)
+        assert_equal(row['serve_time_upstream'], 0.24)
+
+    def test_parse_line_without_serve_times(self):
+        row = dict(zip(columns, parse_line(log_line(times=''))))
+        assert_equal(row['url'], 'GET /dataset/abc HTTP/1.1')
+        assert_equal(row['serve_time'], None)
+        assert_equal(row['serve_time_upstream'], None)
+
+    def test_parse_line_cache_hit(self):
+        row = dict(zip(columns, parse_line(log_line(times=' 0.001 -'))))
+        assert_equal(row['serve_time'], 0.001)
+        assert_equal(row['serve_time_upstream'], None)
+
+    def test_parse_line_unparseable(self):
+        assert_equal(parse_line('not a log line\n'), None)
+
+    def test_parse_chunk_routes(self):
+        self.write_log([log_line('/dataset/abc?q=1'),
+                        log_line('/api/action/package_show?id=1'),
+                        log_line('/data/search?q=fish', times=''),
+                        log_line('/'),
+                        'not a log line\n'])
+        df, unparsed = parse_chunk(
+            (self.filepath, 0, os.path.getsize(self.filepath)))
+        assert_equal(list(df['route']),
+                     ['/dataset', '/api/action', '/data/search', '/'])
+        assert_equal(unparsed, 1)
+        assert_equal(str(df.index[0]), '2014-10-10 13:55:00')
+
+    def test_summary(self):
+        # 100 requests to /dataset taking 0.01s to 1s, and 20 served from
+        # the cache, split over two chunks
+        lines = [log_line(times=' %.2f %.2f' % (i / 100.0, i / 100.0))
+                 for i in range(1, 101)]
+        lines += [log_line(times=' 0.001 -')] * 20
+        lines += [log_line(times='')] * 5
+        self.write_log(lines)
+        size = os.path.getsize(self.filepath)
+        summary = LogSummary(top=3)
+        for start, end in ((0, size / 2), (size / 2, size)):
+            summary.add(parse_chunk((self.filepath, start, end))[0])
+
+        assert_equal(summary.requests, 125)
+        assert_almost_equal(summary.cache_hit_ratio(), 20 / 120.0)
+        [(route, requests, p50, p95, p99)] = summary.route_percentiles()
+        assert_equal((route, requests), ('/dataset', 100))
+        # percentiles are the upper edge of ~2% wide bins
+        for percentile, expected in ((p50, 0.50), (p95, 0.95), (p99, 0.99)):
+            assert expected <= percentile <= expected * 1.03, \
+                (percentile, expected)
+        assert_equal(list(summary.slowest['serve_time_upstream']),
+                     [1.0, 0.99, 0.98])
+
+    def test_cache_hit_ratio_without_serve_times(self):
+        self.write_log([log_line(times='')])
+        summary = LogSummary()
+        summary.add(parse_chunk(
+            (self.filepath, 0, os.path.getsize(self.filepath)))[0])
+        assert_equal(summary.cache_hit_ratio(), None)
@@ -395,6 +395,29 @@ class TestDguApi(ControllerTestCase, TestSearchIndexer):
         res = self.app.get(pkg['publisher_link'], status=[200])
         assert 'National Health Service' in res.body, res
 
+    def test_latest_datasets_cache_invalidated_on_commit(self):
+        offset = '/api/util/latest-datasets?limit=1'
+        res = json.loads(self.app.get(offset, status=[200]).body)
+        assert_equal(res[0]['name'], 'latest')
+
+        DguCreateTestData.create_arbitrary({'name': 'later',
+                                            'groups': ['national-health-service']})
+        self.tsi.index()
+
+        res = json.loads(self.app.get(offset, status=[200]).body)
+        assert_equal(res[0]['name'], 'later')
+
+    def test_new_dataset_counted_on_commit(self):
+        offset = '/api/util/dataset-count'
+        count = json.loads(self.app.get(offset, status=[200]).body)
+
+        DguCreateTestData.create_arbitrary({'name': 'counted',
+                                            'groups': ['national-health-service']})
+        self.tsi.index()
+
+        res = json.loads(self.app.get(offset, status=[200]).body)
+        assert_equal(res, count + 1)
+
 def pkg_id(pkg_name):
     return model.Package.by_name(pkg_name).id
 
@@ -562,6 +585,33 @@ class TestDrupalApi(ControllerTestCase, TestSearchIndexer):
         assert set(res.keys()) >= set(('since_timestamp', 'datasets')), res.keys()
         revs = self._get_revisions()
         assert_equal(res['since_revision_id'], revs[0].id)
-        assert_equal(res['newest_revision_id'], revs[-1].id)
-        assert res['number_of_revisions'] == len(revs), res['number_of_revisions']
-        assert res['results_limited'] == True, res['results_limited']
+        assert_equal(res['number_of_revisions'], min(len(revs), 50))
+        assert_equal(res['results_limited'], len(revs) > 50)
+        if not res['results_limited']:
+            assert_equal(res['newest_revision_id'], revs[-1].id)
+
+    def test_revisions__paging(self):
+        revs = self._get_revisions()
+        offset = '/api/util/revisions?in-the-last-x-minutes=5&limit=2'
+        rev_ids = []
+        dataset_names = set()
+        while True:
+            res = json.loads(self.app.get(offset, status=[200]).body)
+            assert res['number_of_revisions'] <= 2, res
+            rev_ids.append(res['since_revision_id'])
+            rev_ids.append(res['newest_revision_id'])
+            dataset_names.update(pkg['name'] for pkg in res['datasets'])
+            if not res['results_limited']:
+                break
+            assert_equal(res['next_after_revision_id'],
+                         res['newest_revision_id'])
+            offset = '/api/util/revisions?after-revision-id=%s&limit=2' % \
+                res['next_after_revision_id']
+        assert_equal(rev_ids[0], revs[0].id)
+        assert_equal(rev_ids[-1], revs[-1].id)
+        assert 'latest' in dataset_names, dataset_names
+
+    def test_revisions__bad_limit(self):
+        for limit in ('0', '-1', 'x'):
+            offset = '/api/util/revisions?in-the-last-x-minutes=5&limit=%s' % limit
+            self.app.get(offset, status=[400])
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import zipfile
+
+import unicodecsv as csv
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.dgu.lib.dumper import (CSVDumper, DATASET_COLUMNS,
+                                    RESOURCE_COLUMNS)
+from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+
+
+class TestCSVDumper(object):
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+        cls.zip_filepath = tempfile.mktemp(suffix='.csv.zip')
+        # small batches, so that the datasets span several of them
+        CSVDumper(batch_size=2).dump(cls.zip_filepath)
+        zip_file = zipfile.ZipFile(cls.zip_filepath)
+        cls.datasets = list(csv.reader(zip_file.open('datasets.csv')))
+        cls.resources = list(csv.reader(zip_file.open('resources.csv')))
+
+    @classmethod
+    def teardown_class(cls):
+        os.remove(cls.zip_filepath)
+        model.repo.rebuild_db()
+
+    def test_headers(self):
+        assert_equal(self.datasets[0], DATASET_COLUMNS)
+        assert_equal(self.resources[0], RESOURCE_COLUMNS)
+
+    def test_datasets_in_name_order(self):
+        names = [row[0] for row in self.datasets[1:]]
+        assert_equal(names, sorted(names))
+        assert 'cabinet-office-energy-use' in names, names
+
+    def test_dataset_row(self):
+        row = dict(zip(DATASET_COLUMNS,
+                       [row for row in self.datasets
+                        if row[0] == 'cabinet-office-energy-use'][0]))
+        assert_equal(row['Title'], 'Cabinet Office 70 Whitehall energy use')
+        assert_equal(row['Organization'], 'Cabinet Office')
+        assert_equal(row['Published'], 'True')
+        assert 'energy-use' in row['Tags'].split(','), row['Tags']
+
+    def test_resources(self):
+        pkg = model.Package.by_name('directgov-cota')
+        rows = [row for row in self.resources[1:]
+                if row[0] == 'directgov-cota']
+        assert_equal(len(rows), len(pkg.resources))
+        assert_equal([row[4] for row in rows],
+                     [res.id for res in pkg.resources])
@@ -0,0 +1,51 @@
+import time
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.dgu.lib.fetch_pool import FetchPool
+
+
+class NotFound(Exception):
+    pass
+
+
+def fetch(item):
+    # later items return sooner, so results arrive out of order
+    time.sleep(0.01 * (5 - item % 5))
+    if item == 3:
+        raise NotFound('There is no node with nid %s' % item)
+    return item * 10
+
+
+class TestFetchPool(object):
+    def test_results_in_order(self):
+        pool = FetchPool(workers=4, errors=(NotFound,))
+        results = list(pool.imap(fetch, range(12)))
+        assert_equal([item for item, result, error in results], range(12))
+        assert_equal(results[2], (2, 20, None))
+        assert_equal(results[3][1], None)
+        assert_equal(str(results[3][2]), 'There is no node with nid 3')
+        assert_equal(pool.fetched, 12)
+
+    def test_unexpected_error_raised(self):
+        pool = FetchPool(workers=4)
+        assert_raises(NotFound, list, pool.imap(fetch, range(12)))
+
+    def test_rate_limit(self):
+        pool = FetchPool(workers=4, rate=50)
+        start = time.time()
+        list(pool.imap(lambda item: item, range(11)))
+        # 10 intervals of 1/50s
+        assert time.time() - start >= 0.19, time.time() - start
+
+    def test_generator_not_read_ahead(self):
+        read = []
+        def items():
+            for item in range(100):
+                read.append(item)
+                yield item
+        pool = FetchPool(workers=2)
+        for item, result, error in pool.imap(lambda item: item, items()):
+            if item == 10:
+                break
+        assert len(read) < 20, len(read)
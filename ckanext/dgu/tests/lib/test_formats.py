@@ -0,0 +1,45 @@
+from nose.tools import assert_equal
+
+from ckanext.dgu.lib.formats import LRUCache, FormatNormaliser
+
+
+class TestLRUCache(object):
+    def test_get_set(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        assert_equal(cache.get('a'), 1)
+        assert_equal(cache.get('b'), None)
+        assert_equal((cache.hits, cache.misses), (1, 1))
+
+    def test_discards_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert_equal(len(cache), 2)
+        assert_equal(cache.get('a'), 1)
+        assert_equal(cache.get('b'), None)
+        assert_equal(cache.get('c'), 3)
+
+
+class TestFormatNormaliser(object):
+    def setup(self):
+        self.normaliser = FormatNormaliser()
+
+    def test_canonical(self):
+        assert_equal(self.normaliser.canonical_format('.Csv '), 'CSV')
+        assert_equal(self.normaliser.clean_format('.Csv '), 'CSV')
+
+    def test_unknown(self):
+        assert_equal(self.normaliser.canonical_format('Not a $format'), None)
+        assert_equal(self.normaliser.clean_format('Not a $format'), 'Not a format')
+
+    def test_not_a_string(self):
+        assert_equal(self.normaliser.clean_format(None), None)
+
+    def test_memoized(self):
+        self.normaliser.clean_format('xls')
+        self.normaliser.clean_format('xls')
+        assert_equal((self.normaliser.cache.hits, self.normaliser.cache.misses),
+                     (1, 1))
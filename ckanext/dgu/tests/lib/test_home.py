@@ -2,7 +2,7 @@ import os
 
 from nose.tools import assert_equal
 
-from ckanext.dgu.lib.home import get_themes
+from ckanext.dgu.lib.home import get_themes, Counters
 from ckanext.taxonomy.models import init_tables as init_taxonomy_tables
 from ckanext.taxonomy import lib as taxonomy_lib
 
@@ -22,3 +22,25 @@ class TestHome(object):
         assert_equal(themes[0][0], 'Business and economy')
         assert_equal(themes[0][1], 'Business & Economy')
         assert_equal(themes[0][2], 'Small businesses, industry, imports, exports and trade')
+
+
+class TestCounters(object):
+    def setup(self):
+        self.load = Counters.load
+        Counters.invalidate()
+
+    def teardown(self):
+        Counters.load = self.load
+        Counters.invalidate()
+
+    def test_search_failure_not_kept(self):
+        Counters.load = classmethod(lambda cls: cls(0, 0, {}, {}, failed=True))
+        assert_equal(Counters.get().datasets, 0)
+        assert_equal(Counters._snapshot, None)
+
+    def test_search_failure_keeps_previous(self):
+        Counters.load = classmethod(lambda cls: cls(10, 8, {}, {}))
+        counters = Counters.get()
+        counters.created -= 3600  # expired
+        Counters.load = classmethod(lambda cls: cls(0, 0, {}, {}, failed=True))
+        assert_equal(Counters.get().datasets, 10)
@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.dgu.lib.incremental_dump import DumpCache, IncrementalDump
+from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+
+
+class TestDumpCache(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = DumpCache(os.path.join(self.dir, 'test.db'))
+
+    def teardown(self):
+        self.cache.close()
+        shutil.rmtree(self.dir)
+
+    def test_get(self):
+        self.cache.set(u'id1', '2015-01-01T00:00:00', 'part\nwith newline')
+        assert_equal(self.cache.get(u'id1', '2015-01-01T00:00:00'),
+                     'part\nwith newline')
+
+    def test_modified(self):
+        self.cache.set(u'id1', '2015-01-01T00:00:00', 'part')
+        assert_equal(self.cache.get(u'id1', '2015-01-02T00:00:00'), None)
+
+    def test_missing(self):
+        assert_equal(self.cache.get(u'id1', '2015-01-01T00:00:00'), None)
+
+
+class TestIncrementalDump(object):
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def setup(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.dump_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.dump_dir)
+
+    def _read_json_dump(self, dump_file_base):
+        zip_file = zipfile.ZipFile(os.path.join(
+            self.dump_dir, dump_file_base + '.json.zip'))
+        return json.loads(zip_file.read(dump_file_base + '.json'))
+
+    def _read_delta(self, dump_file_base):
+        with open(os.path.join(self.dump_dir,
+                               dump_file_base + '.delta.json')) as f:
+            return json.load(f)
+
+    def test_second_run_serializes_nothing(self):
+        dumper = IncrementalDump(self.cache_dir)
+        dumper.run(self.dump_dir, 'day1', ['json', 'csv'])
+        dumper.run(self.dump_dir, 'day2', ['json', 'csv'])
+
+        num_datasets = model.Session.query(model.Package)\
+            .filter_by(state='active').count()
+        assert_equal(len(self._read_delta('day1')['changed']), num_datasets)
+        assert_equal(self._read_delta('day2')['changed'], [])
+        assert_equal(self._read_json_dump('day1'),
+                     self._read_json_dump('day2'))
+        assert_equal(len(self._read_json_dump('day2')), num_datasets)
+        assert os.path.exists(os.path.join(
+            self.dump_dir, 'data.gov.uk-ckan-meta-data-latest.csv.zip'))
+        assert os.path.exists(os.path.join(
+            self.dump_dir, 'data.gov.uk-ckan-meta-data-latest.manifest.json'))
+
+    def test_group_membership_change(self):
+        dumper = IncrementalDump(self.cache_dir)
+        dumper.run(self.dump_dir, 'day1', ['json'])
+        pkg = model.Package.by_name(u'directgov-cota')
+        group = model.Group.get(u'cabinet-office')
+        model.repo.new_revision()
+        model.Session.add(model.Member(group=group, table_id=pkg.id,
+                                       table_name='package',
+                                       capacity='public'))
+        model.repo.commit_and_remove()
+
+        dumper.run(self.dump_dir, 'day2', ['json'])
+
+        assert_equal([dataset['name'] for dataset in
+                      self._read_delta('day2')['changed']],
+                     ['directgov-cota'])
+        pkg_dict = [dataset for dataset in self._read_json_dump('day2')
+                    if dataset['name'] == 'directgov-cota'][0]
+        assert 'cabinet-office' in pkg_dict['groups'], pkg_dict['groups']
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.dgu.lib.ingest import Ingester, IngestException
+
+
+class TestIngester(object):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def ingester(self, lines):
+        filepath = os.path.join(self.tmp_dir, 'ingest.csv')
+        with open(filepath, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return Ingester(filepath)
+
+    def test_process(self):
+        ingester = self.ingester(['Name,Number', 'a,1', 'b,2'])
+        rows = []
+
+        ingester.process(rows.append)
+
+        assert_equal([list(row) for row in rows], [['a', '1'], ['b', '2']])
+        assert_equal(rows[1]['Number'], '2')
+        assert_equal(rows[1].number, 3)
+
+    def test_process_batches(self):
+        ingester = self.ingester(['Name'] + ['row%s' % i for i in range(7)])
+        batches = []
+
+        ingester.process(batches.append, batch_size=3)
+
+        assert_equal([[row['Name'] for row in batch] for batch in batches],
+                     [['row0', 'row1', 'row2'], ['row3', 'row4', 'row5'],
+                      ['row6']])
+
+    def test_blank_row_raised_after_rows_before_it(self):
+        ingester = self.ingester(['Name', 'a', 'b', ',', 'c'])
+        rows = []
+
+        assert_raises(IngestException, ingester.process, rows.extend,
+                      batch_size=10)
+        assert_equal([row['Name'] for row in rows], ['a', 'b'])
+
+    def test_header_validator(self):
+        ingester = self.ingester(['Wrong', 'a'])
+        rows = []
+
+        assert_raises(IngestException, ingester.process, rows.append,
+                      header_validator=lambda row: (row[0] == 'Name', 'Bad'))
+        assert_equal(rows, [])
+
+    def test_processor_error_continues(self):
+        ingester = self.ingester(['Name', 'a', 'b', 'c'])
+        rows = []
+
+        def processor(row):
+            if row['Name'] == 'b':
+                raise IngestException('Skip b', True)
+            rows.append(row)
+        ingester.process(processor)
+
+        assert_equal([row['Name'] for row in rows], ['a', 'c'])
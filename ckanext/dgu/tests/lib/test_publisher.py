@@ -129,3 +129,125 @@ class TestGoDownTree:
     def test_barnsley(self):
         assert_equal(to_names(go_down_tree(model.Group.get(u'barnsley-primary-care-trust'))),
                      ['barnsley-primary-care-trust'])
+
+class TestPublisherHierarchy:
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+        cls.hierarchy = PublisherHierarchy.load()
+
+    @classmethod
+    def teardown_class(cls):
+        PublisherHierarchy.invalidate()
+        model.repo.rebuild_db()
+
+    def test_publisher(self):
+        nhs = self.hierarchy.publisher('national-health-service')
+        assert_equal(nhs['id'], model.Group.get(u'national-health-service').id)
+        assert_equal(nhs['abbreviation'], 'NHS')
+        assert_equal(self.hierarchy.publisher(nhs['id']), nhs)
+
+    def test_publisher_unknown(self):
+        assert_equal(self.hierarchy.publisher('not-a-publisher'), None)
+
+    def test_ancestors_doh(self):
+        assert_equal([p['name'] for p in self.hierarchy.ancestors('dept-health')],
+                     ['dept-health'])
+
+    def test_ancestors_barnsley(self):
+        assert_equal([p['name'] for p in self.hierarchy.ancestors('barnsley-primary-care-trust')],
+                     ['barnsley-primary-care-trust', 'national-health-service', 'dept-health'])
+
+    def test_descendants_nhs(self):
+        names = [self.hierarchy.publishers[id_]['name']
+                 for id_ in self.hierarchy.descendants('national-health-service')]
+        assert_equal(sorted(names),
+                     ['barnsley-primary-care-trust', 'national-health-service', 'newham-primary-care-trust'])
+
+    def test_get_for_new_publisher(self):
+        PublisherHierarchy.invalidate()
+        hierarchy = PublisherHierarchy.get()
+        model.repo.new_revision()
+        model.Session.add(model.Group(name=u'new-publisher', title=u'New Publisher',
+                                      type='organization', is_organization=True))
+        model.repo.commit_and_remove()
+        # as if it was created by another process, some time after the load
+        hierarchy.created -= 60
+        PublisherHierarchy._snapshot = hierarchy
+
+        assert_equal(PublisherHierarchy.get_for('new-publisher')
+                     .publisher('new-publisher')['title'], 'New Publisher')
+        # and an unknown publisher doesn't reload it again straight away
+        snapshot = PublisherHierarchy.get_for('not-a-publisher')
+        assert PublisherHierarchy.get_for('not-a-publisher') is snapshot
+
+class TestOpennessScores:
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+        # directgov-cota (NHS) has a resource with score 0 already
+        DguCreateTestData.create_task_statuses([
+            {'package_name': 'nhs-spend-over-25k-barnsleypct',
+             'resource_index': 0,
+             'task_type': 'qa',
+             'key': 'openness_score',
+             'value': '3'}])
+        cls.nhs = model.Group.get(u'national-health-service')
+        cls.barnsley = model.Group.get(u'barnsley-primary-care-trust')
+
+    @classmethod
+    def teardown_class(cls):
+        PublisherHierarchy.invalidate()
+        model.repo.rebuild_db()
+
+    def test_openness_score_counts(self):
+        counts = openness_score_counts()
+        assert_equal(dict(counts[self.nhs.id]), {'0': 1})
+        assert_equal(dict(counts[self.barnsley.id]), {'3': 1})
+        assert_equal(set(counts), set([self.nhs.id, self.barnsley.id]))
+
+    def test_openness_score_counts_for_groups(self):
+        counts = openness_score_counts([self.barnsley.id])
+        assert_equal(dict((id_, dict(c)) for id_, c in counts.items()),
+                     {self.barnsley.id: {'3': 1}})
+
+    def test_cached_openness_scores(self):
+        cached_openness_scores()
+        model.Session.remove()
+        # it is read from the cache, not calculated
+        assert model.DataCache.get_fresh(self.nhs.name,
+                                         'openness-scores-withsub')
+
+        for publisher, include_sub_publishers, expected in (
+                (self.nhs, False, (1, {'0': 1})),
+                (self.nhs, True, (2, {'0': 1, '3': 1})),
+                (self.barnsley, False, (1, {'3': 1})),
+                (self.barnsley, True, (1, {'3': 1})),
+                (model.Group.get(u'dept-health'), False, (0, {})),
+                (model.Group.get(u'dept-health'), True,
+                 (2, {'0': 1, '3': 1}))):
+            total, counts = openness_scores(
+                publisher, include_sub_publishers, use_cache=True)
+            assert_equal((total, dict(counts)), expected,
+                         (publisher.name, include_sub_publishers))
+            # and the same as calculated live
+            total, counts = openness_scores(
+                publisher, include_sub_publishers, use_cache=False)
+            assert_equal((total, dict(counts)), expected)
+
+class TestPerformanceTrafficLights:
+    def test_all_good(self):
+        assert_equal(performance_traffic_lights(
+            resource_count=10, broken_count=0,
+            openness_counters={'4': 5, '5': 5},
+            issues='green', spending='green'),
+            {'broken_links': 'green', 'openness': 'green',
+             'issues': 'green', 'spending': 'green'})
+
+    def test_broken(self):
+        lights = performance_traffic_lights(
+            resource_count=10, broken_count=7, openness_counters={'0': 10},
+            issues='green', spending='red')
+        assert_equal(lights['broken_links'], 'red')
+        assert_equal(lights['openness'], 'red')
+        assert_equal(lights['spending'], 'red')
@@ -0,0 +1,64 @@
+from nose.tools import assert_equal
+from ckan import model
+from ckanext.dgu.lib import publisher_tree
+from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+
+
+def to_names(groups):
+    return [group.name for group in groups]
+
+class TestPublisherTree:
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+
+    @classmethod
+    def teardown_class(cls):
+        publisher_tree.invalidate()
+        model.repo.rebuild_db()
+
+    def test_ancestors(self):
+        assert_equal(to_names(publisher_tree.ancestors(model.Group.get(u'barnsley-primary-care-trust'))),
+                     ['barnsley-primary-care-trust', 'national-health-service', 'dept-health'])
+
+    def test_ancestors_by_id(self):
+        nhs = model.Group.get(u'national-health-service')
+        assert_equal(publisher_tree.ancestor_ids(nhs.id),
+                     [nhs.id, model.Group.get(u'dept-health').id])
+
+    def test_descendants(self):
+        assert_equal(sorted(to_names(publisher_tree.descendants(model.Group.get(u'national-health-service')))),
+                     ['barnsley-primary-care-trust', 'national-health-service', 'newham-primary-care-trust'])
+
+    def test_descendants_nearest_first(self):
+        names = to_names(publisher_tree.descendants(model.Group.get(u'dept-health')))
+        assert_equal(names[:2], ['dept-health', 'national-health-service'])
+
+    def test_top_level(self):
+        assert_equal(publisher_tree.top_level(model.Group.get(u'barnsley-primary-care-trust')).name,
+                     'dept-health')
+
+    def test_cached(self):
+        nhs = model.Group.get(u'national-health-service')
+        ids = publisher_tree.descendant_ids(nhs)
+        assert ('down', nhs.id) in publisher_tree._cache
+        assert_equal(publisher_tree.descendant_ids(nhs), ids)
+
+    def test_deleted_publisher_excluded(self):
+        nhs = model.Group.get(u'national-health-service')
+        model.repo.new_revision()
+        child = model.Group(name=u'closed-primary-care-trust',
+                            title=u'Closed Primary Care Trust',
+                            type='organization', is_organization=True)
+        model.Session.add(child)
+        model.Session.flush()
+        model.Session.add(model.Member(group=nhs, table_id=child.id,
+                                       table_name='group', capacity='parent'))
+        child.state = 'deleted'
+        model.repo.commit_and_remove()
+        publisher_tree.invalidate()
+
+        names = to_names(publisher_tree.descendants(
+            model.Group.get(u'national-health-service')))
+        assert 'closed-primary-care-trust' not in names, names
+        assert 'barnsley-primary-care-trust' in names, names
@@ -1,7 +1,10 @@
 from datetime import datetime as dt
+from datetime import timedelta
 from nose.tools import assert_equal
 
-from ckanext.dgu.lib.reports import get_quarter_dates
+from ckan import model
+from ckanext.dgu.lib.reports import get_quarter_dates, PublisherActivity
+from ckanext.dgu.testtools.create_test_data import DguCreateTestData
 
 class TestQuarters(object):
     def test_may(self):
@@ -20,3 +23,41 @@ class TestQuarters(object):
         assert_equal(qs['last'], (dt(2014, 1, 1), dt(2014, 3, 31)))
 
 
+class TestPublisherActivity(object):
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+        now = dt.now()
+        cls.periods = {'recent': (now - timedelta(days=1),
+                                  now + timedelta(days=1)),
+                       'old': (dt(2000, 1, 1), dt(2000, 3, 31))}
+        cls.activity = PublisherActivity(cls.periods)
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def test_created(self):
+        created, modified = self.activity.get_activity()
+        names = set(row[0] for row in created['recent'])
+        assert 'cabinet-office-energy-use' in names, names
+        assert_equal(created['old'], [])
+
+    def test_organization(self):
+        org = model.Group.by_name('cabinet-office')
+        created, modified = self.activity.get_activity([org.id])
+        names = set(row[0] for row in created['recent'])
+        assert_equal(names, set(pkg.name for pkg in model.Session.query(model.Package)
+                                .filter_by(owner_org=org.id)))
+
+    def test_unknown_organization(self):
+        created, modified = self.activity.get_activity(['not-an-org'])
+        assert_equal(created['recent'], [])
+        assert_equal(modified['recent'], [])
+
+    def test_activity_outlives_session(self):
+        # it is cached between requests, so mustn't need the Session
+        model.Session.remove()
+        created, modified = self.activity.get_activity()
+        names = set(row[0] for row in created['recent'])
+        assert 'cabinet-office-energy-use' in names, names
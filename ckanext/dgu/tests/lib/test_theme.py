@@ -3,8 +3,11 @@ import os.path
 from nose.tools import assert_equal
 
 from ckan import model
+from ckan.lib.create_test_data import CreateTestData
 from ckanext.dgu.lib.theme import (categorize_package, categorize_package2,
-                                   normalize_token)
+                                   categorize_packages, normalize_token,
+                                   stream_package_dicts, ThemeClassifier,
+                                   Themes)
 from ckanext.taxonomy.models import init_tables
 from ckanext.taxonomy import lib
 
@@ -39,6 +42,7 @@ class ThemeTestBase(object):
         themes_filepath = os.path.abspath(os.path.join(__file__,
                                                        '../../../themes.json'))
         lib.load_terms_and_extras(themes_filepath, 'dgu-themes')
+        Themes.invalidate()
 
     @classmethod
     def teardown_class(cls):
@@ -108,6 +112,101 @@ class TestCategorizePackage2(ThemeTestBase):
         assert_equal(set(('Business & Economy',)), set(theme_names))
 
 
+class TestThemeClassifier(ThemeTestBase):
+    def test_match_topics(self):
+        classifier = ThemeClassifier.instance()
+        matches = classifier.match_topics(['fish', 'in', 'the', 'river', 'fish'])
+
+        assert_equal(matches, [(1, 'fish', 2), (1, 'river', 1)])
+
+    def test_match_topics_ignores_stopwords(self):
+        classifier = ThemeClassifier.instance()
+
+        assert_equal(classifier.match_topics(['in', 'the']), [])
+
+    def test_categorize_packages(self):
+        pkgs = [fish_pkg, fish_and_spend_pkg, death_pkg, employer_pkg]
+        results = list(categorize_packages(pkgs, processes=2))
+
+        assert_equal([theme_scores for pkg, theme_scores in results],
+                     [categorize_package2(pkg) for pkg in pkgs])
+
+    def test_categorize_packages_in_process(self):
+        results = list(categorize_packages([fish_pkg], processes=1))
+
+        assert_equal(results[0][1], categorize_package2(fish_pkg))
+
+
+class TestThemes(ThemeTestBase):
+    def test_instance_is_shared(self):
+        assert Themes.instance() is Themes.instance()
+
+    def test_invalidate(self):
+        themes = Themes.instance()
+        Themes.invalidate()
+
+        assert Themes.instance() is not themes
+        assert_equal(Themes.instance().names, themes.names)
+
+    def test_invalidated_when_taxonomy_committed(self):
+        from ckanext.dgu.plugin import SearchPlugin
+        class TaxonomyTerm(object):
+            __tablename__ = 'taxonomy_term'
+        class Session(object):
+            _object_cache = {'new': set([TaxonomyTerm()]), 'changed': set(),
+                             'deleted': set()}
+        themes = Themes.instance()
+
+        SearchPlugin().before_commit(Session())
+
+        assert Themes.instance() is not themes
+
+    def test_names_in_taxonomy_order(self):
+        names = Themes.instance().names
+
+        assert_equal(len(names), 12)
+        assert_equal(names[0], 'Business & Economy')
+
+
+class TestStreamPackageDicts(object):
+    @classmethod
+    def setup_class(cls):
+        CreateTestData.create_arbitrary([
+            {'name': 'fishing',
+             'title': 'Fishing in the river',
+             'notes': 'Fish',
+             'tags': ['river', 'fish'],
+             'extras': {'theme-primary': 'Environment',
+                        'UKLP': 'True',
+                        'unrelated': 'value'}},
+            {'name': 'spending',
+             'title': 'Spend',
+             'notes': '',
+             'extras': {}},
+            ])
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def test_stream(self):
+        pkgs = list(stream_package_dicts())
+
+        assert_equal([pkg['name'] for pkg in pkgs], ['fishing', 'spending'])
+        assert_equal(pkgs[0]['id'], model.Package.by_name(u'fishing').id)
+        assert_equal(pkgs[0]['title'], 'Fishing in the river')
+        assert_equal(sorted(pkgs[0]['tags']), ['fish', 'river'])
+        assert_equal(pkgs[0]['extras'], {'theme-primary': 'Environment',
+                                         'UKLP': 'True'})
+        assert_equal(pkgs[1]['tags'], [])
+        assert_equal(pkgs[1]['extras'], {})
+
+    def test_limit(self):
+        pkgs = list(stream_package_dicts(limit=1, batch_size=1))
+
+        assert_equal([pkg['name'] for pkg in pkgs], ['fishing'])
+
+
 class TestNormalizeToken(object):
     def test_no_change(self):
         assert_equal(normalize_token('fish'), 'fish')
@@ -1,11 +1,14 @@
 import time
 import datetime
+import threading
 
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_raises
 
 from ckan import model
 
-from ckanext.dgu.authentication.drupal_auth import DrupalAuthMiddleware
+from ckanext.dgu.authentication.drupal_auth import (DrupalAuthMiddleware,
+                                                    DrupalSessionCache)
+from ckanext.dgu.drupalclient import DrupalRequestError
 from ckanext.dgu.tests import MockDrupalCase
 
 class TestCookie:
@@ -39,6 +42,79 @@ class TestCookie:
         res = DrupalAuthMiddleware._is_this_a_ckan_cookie(self.drupal_cookie)
         assert_equal(res, False)
 
+class TestDrupalSessionCache:
+    def setup(self):
+        self.loads = []
+
+    def load(self, session_id):
+        self.loads.append(session_id)
+        return {'user_name': 'user_d%s' % session_id} \
+            if session_id.startswith('valid') else None
+
+    def test_hit(self):
+        cache = DrupalSessionCache()
+        assert_equal(cache.get('valid1', self.load), {'user_name': 'user_dvalid1'})
+        assert_equal(cache.get('valid1', self.load), {'user_name': 'user_dvalid1'})
+        assert_equal(self.loads, ['valid1'])
+        assert_equal((cache.hits, cache.misses), (1, 1))
+
+    def test_negative(self):
+        cache = DrupalSessionCache()
+        assert_equal(cache.get('invalid', self.load), None)
+        assert_equal(cache.get('invalid', self.load), None)
+        assert_equal(self.loads, ['invalid'])
+        assert_equal(cache.negative_hits, 1)
+
+    def test_expiry(self):
+        cache = DrupalSessionCache(ttl=0, negative_ttl=0)
+        cache.get('valid1', self.load)
+        time.sleep(0.01)
+        cache.get('valid1', self.load)
+        assert_equal(self.loads, ['valid1', 'valid1'])
+
+    def test_max_size(self):
+        cache = DrupalSessionCache(max_size=2)
+        for session_id in ('valid1', 'valid2', 'valid1', 'valid3', 'valid1',
+                           'valid2'):
+            cache.get(session_id, self.load)
+        # valid2 was the least recently used when valid3 was added
+        assert_equal(self.loads, ['valid1', 'valid2', 'valid3', 'valid2'])
+
+    def test_error_not_cached(self):
+        cache = DrupalSessionCache()
+        def load(session_id):
+            self.loads.append(session_id)
+            raise DrupalRequestError('Drupal is down')
+        assert_raises(DrupalRequestError, cache.get, 'valid1', load)
+        assert_raises(DrupalRequestError, cache.get, 'valid1', load)
+        assert_equal(len(self.loads), 2)
+        assert_equal(cache.errors, 2)
+
+    def test_concurrent_lookups_share_one_load(self):
+        cache = DrupalSessionCache()
+        started = threading.Event()
+        release = threading.Event()
+        def slow_load(session_id):
+            started.set()
+            release.wait()
+            return self.load(session_id)
+        results = []
+        def lookup():
+            results.append(cache.get('valid1', slow_load))
+        threads = [threading.Thread(target=lookup) for i in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert_equal(self.loads, ['valid1'])
+        assert_equal(results, [{'user_name': 'user_dvalid1'}] * 5)
+        assert_equal(cache.stats()['misses'], 1)
+
+
 class MockApp:
     def __init__(self):
         self.calls = []
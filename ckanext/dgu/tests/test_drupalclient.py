@@ -1,9 +1,16 @@
 from pylons import config
 from nose.tools import assert_equal, assert_raises
 
+import socket
+import time
+
 from ckanext.dgu.tests import MockDrupalCase
 from ckanext.dgu.testtools.mock_drupal import get_mock_drupal_config, MOCK_DRUPAL_URL
-from ckanext.dgu.drupalclient import DrupalClient, DrupalKeyError
+from ckanext.dgu.testtools.mock_drupal2 import MockDrupal2Server
+from ckanext.dgu import drupalclient
+from ckanext.dgu.drupalclient import (DrupalClient, DrupalKeyError,
+                                      CircuitBreaker, DrupalCircuitOpenError,
+                                      DrupalTransport)
 
 class TestDrupalConnection(MockDrupalCase):
 
@@ -61,3 +68,143 @@ class TestDrupalConnection(MockDrupalCase):
         assert_raises(DrupalKeyError, client.get_department_from_organisation, '')
         assert_raises(DrupalKeyError, client.get_department_from_organisation, None)
         
+
+
+class TestCircuitBreaker:
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(threshold=2, reset_seconds=60)
+        breaker.before_call()
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+        assert_raises(DrupalCircuitOpenError, breaker.before_call)
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(threshold=2, reset_seconds=60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.before_call()
+
+    def test_trial_call_after_reset(self):
+        breaker = CircuitBreaker(threshold=1, reset_seconds=0)
+        breaker.record_failure()
+        # one trial call is let through
+        breaker.before_call()
+        assert_raises(DrupalCircuitOpenError, breaker.before_call)
+        breaker.record_success()
+        breaker.before_call()
+        breaker.before_call()
+
+
+class MockTime(object):
+    '''Records the sleeps of the drupalclient module, instead of
+    sleeping.'''
+    def __init__(self):
+        self.sleeps = []
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+class TestDrupalTransport:
+    @classmethod
+    def setup_class(cls):
+        cls.server = MockDrupal2Server(port=0)
+        cls.server.start()
+        cls.base_url = 'http://localhost:%s' % cls.server.port
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.stop()
+
+    def setup(self):
+        self.server.faults = []
+        self.server.requests = []
+        self.transport = DrupalTransport(timeout=0.5, retries=2, backoff=0.1,
+                                         breaker_threshold=2)
+        self.time = MockTime()
+        drupalclient.time = self.time
+
+    def teardown(self):
+        drupalclient.time = time
+
+    def get_node(self):
+        return self.transport.request(
+            'GET', self.base_url + '/services/rest/node/1', 'node')
+
+    def test_retry_on_5xx(self):
+        self.server.faults = [503, 500]
+        response = self.get_node()
+        assert_equal(response.json()['nid'], '1')
+        assert_equal(len(self.server.requests), 3)
+        assert_equal(self.time.sleeps, [0.1, 0.2])
+        stats = self.transport.stats()['node']
+        assert_equal((stats['calls'], stats['errors']), (3, 2))
+        assert_equal(self.transport.breaker.failures, 0)
+
+    def test_retry_on_timeout(self):
+        self.server.faults = [1.0]
+        response = self.get_node()
+        assert_equal(response.status_code, 200)
+        assert_equal(len(self.server.requests), 2)
+        assert_equal(self.time.sleeps, [0.1])
+
+    def test_no_retry_on_4xx(self):
+        response = self.transport.request(
+            'GET', self.base_url + '/services/rest/not-there', 'not-there')
+        assert_equal(response.status_code, 404)
+        assert_equal(len(self.server.requests), 1)
+        assert_equal(self.time.sleeps, [])
+
+    def test_gives_up_after_retries(self):
+        self.server.faults = [500, 500, 500, 500, 500, 500]
+        assert_equal(self.get_node().status_code, 500)
+        assert_equal(len(self.server.requests), 3)
+        assert_equal(self.time.sleeps, [0.1, 0.2])
+        assert_equal(self.transport.breaker.failures, 1)
+        # the second failed call opens the circuit
+        self.get_node()
+        assert_raises(DrupalCircuitOpenError, self.get_node)
+        assert_equal(len(self.server.requests), 6)
+
+    def test_unreachable(self):
+        transport = DrupalTransport(timeout=0.5, retries=1, backoff=0)
+        # nothing listens on port 1
+        assert_raises(socket.error, transport.request,
+                      'GET', 'http://localhost:1/services/rest/node/1', 'node')
+        assert_equal(transport.breaker.failures, 1)
+
+    def test_unexpected_error_ends_trial(self):
+        breaker = self.transport.breaker
+        breaker.reset_seconds = 0
+        breaker.record_failure()
+        breaker.record_failure()
+        def request(*args, **kwargs):
+            raise ValueError('unexpected')
+        self.transport.session.request = request
+        # the trial call
+        assert_raises(ValueError, self.get_node)
+        del self.transport.session.request
+        # another trial is allowed, rather than the circuit staying open
+        assert_equal(self.get_node().status_code, 200)
+        assert_equal(breaker.opened_at, None)
+
+    def test_xmlrpc_through_shared_session(self):
+        settings = {'xmlrpc_domain': 'localhost:%s' % self.server.port}
+        client = DrupalClient(settings)
+        connections = self.server.connections
+        expected_user = get_mock_drupal_config()['test_users']['62']
+
+        for i in range(3):
+            user = DrupalClient(settings).get_user_properties('62')
+            assert_equal(user['name'], expected_user['name'])
+
+        assert DrupalClient(settings).transport is client.transport
+        assert_equal(client.stats()['user.retrieve']['calls'], 3)
+        # one kept-alive connection for all the calls
+        assert_equal(self.server.connections - connections, 1)
+        assert_equal(self.server.requests, ['/services/xmlrpc'] * 3)
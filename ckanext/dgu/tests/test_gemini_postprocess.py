@@ -1,17 +1,37 @@
+import os
+import time
+import threading
+import BaseHTTPServer
+from StringIO import StringIO
+from collections import defaultdict
+
 from nose.tools import assert_equal
 
 import ckan.new_tests.factories as factories
 import ckan.new_tests.helpers as helpers
 
+from ckanext.dgu import gemini_postprocess
 from ckanext.dgu.gemini_postprocess import (
     process_package_,
     process_resource,
+    probe_wms,
+    probe_wms_urls,
+    inspect_capabilities,
+    _check_capabilities,
+    resource_fingerprints,
     _is_wms,
     wms_capabilities_url,
     _wms_base_urls,
     strip_session_id,
     )
 
+SAMPLES_DIR = os.path.join(os.path.dirname(__file__), 'wms_samples')
+
+
+def read_sample(filename):
+    with open(os.path.join(SAMPLES_DIR, filename)) as f:
+        return f.read()
+
 
 class TestProcessPackage(object):
     # Warning - servers may go down
@@ -129,3 +149,201 @@ class TestIsWms(object):
         assert_equal(_is_wms(
             'http://environment.data.gov.uk/ds/wms?SERVICE=WMS&INTERFACE=ENVIRONMENT--6f51a299-351f-4e30-a5a3-2511da9688f7'
             ), True)
+
+
+WMS_1_3_CAPABILITIES = '''<?xml version="1.0" encoding="UTF-8"?>
+<WMS_Capabilities version="1.3.0" xmlns="http://www.opengis.net/wms"
+    xmlns:xlink="http://www.w3.org/1999/xlink">
+  <Capability><Request><GetMap><DCPType><HTTP><Get>
+    <OnlineResource xlink:href="http://maps.example.com/wms;jsessionid=abc?"/>
+  </Get></HTTP></DCPType></GetMap></Request></Capability>
+</WMS_Capabilities>'''
+
+
+class TestProbeWms(object):
+    @classmethod
+    def setup_class(cls):
+        cls.paths = []
+        paths = cls.paths
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                paths.append(self.path)
+                versioned = 'version=' in self.path
+                if self.path.startswith('/error') and not versioned:
+                    self.send_error(400)
+                    return
+                self.send_response(200)
+                self.end_headers()
+                if self.path.startswith('/csv'):
+                    self.wfile.write('a,b\n1,2\n')
+                elif self.path.startswith('/exception') and not versioned:
+                    self.wfile.write(read_sample('service_exception.xml'))
+                else:
+                    self.wfile.write(WMS_1_3_CAPABILITIES)
+
+            def log_message(self, format, *args):
+                pass
+        cls.server = BaseHTTPServer.HTTPServer(('localhost', 0), Handler)
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cls.host = 'http://localhost:%s' % cls.server.server_port
+        cls.url = cls.host + '/wms'
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_one_request(self):
+        del self.paths[:]
+        assert_equal(probe_wms(self.url),
+                     {'is_wms': True,
+                      'base_urls': ['http://maps.example.com/wms;jsessionid=']})
+        assert_equal(self.paths,
+                     ['/wms?service=WMS&request=GetCapabilities'])
+
+    def test_not_wms_one_request(self):
+        del self.paths[:]
+        assert_equal(probe_wms(self.host + '/csv'),
+                     {'is_wms': False, 'base_urls': []})
+        assert_equal(self.paths,
+                     ['/csv?service=WMS&request=GetCapabilities'])
+
+    def test_http_error_tries_versions(self):
+        del self.paths[:]
+        assert_equal(probe_wms(self.host + '/error'),
+                     {'is_wms': True, 'base_urls': []})
+        assert_equal(self.paths,
+                     ['/error?service=WMS&request=GetCapabilities',
+                      '/error?service=WMS&request=GetCapabilities&version=1.3'])
+
+    def test_service_exception_tries_versions(self):
+        del self.paths[:]
+        assert_equal(probe_wms(self.host + '/exception'),
+                     {'is_wms': True, 'base_urls': []})
+        assert_equal(len(self.paths), 2)
+
+
+class TestProbeWmsUrls(object):
+    def setup(self):
+        self.original_probe_wms = gemini_postprocess.probe_wms
+        self.calls = []
+        self.in_flight = defaultdict(int)
+        self.max_in_flight = defaultdict(int)
+        self.lock = threading.Lock()
+
+        def probe_wms(url):
+            host = url.split('/')[2]
+            with self.lock:
+                self.calls.append(url)
+                self.in_flight[host] += 1
+                self.max_in_flight[host] = max(self.max_in_flight[host],
+                                               self.in_flight[host])
+            time.sleep(0.02)
+            with self.lock:
+                self.in_flight[host] -= 1
+            return {'is_wms': True, 'base_urls': [url]}
+        gemini_postprocess.probe_wms = probe_wms
+
+    def teardown(self):
+        gemini_postprocess.probe_wms = self.original_probe_wms
+
+    def test_probe_each_service_once(self):
+        urls = ['http://a.com/wms;jsessionid=1',
+                'http://a.com/wms;jsessionid=2',
+                'http://a.com/wms?request=GetCapabilities&service=WMS',
+                'http://b.com/wms?layer=x',
+                'http://b.com/wms?layer=y']
+        probes = probe_wms_urls(urls, workers=4)
+        assert_equal(len(self.calls), 4)
+        assert_equal(probes[urls[1]], probes[urls[0]])
+        assert probes[urls[3]] != probes[urls[4]]
+
+    def test_per_host_limit(self):
+        urls = ['http://%s.com/wms?layer=%s' % (host, i)
+                for host in 'ab' for i in range(6)]
+        probes = probe_wms_urls(urls, workers=8, per_host=2)
+        assert_equal(len(self.calls), 12)
+        assert_equal(dict(self.max_in_flight), {'a.com': 2, 'b.com': 2})
+
+
+class TestInspectCapabilities(object):
+    def test_wms_1_3(self):
+        capabilities = inspect_capabilities(StringIO(
+            read_sample('wms_1_3_capabilities.xml')))
+        assert_equal(capabilities.root_tag,
+                     '{http://www.opengis.net/wms}WMS_Capabilities')
+        assert_equal(capabilities.service_exception, None)
+        assert_equal(capabilities.has_layer, True)
+        # not the Service or LegendURL OnlineResources
+        assert_equal(capabilities.online_resources, [
+            'http://www.geostore.com/OGC/OGCInterface;jsessionid=d5A2nBGr7eFdyUDUfo5gWD8R?INTERFACE=ENVIRONMENT&',
+            'http://www.geostore.com/OGC/OGCInterface;jsessionid=d5A2nBGr7eFdyUDUfo5gWD8R',
+            'http://www.geostore.com/OGC/OGCInterface;jsessionid=d5A2nBGr7eFdyUDUfo5gWD8R?INTERFACE=ENVIRONMENT&',
+            'http://maps.environment-agency.gov.uk/featureinfo?'])
+        assert_equal(_check_capabilities('url', capabilities, '1.3'), True)
+        assert_equal(_check_capabilities('url', capabilities, '1.1.1'),
+                     False)
+
+    def test_wms_1_1_1(self):
+        capabilities = inspect_capabilities(StringIO(
+            read_sample('wms_1_1_1_capabilities.xml')))
+        assert_equal(capabilities.root_tag, 'WMT_MS_Capabilities')
+        assert_equal(capabilities.has_layer, True)
+        assert_equal(capabilities.online_resources, [])
+        assert_equal(_check_capabilities('url', capabilities, '1.1.1'),
+                     True)
+        assert_equal(_check_capabilities('url', capabilities, '1.3'), False)
+
+    def test_service_exception(self):
+        capabilities = inspect_capabilities(StringIO(
+            read_sample('service_exception.xml')))
+        assert capabilities.service_exception.startswith('Access denied')
+        assert_equal(_check_capabilities('url', capabilities, '1.3'), False)
+        assert_equal(_check_capabilities('url', capabilities, '1.1.1'),
+                     False)
+
+    def test_stops_at_first_layer(self):
+        xml = read_sample('wms_1_3_capabilities.xml')
+        layer_start = xml.index('<Layer>')
+        xml = xml[:layer_start] + '<Layer>' * 100000
+        capabilities = inspect_capabilities(StringIO(xml))
+        assert_equal(capabilities.error, None)
+        assert_equal(capabilities.has_layer, True)
+        assert capabilities.bytes_read < 50000, capabilities.bytes_read
+
+    def test_html(self):
+        capabilities = inspect_capabilities(StringIO(
+            '<html><body>' + '<p>Not a WMS</p>' * 10000))
+        assert_equal(capabilities.root_tag, 'html')
+        assert capabilities.bytes_read < 50000, capabilities.bytes_read
+
+    def test_empty(self):
+        assert_equal(inspect_capabilities(StringIO(' \n')).error, 'empty')
+
+    def test_not_xml(self):
+        assert inspect_capabilities(StringIO('{"a": 1}')).error
+
+    def test_too_large(self):
+        xml = read_sample('wms_1_3_capabilities.xml')
+        assert_equal(inspect_capabilities(StringIO(xml), max_bytes=1000)
+                     .error, 'too large')
+
+
+class TestResourceFingerprints(object):
+    def test_changes(self):
+        before = resource_fingerprints([('id1', 'http://a.com/wms'),
+                                        ('id2', u'http://b.com/caf\xe9')])
+        assert_equal(len(before), 2)
+        # unchanged or removed
+        assert_equal(resource_fingerprints(
+            [('id2', u'http://b.com/caf\xe9')]) - before, set())
+        # added
+        assert_equal(len(resource_fingerprints(
+            [('id1', 'http://a.com/wms'), ('id3', 'http://a.com/wms')])
+            - before), 1)
+        # url changed
+        assert_equal(len(resource_fingerprints(
+            [('id1', 'http://a.com/wms?x=1')]) - before), 1)
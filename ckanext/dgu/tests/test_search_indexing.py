@@ -1,6 +1,15 @@
+import datetime
+
 from nose.tools import assert_equal
+from nose.plugins.skip import SkipTest
+from pylons import config
 
-from ckanext.dgu.search_indexing import SearchIndexing
+from ckan import model
+import ckan.lib.search.index as search_index
+from ckanext.dgu.plugins_toolkit import get_action
+from ckanext.dgu.search_indexing import SearchIndexing, _get_extra
+from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+import ckanext.dgu.model.schema_codelist as schema_model
 
 resource_format_cleanup = SearchIndexing.resource_format_cleanup
 
@@ -30,3 +39,115 @@ class TestResourceFormatCleanup:
     #def test_ical(self): self.assert_format_clean('ical', 'iCal')
     def test_shapefile(self): self.assert_format_clean('shapefile', 'SHP')
     def test_sql(self): self.assert_format_clean('sql', 'Database')
+
+
+class TestGetExtra:
+    def test_index_dict(self):
+        assert_equal(_get_extra({'UKLP': 'True'}, 'UKLP'), 'True')
+
+    def test_package_show_dict(self):
+        pkg = {'extras': [{'key': 'UKLP', 'value': 'True'}]}
+        assert_equal(_get_extra(pkg, 'UKLP'), 'True')
+
+    def test_missing(self):
+        assert_equal(_get_extra({'extras': []}, 'UKLP', 'False'), 'False')
+
+
+class MockSolrConnection(object):
+    def __init__(self, docs):
+        self.docs = docs
+
+    def add_many(self, docs, _commit=True):
+        self.docs.extend(docs)
+
+    def close(self):
+        pass
+
+
+class TestPrefetch:
+    '''Indexing with the values prefetched for the batch gives the same
+    result as looking them up for each dataset.'''
+    names = ['cabinet-office-energy-use', 'directgov-cota',
+             'gdp_and_the_labour_market_']
+
+    @classmethod
+    def setup_class(cls):
+        try:
+            from ckanext.ga_report import ga_model
+        except ImportError:
+            raise SkipTest('ckanext-ga-report is not installed')
+        ga_model.init_tables()
+        schema_model.init_tables(model.meta.engine)
+        DguCreateTestData.create_dgu_test_data()
+
+        now = datetime.datetime.now()
+        last_month = now - datetime.timedelta(days=30)
+        this_period = '%s-%02d' % (now.year, now.month)
+        last_period = '%s-%02d' % (last_month.year, last_month.month)
+        entries = [('directgov-cota', this_period, 40, 4),
+                   # not a complete day yet
+                   ('gdp_and_the_labour_market_', this_period, 30, 0)]
+        # e.g. on the 31st, 30 days ago is in the same month
+        cls.one_period = last_period == this_period
+        if not cls.one_period:
+            entries.append(('directgov-cota', last_period, 300, 30))
+        for name, period_name, pageviews, period_complete_day in entries:
+            model.Session.add(ga_model.GA_Url(
+                period_name=period_name, pageviews=pageviews,
+                period_complete_day=period_complete_day,
+                url='/dataset/%s' % name, package_id=name))
+        model.Session.commit()
+
+        cls.original_plugins = config.get('ckan.plugins', '')
+        config['ckan.plugins'] = cls.original_plugins + ' ga-report'
+
+    @classmethod
+    def teardown_class(cls):
+        config['ckan.plugins'] = cls.original_plugins
+        model.repo.rebuild_db()
+
+    def setup(self):
+        self.docs = []
+        self.original_make_connection = search_index.make_connection
+        search_index.make_connection = lambda: MockSolrConnection(self.docs)
+
+    def teardown(self):
+        search_index.make_connection = self.original_make_connection
+
+    def index(self, prefetch):
+        '''Indexes the datasets as "dgu_search_index rebuild" does, and
+        returns the docs that would be sent to Solr.'''
+        context = {'model': model, 'ignore_auth': True, 'validate': False,
+                   'use_cache': False}
+        pkg_dicts = [get_action('package_show')(context, {'id': name})
+                     for name in self.names]
+        if prefetch:
+            SearchIndexing.prefetch(pkg_dicts)
+        try:
+            for pkg_dict in pkg_dicts:
+                search_index.PackageSearchIndex().update_dict(
+                    pkg_dict, defer_commit=True)
+        finally:
+            SearchIndexing.clear_prefetched()
+        docs = dict((doc['name'], doc) for doc in self.docs)
+        del self.docs[:]
+        for doc in docs.values():
+            del doc['indexed_ts']
+        return docs
+
+    def test_same_as_without_prefetch(self):
+        docs = self.index(prefetch=False)
+        prefetched_docs = self.index(prefetch=True)
+
+        assert_equal(sorted(docs), self.names)
+        for name in self.names:
+            assert_equal(prefetched_docs[name], docs[name])
+        popularity = dict((name, doc['popularity'])
+                          for name, doc in prefetched_docs.items())
+        # 10 views a day last month, discounted by half, and this month
+        assert_equal(popularity['directgov-cota'], 1500)
+        # 2 views a day this month (taken to be 15 days in), or counted
+        # for both periods
+        assert_equal(popularity['gdp_and_the_labour_market_'],
+                     300 if self.one_period else 200)
+        assert_equal(popularity['cabinet-office-energy-use'], 0)
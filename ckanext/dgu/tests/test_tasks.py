@@ -0,0 +1,215 @@
+import copy
+import logging
+import threading
+
+from nose.tools import assert_equal
+
+from ckanclient import CkanApiError
+
+from ckanext.dgu import tasks
+from ckanext.dgu.tasks import InventoryUploader
+
+log = logging.getLogger(__name__)
+
+
+class Cell(object):
+    def __init__(self, value):
+        self.value = value
+
+
+def make_rows(rows):
+    '''Returns rows like _process_upload's, numbered from 2 as row 1 is the
+    header.'''
+    return [(row_number, [Cell(value) for value in row])
+            for row_number, row in enumerate(rows, 2)]
+
+
+class MockSite(object):
+    '''The organizations and datasets that a MockCkanClient talks to.'''
+    def __init__(self, orgs, packages):
+        self.orgs = orgs
+        self.packages = dict((pkg['name'], pkg) for pkg in packages)
+        self.created = []
+        self.updated = []
+        self.lock = threading.Lock()
+
+
+class MockCkanClient(object):
+    def __init__(self, site):
+        self.site = site
+        self.last_status = None
+
+    def action(self, name, **params):
+        if name == 'organization_list':
+            return self.site.orgs
+        assert_equal(name, 'package_search')
+        unpublished = params['fq'].startswith('+unpublished:true')
+        with self.site.lock:
+            results = [
+                dict(pkg, organization={'name': pkg['owner_org']})
+                for name_, pkg in sorted(self.site.packages.items())
+                if bool(pkg['extras'].get('unpublished')) == unpublished]
+        start = params['start']
+        return {'count': len(results),
+                'results': results[start:start + params['rows']]}
+
+    def package_entity_get(self, name):
+        with self.site.lock:
+            pkg = self.site.packages.get(name)
+        if not pkg:
+            self.last_status = 404
+            raise CkanApiError('Not found')
+        self.last_status = 200
+        return copy.deepcopy(pkg)
+
+    def package_entity_put(self, pkg):
+        with self.site.lock:
+            self.site.packages[pkg['name']] = pkg
+            self.site.updated.append(pkg['name'])
+
+    def package_register_post(self, pkg):
+        pkg = dict(pkg, id='id-%s' % pkg['name'])
+        with self.site.lock:
+            self.site.packages[pkg['name']] = pkg
+            self.site.created.append(pkg['name'])
+        return pkg
+
+
+class TestInventoryUploader(object):
+    def setup(self):
+        self.site = MockSite(
+            orgs=[{'name': 'dept-health', 'title': 'Department of Health'},
+                  {'name': 'cabinet-office', 'title': 'Cabinet Office'}],
+            packages=[
+                {'id': 'id-existing', 'name': 'existing',
+                 'title': 'Existing', 'owner_org': 'dept-health',
+                 'notes': 'Old', 'extras': {'unpublished': True}},
+                {'id': 'id-published', 'name': 'published',
+                 'title': 'Published', 'owner_org': 'dept-health',
+                 'notes': '', 'extras': {}},
+                ])
+        self.original_client = tasks.CkanClient
+        tasks.CkanClient = lambda **kwargs: MockCkanClient(self.site)
+        self.progress = []
+
+    def teardown(self):
+        tasks.CkanClient = self.original_client
+
+    def process(self, rows, batch_size=None):
+        uploader = InventoryUploader(
+            {'site_url': 'http://test.data.gov.uk/', 'apikey': 'key'}, log,
+            progress=lambda *args: self.progress.append(args))
+        if batch_size:
+            uploader.BATCH_SIZE = batch_size
+        return uploader.process(make_rows(rows))
+
+    def test_add_and_update(self):
+        errors, results = self.process([
+            [u'New', u'A new one', u'dept-health', u'', u''],
+            [u'Existing', u'Now described', u'dept-health', u'', u'Notes'],
+            ])
+
+        assert_equal(errors, [])
+        assert_equal(results, [{'package': 'id-new', 'action': 'Added'},
+                               {'package': 'id-existing',
+                                'action': 'Updated'}])
+        assert_equal(self.site.packages['new']['owner_org'], 'dept-health')
+        assert_equal(self.site.packages['existing']['notes'],
+                     'Now described')
+        assert_equal(self.site.packages['existing']['extras']
+                     ['release-notes'], 'Notes')
+
+    def test_publisher_by_title(self):
+        errors, results = self.process([
+            [u'New', u'A new one', u'Cabinet Office', u'', u''],
+            ])
+
+        assert_equal(errors, [])
+        assert_equal(self.site.packages['new']['owner_org'],
+                     'cabinet-office')
+
+    def test_title_of_another_publisher_is_added(self):
+        errors, results = self.process([
+            [u'Existing', u'Same title', u'cabinet-office', u'', u''],
+            ])
+
+        assert_equal(errors, [])
+        assert_equal(results, [{'package': 'id-existing_1',
+                                'action': 'Added'}])
+
+    def test_duplicate_titles_in_one_upload(self):
+        errors, results = self.process([
+            [u'Twice', u'First', u'dept-health', u'', u''],
+            [u'twice', u'Second', u'dept-health', u'', u''],
+            ])
+
+        assert_equal(errors, [])
+        assert_equal(results, [{'package': 'id-twice', 'action': 'Added'},
+                               {'package': 'id-twice', 'action': 'Updated'}])
+        assert_equal(self.site.created, ['twice'])
+        assert_equal(self.site.packages['twice']['notes'], 'Second')
+
+    def test_unknown_publisher(self):
+        errors, results = self.process([
+            [u'New', u'A new one', u'not-a-publisher', u'', u''],
+            ])
+
+        assert_equal(errors, ['Row 2 (New): Publisher does not exist in '
+                              'data.gov.uk: "not-a-publisher"'])
+        assert_equal(results, [])
+
+    def test_missing_fields(self):
+        errors, results = self.process([
+            [u'New', u' ', u'', u'', u''],
+            ])
+
+        assert_equal(errors, ['Row 2 (New): The following fields were '
+                              'missing: Description of dataset, Owner'])
+
+    def test_published_title(self):
+        errors, results = self.process([
+            [u'PUBLISHED', u'A new one', u'dept-health', u'', u''],
+            ])
+
+        assert_equal(errors, ["Row 2 (PUBLISHED): The non-inventory dataset "
+                              "'PUBLISHED' already exists"])
+        assert_equal(self.site.created, [])
+
+    def test_errors_in_row_order(self):
+        errors, results = self.process([
+            [u'Published', u'Conflicts', u'dept-health', u'', u''],
+            [u'New 1', u'', u'dept-health', u'', u''],
+            [u'New 2', u'Fine', u'dept-health', u'', u''],
+            [u'New 3', u'Fine', u'not-a-publisher', u'', u''],
+            [u'New 4', u'Fine', u'dept-health', 5, u''],
+            [u'Published', u'Conflicts', u'dept-health', u'', u''],
+            ], batch_size=1)
+
+        assert_equal([error.split(':')[0] for error in errors],
+                     ['Row 2 (Published)', 'Row 3 (New 1)', 'Row 5 (New 3)',
+                      'Row 6 (New 4)', 'Row 7 (Published)'])
+        assert_equal(results, [{'package': 'id-new-2', 'action': 'Added'}])
+        # a progress report after each batch of one row
+        assert_equal([num_processed for num_processed, _ in self.progress],
+                     [4, 5, 6])
+        assert_equal(self.progress[-1][1], errors)
+
+    def test_batches_split_on_duplicate_key(self):
+        uploader = InventoryUploader({'site_url': 'http://test/',
+                                      'apikey': 'key'}, log)
+        uploader.BATCH_SIZE = 3
+        group = {'name': 'dept-health'}
+        items = [{'title': title, 'group': group}
+                 for title in ('a', 'b', 'A', 'c', 'd', 'e', 'f')]
+
+        batches = [[item['title'] for item in batch]
+                   for batch in uploader.batches(items)]
+
+        assert_equal(batches, [['a', 'b'], ['A', 'c', 'd'], ['e', 'f']])
+
+    def test_get_clean_name_claims_names(self):
+        uploader = InventoryUploader({'site_url': 'http://test/',
+                                      'apikey': 'key'}, log)
+        names = [uploader.get_clean_name('Existing') for i in range(3)]
+
+        assert_equal(names, ['existing_1', 'existing_2', 'existing_3'])
@@ -944,3 +944,177 @@ c163e7e1fba578e38bb3cf295bd1be0514d2fcf9  fact_table_extract_2009_10.zip</p>
 <li class="pager-last last"><a href="/comment/get/3266d22c-9d0f-4ebe-b0bc-ea622f858e15?page=1" title="Go to last page" class="active">last</a></li>
 </ul></div>  </div>
 '''
+
+
+def example_replies():
+    '''The example comments in the format of Drupal's REST replies view.'''
+    replies = []
+    def add(comments):
+        for comment in comments:
+            replies.append({'entity_id': comment['nid'],
+                            'reply id': comment['cid'],
+                            'uid': comment['uid'],
+                            'subject': comment['subject'],
+                            'comment': comment['comment']})
+            add(comment.get('children') or [])
+    add(example_comments_json)
+    return replies
+
+
+def example_node(nid):
+    '''A forum topic in the format of Drupal's REST node resource.'''
+    return {'nid': nid,
+            'vid': nid,
+            'type': 'forum',
+            'title': 'Topic %s' % nid,
+            'uid': '62',
+            'status': '1',
+            'created': '1406568348',
+            'changed': '1447195725',
+            'body': {'und': [{'value': '<p>Does anyone know how to remove '
+                                       'a dataset?</p>',
+                              'format': 'filtered_html'}]}}
+
+
+class MockDrupal2Server(object):
+    '''A standalone mock of Drupal's XML-RPC and REST services, with
+    keep-alive (HTTP/1.1) connections, for benchmarking DrupalClient.
+
+    latency - seconds taken to respond to each request
+    connect_latency - seconds taken to accept each new connection, like the
+                      TCP and TLS handshakes with a remote Drupal
+    port - 0 for any free port, which is then set on start()
+    e.g.
+        server = MockDrupal2Server(port=8052, latency=0.01)
+        server.start()  # in a background thread
+        ...
+        server.stop()
+
+    For testing errors, the next requests are given the `faults` in turn:
+    an int is an HTTP status to respond with instead, and a float is
+    seconds to wait before responding. The path of each request is recorded
+    in `requests`, and the number of connections made in `connections`.
+    '''
+    def __init__(self, host='localhost', port=8052, latency=0,
+                 connect_latency=0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.server = None
+        self.faults = []
+        self.requests = []
+        self.connections = 0
+
+    def make_server(self):
+        import socket
+        import threading
+        import time
+        import BaseHTTPServer
+        import SocketServer
+        from SimpleXMLRPCServer import SimpleXMLRPCDispatcher
+        from xmlrpclib import Fault
+        from ckanext.dgu.testtools.mock_drupal import get_mock_drupal_config
+
+        config = get_mock_drupal_config()
+        dispatcher = SimpleXMLRPCDispatcher(allow_none=True, encoding=None)
+
+        def session_retrieve(session_id):
+            return config['test_sessions'].get(session_id, '0')
+        def user_retrieve(user_id):
+            try:
+                return config['test_users'][user_id]
+            except KeyError:
+                raise Fault(404, 'There is no user with such ID.')
+        dispatcher.register_function(session_retrieve, 'session.retrieve')
+        dispatcher.register_function(user_retrieve, 'user.retrieve')
+        replies = json.dumps(example_replies())
+        latency = self.latency
+        connect_latency = self.connect_latency
+        mock = self
+        lock = threading.Lock()
+
+        class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # send the headers and body together, or kept-alive connections
+            # wait for delayed ACKs
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                with lock:
+                    mock.connections += 1
+                if connect_latency:
+                    time.sleep(connect_latency)
+
+            def _fault(self):
+                '''Records the request and returns True if it has been
+                responded to with an error status.'''
+                with lock:
+                    mock.requests.append(self.path)
+                    fault = mock.faults.pop(0) if mock.faults else None
+                if isinstance(fault, float):
+                    time.sleep(fault)
+                elif fault:
+                    self.send_error(fault)
+                    return True
+                return False
+
+            def _respond(self, body, content_type):
+                if latency:
+                    time.sleep(latency)
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except socket.error:
+                    # the client gave up waiting
+                    self.close_connection = 1
+
+            def do_POST(self):
+                if self._fault():
+                    return
+                if self.path != '/services/xmlrpc':
+                    self.send_error(404)
+                    return
+                request_body = self.rfile.read(
+                    int(self.headers['Content-Length']))
+                self._respond(dispatcher._marshaled_dispatch(request_body),
+                              'text/xml')
+
+            def do_GET(self):
+                if self._fault():
+                    return
+                if self.path.startswith('/services/rest/views/replies'):
+                    self._respond(replies, 'application/json')
+                elif self.path.startswith('/services/rest/node/'):
+                    nid = self.path.split('/')[-1]
+                    self._respond(json.dumps(example_node(nid)),
+                                  'application/json')
+                else:
+                    self.send_error(404)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        return Server((self.host, self.port), RequestHandler)
+
+    def start(self):
+        import threading
+        self.server = self.make_server()
+        self.port = self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        log.info('Mock Drupal serving on http://%s:%s', self.host, self.port)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -77,6 +77,7 @@ setup(
         selenium_tests = ckanext.dgu.commands.selenium_tests:TestRunner
         build_void = ckanext.dgu.commands.void_constructor:VoidConstructor
         stress_solr = ckanext.dgu.commands.solr_stress:SolrStressTest
+        dgu_search_index = ckanext.dgu.commands.search_index:SearchIndex
         remap_govuk_resources = ckanext.dgu.commands.remap_govuk_resources:ResourceRemapper
         derive_govuk_resources = ckanext.dgu.commands.derive_govuk_resources:GovUkResourceChecker
         refine_packages = ckanext.dgu.commands.refine_packages:RefinePackages
@@ -92,6 +93,7 @@ setup(
         schema = ckanext.dgu.commands.schema:Schema
         user_sync = ckanext.dgu.commands.user_sync:UserSync
         updated_harvested_schema = ckanext.dgu.commands.update_harvested_schema:UpdateHarvestedSchema
+        classify_themes = ckanext.dgu.commands.theme_classify:ClassifyThemes
     """,
     test_suite = 'nose.collector',
 )